@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+from itertools import chain
 import os
 import pickle
 import sys
@@ -8,9 +9,9 @@ import time
 from sloika import fast5
 from sloika.cmdargs import (AutoBool, ByteString, FileAbsent, FileExists, Maybe,
                                NonNegative, proportion, Positive, Vector)
-from sloika.iterators import imap_mp
+from sloika.iterators import grouper_it, imap_mp
 
-from sloika import basecall, helpers, util
+from sloika import basecall, batch, helpers, maths, util
 
 
 # create the top-level parser
@@ -23,8 +24,14 @@ parser = argparse.ArgumentParser(
 common_parser = argparse.ArgumentParser(add_help=False)
 common_parser.add_argument('--alphabet', default=b"ACGT", action=ByteString,
                            help='Alphabet of the sequences')
+common_parser.add_argument('--beam', default=None, metavar='width', type=Maybe(Positive(int)),
+                           help='Width of beam for transducer decoding (None for exact Viterbi)')
 common_parser.add_argument('--compile', default=None, action=FileAbsent,
                            help='File output compiled model')
+common_parser.add_argument('--decode_threads', default=None, metavar='n', type=Maybe(Positive(int)),
+                           help='Threads per job decoding while network is evaluated (None for no threads)')
+common_parser.add_argument('--graph_decode', default=False, action=AutoBool,
+                           help='Decode transducer within compiled network (requires uncompiled model)')
 common_parser.add_argument('--input_strand_list', default=None, action=FileExists,
                            help='Strand summary file containing subset')
 common_parser.add_argument('--jobs', default=1, metavar='n', type=Positive(int),
@@ -35,8 +42,16 @@ common_parser.add_argument('--limit', default=None, metavar='reads',
                            type=Maybe(Positive(int)), help='Limit number of reads to process')
 common_parser.add_argument('--min_prob', metavar='proportion', default=1e-5,
                            type=proportion, help='Minimum allowed probabiility for basecalls')
+common_parser.add_argument('--polish', default=None, nargs=2, metavar=('iterations', 'seconds'),
+                           type=NonNegative(float),
+                           help='Budget for refining transducer calls using forward scores, reported score of '
+                           'call is then its forward score (requires a positive --skip)')
+common_parser.add_argument('--quality', default=None, action=FileAbsent,
+                           help='File to output per-read quality summary (tab separated)')
 common_parser.add_argument('--skip', default=0.0,
                            type=NonNegative(float), help='Skip penalty')
+common_parser.add_argument('--sparse', default=None, metavar='kmers', type=Maybe(Positive(int)),
+                           help='Kmers per block retained for sparse transducer decoding (None for exact Viterbi)')
 common_parser.add_argument('--trans', default=None, type=proportion, nargs=3,
                            metavar=('stay', 'step', 'skip'), help='Base transition probabilities')
 common_parser.add_argument('--transducer', default=True, action=AutoBool,
@@ -68,8 +83,12 @@ parser_raw = subparsers.add_parser('raw', parents=[common_parser], help='basecal
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser_raw.add_argument('--bad', default=True, action=AutoBool,
                         help='Model emits bad signal blocks as a separate state')
+parser_raw.add_argument('--mad_method', default='exact', choices=sorted(maths.MED_MAD_METHODS),
+                        help='Method for median and MAD of signal, fast uses a histogram')
 parser_raw.add_argument('--open_pore_fraction', metavar='proportion', default=0,
                         type=proportion, help='Max fraction of signal to trim due to open pore')
+parser_raw.add_argument('--open_pore_method', default='mad', choices=sorted(batch.TRIM_OPEN_PORE_LOCAL_VAR_METHODS),
+                        help='Local variation of signal used to locate open pore, range is cheapest')
 parser_raw.add_argument('--trim', default=(200, 10), nargs=2, type=NonNegative(int),
                         metavar=('beginning', 'end'), help='Number of samples to trim off start and end')
 parser_raw.set_defaults(datatype='samples')
@@ -83,26 +102,54 @@ if __name__ == '__main__':
     assert args.command in ["events", "raw"]
 
     basecall_worker = getattr(basecall, args.command + "_worker")
+    posterior_worker = getattr(basecall, args.command + "_posterior_worker")
     if args.command == "events":
-        kwarg_names = ['section', 'segmentation', 'trim', 'kmer_len', 'transducer', 'bad', 'min_prob', 'skip', 'trans', 'alphabet']
+        posterior_kwarg_names = ['section', 'segmentation', 'trim']
     else:
-        kwarg_names = ['trim', 'open_pore_fraction', 'kmer_len', 'transducer', 'bad', 'min_prob', 'skip', 'trans', 'alphabet']
-
-    compiled_file = helpers.compile_model(args.model, args.compile)
+        posterior_kwarg_names = ['trim', 'open_pore_fraction', 'open_pore_method', 'mad_method']
+    decode_kwarg_names = ['kmer_len', 'transducer', 'bad', 'min_prob', 'skip', 'trans', 'alphabet', 'beam', 'polish',
+                          'sparse', 'graph_decode']
+    posterior_kwargs = util.get_kwargs(args, posterior_kwarg_names)
+    decode_kwargs = util.get_kwargs(args, decode_kwarg_names)
+    decode_kwargs['quality'] = args.quality is not None
+
+    if args.polish is not None:
+        assert args.skip > 0.0, "Refining calls requires a positive skip penalty"
+
+    if args.graph_decode:
+        assert args.transducer, "Decoding within network requires a transducer"
+        assert args.beam is None and args.polish is None and args.sparse is None, \
+            "Decoding within network is exact Viterbi only"
+        graph_decode = {'k': args.kmer_len, 'nbase': len(args.alphabet), 'skip_pen': args.skip,
+                        'min_prob': args.min_prob}
+    else:
+        graph_decode = None
+    compiled_file = helpers.compile_model(args.model, args.compile, decode=graph_decode)
 
     seq_printer = basecall.SeqPrinter(args.kmer_len, datatype=args.datatype,
-                                      transducer=args.transducer, alphabet=args.alphabet.decode('ascii'))
+                                      transducer=args.transducer, alphabet=args.alphabet.decode('ascii'),
+                                      quality_fname=args.quality)
 
     files = fast5.iterate_fast5(args.input_folder, paths=True, limit=args.limit,
                                 strand_list=args.input_strand_list)
     nbases = nevents = 0
     t0 = time.time()
-    for res in imap_mp(basecall_worker, files, threads=args.jobs, fix_kwargs=util.get_kwargs(args, kwarg_names),
-                       unordered=True, init=basecall.init_worker, initargs=[compiled_file]):
+    if args.decode_threads is None:
+        results = imap_mp(basecall_worker, files, threads=args.jobs, fix_kwargs=dict(posterior_kwargs, **decode_kwargs),
+                          unordered=True, init=basecall.init_worker, initargs=[compiled_file])
+    else:
+        #  Each job calls a group of reads, decoding with threads as it goes
+        groups = (list(group) for group in grouper_it(files, 4 * args.decode_threads))
+        threaded_kwargs = {'posterior_worker': posterior_worker, 'posterior_kwargs': posterior_kwargs,
+                           'decode_kwargs': decode_kwargs, 'decode_threads': args.decode_threads}
+        results = chain.from_iterable(imap_mp(basecall.threaded_worker, groups, threads=args.jobs,
+                                              fix_kwargs=threaded_kwargs, unordered=True,
+                                              init=basecall.init_worker, initargs=[compiled_file]))
+    for res in results:
         if res is None:
             continue
-        read, score, call, nev = res
-        seq_len = seq_printer.write(read, score, call, nev)
+        read, score, call, nev, qual = res
+        seq_len = seq_printer.write(read, score, call, nev, quality=qual)
         nbases += seq_len
         nevents += nev
 
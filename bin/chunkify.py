@@ -10,7 +10,7 @@ import sloika.tools.chunkify_raw
 from sloika.tools.chunkify_raw import raw_chunkify_with_identity_main, raw_chunkify_with_remap_main
 from sloika.tools.chunkify_with_identity import chunkify_with_identity_main
 from sloika.tools.chunkify_with_remap import chunkify_with_remap_main
-from sloika import batch
+from sloika import batch, maths
 
 
 program_description = "Prepare data for model training and save to hdf5 file"
@@ -20,6 +20,8 @@ parser = argparse.ArgumentParser(description=program_description,
 common_parser = argparse.ArgumentParser(add_help=False)
 common_parser.add_argument('--alphabet', default=b"ACGT", action=ByteString,
                            help='Alphabet of the sequences')
+common_parser.add_argument('--deterministic', default=False, action=AutoBool,
+                           help='Write chunks in order of reads, independent of scheduling of jobs')
 common_parser.add_argument('--input_strand_list', default=None, action=FileExists,
                            help='Strand summary file containing subset')
 common_parser.add_argument('--jobs', default=1, metavar='n', type=Positive(int),
@@ -30,9 +32,11 @@ common_parser.add_argument('--limit', default=None, type=Maybe(Positive(int)),
                            help='Limit number of reads to process')
 common_parser.add_argument('--overwrite', default=False, action=AutoBool,
                            help='Whether to overwrite any output files')
+common_parser.add_argument('--shard_size', default=None, metavar='chunks', type=Maybe(Positive(int)),
+                           help='Write chunks to shards of this size, with output as manifest (None for single file)')
 common_parser.add_argument('input_folder', action=FileExists,
                            help='Directory containing single-read fast5 files')
-common_parser.add_argument('output', help='Output HDF5 file')
+common_parser.add_argument('output', help='Output HDF5 file, or manifest if sharded')
 
 
 common_raw_parser = argparse.ArgumentParser(add_help=False)
@@ -41,6 +45,8 @@ common_raw_parser.add_argument('--blanks_percentile', metavar='percentage', defa
                                help='Percentile above which to filter out chunks with too many blanks')
 common_raw_parser.add_argument('--chunk_len', default=2000, metavar='samples', type=Positive(int),
                                help='Length of each read chunk')
+common_raw_parser.add_argument('--mad_method', default='exact', choices=sorted(maths.MED_MAD_METHODS),
+                               help='Method for median and MAD of signal, fast uses a histogram')
 common_raw_parser.add_argument('--normalisation', default=sloika.tools.chunkify_raw.DEFAULT_NORMALISATION,
                                choices=sloika.tools.chunkify_raw.AVAILABLE_NORMALISATIONS,
                                help='Whether to perform median-mad normalisation and with what scope')
@@ -75,6 +81,9 @@ common_events_parser.add_argument('--section', default='template',
 
 
 common_remap_parser = argparse.ArgumentParser(add_help=False)
+common_remap_parser.add_argument('--anchor', default=None, metavar='width', type=Maybe(Positive(int)),
+                                 help='Positions either side of anchors to search when remapping '
+                                 '(None for all positions)')
 common_remap_parser.add_argument('--compile', default=None, type=Maybe(str),
                                  help='File output compiled model')
 common_remap_parser.add_argument('--min_prob', metavar='proportion', default=1e-5,
@@ -83,6 +92,12 @@ common_remap_parser.add_argument('--output_strand_list', default="strand_output_
                                  help='Strand summary output file')
 common_remap_parser.add_argument('--prior', nargs=2, metavar=('start', 'end'), default=(25.0, 25.0),
                                  type=Maybe(NonNegative(float)), help='Mean of start and end positions')
+common_remap_parser.add_argument('--remap_batch', default=1, metavar='reads', type=Positive(int),
+                                 help='Number of reads gathered when remapping, to be evaluated by network '
+                                 'in batches of similar length')
+common_remap_parser.add_argument('--remap_pad', default=0.0, metavar='proportion', type=proportion,
+                                 help='Maximum padding of a read batched with longer reads, as proportion of '
+                                 'its length (0 batches only reads of equal length, giving identical output)')
 common_remap_parser.add_argument('--slip', default=5.0, type=Maybe(NonNegative(float)),
                                  help='Slip penalty')
 common_remap_parser.add_argument('model', action=FileExists, help='Pickled model file')
@@ -98,6 +113,8 @@ subparsers.required = True
 parser_identity = subparsers.add_parser('identity', parents=[common_parser, common_events_parser],
                                         help='Create HDF file from reads as is',
                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser_identity.add_argument('--cache', default=None, metavar='file', type=Maybe(str),
+                             help='HDF5 file caching chunks of each read between runs')
 parser_identity.set_defaults(command_action=chunkify_with_identity_main)
 
 
@@ -112,6 +129,8 @@ parser_remap.set_defaults(command_action=chunkify_with_remap_main)
 parser_raw_identity = subparsers.add_parser('raw_identity', parents=[common_parser, common_raw_parser],
                                             help='Create HDF file from reads as is using raw data',
                                             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser_raw_identity.add_argument('--cache', default=None, metavar='file', type=Maybe(str),
+                                 help='HDF5 file caching chunks of each read between runs')
 parser_raw_identity.set_defaults(command_action=raw_chunkify_with_identity_main)
 
 
@@ -121,6 +140,9 @@ parser_raw_remap = subparsers.add_parser('raw_remap',
                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser_raw_remap.add_argument('--open_pore_fraction', metavar='proportion', default=0.0,
                               type=proportion, help='Max fraction of signal to trim due to open pore')
+parser_raw_remap.add_argument('--open_pore_method', default='mad',
+                              choices=sorted(batch.TRIM_OPEN_PORE_LOCAL_VAR_METHODS),
+                              help='Local variation of signal used to locate open pore, range is cheapest')
 parser_raw_remap.set_defaults(command_action=raw_chunkify_with_remap_main)
 
 
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import argparse
 import pickle
-import h5py
 import imp
 import logging
 import numpy as np
@@ -19,7 +18,7 @@ from sloika.cmdargs import (AutoBool, display_version_and_exit,
                                Positive, proportion)
 
 import sloika.module_tools as smt
-from sloika import updates
+from sloika import updates, util
 from sloika.variables import DEFAULT_ALPHABET
 from sloika.version import __version__
 
@@ -77,7 +76,7 @@ common_parser.add_argument('model', action=FileExists,
 
 common_parser.add_argument('output', help='Prefix for output files')
 common_parser.add_argument('input', action=FileExists,
-                           help='HDF5 file containing chunks')
+                           help='HDF5 file containing chunks, or manifest of shards')
 
 subparsers = parser.add_subparsers(help='command', dest='command')
 subparsers.required = True
@@ -197,14 +196,12 @@ if __name__ == '__main__':
     log.write(' '.join(sys.argv) + '\n')
 
     log.write('* Loading data from {}\n'.format(args.input))
-    with h5py.File(args.input, 'r') as h5:
-        all_chunks = h5['chunks'][:]
-        all_labels = h5['labels'][:]
-        all_bad = h5['bad'][:]
-        if args.reweight is not None:
-            all_weights = h5[args.reweight][:]
-        else:
-            all_weights = np.ones(len(all_chunks))
+    if args.reweight is not None:
+        all_chunks, all_labels, all_bad, all_weights = util.read_chunks(
+            args.input, ['chunks', 'labels', 'bad', args.reweight])
+    else:
+        all_chunks, all_labels, all_bad = util.read_chunks(args.input, ['chunks', 'labels', 'bad'])
+        all_weights = np.ones(len(all_chunks))
     all_weights = all_weights.astype('float64')
     all_weights /= np.sum(all_weights)
     max_batch_size = (all_weights > 0).sum()
@@ -253,16 +250,16 @@ if __name__ == '__main__':
     log.write('* Reading network from {}\n'.format(args.model))
     model_ext = os.path.splitext(args.model)[1]
     if model_ext == '.py':
-        with h5py.File(args.input, 'r') as h5:
-            klen = h5.attrs['kmer']
-            try:
-                alphabet = h5.attrs['alphabet']
-                log.write("* Using alphabet: {}\n".format(alphabet.decode('ascii')))
-            except:
-                alphabet = DEFAULT_ALPHABET
-                log.write("* Using default alphabet: {}\n".format(alphabet.decode('ascii')))
-                warnings.warn("Deprecated hdf5 input file: missing 'alphabet' attribute")
-            nbase = len(alphabet)
+        attrs = util.chunk_attributes(args.input)
+        klen = attrs['kmer']
+        try:
+            alphabet = attrs['alphabet']
+            log.write("* Using alphabet: {}\n".format(alphabet.decode('ascii')))
+        except:
+            alphabet = DEFAULT_ALPHABET
+            log.write("* Using default alphabet: {}\n".format(alphabet.decode('ascii')))
+            warnings.warn("Deprecated hdf5 input file: missing 'alphabet' attribute")
+        nbase = len(alphabet)
         netmodule = imp.load_source('netmodule', args.model)
 
         network = netmodule.network(klen=klen, sd=args.sd, nbase=nbase,
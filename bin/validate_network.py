@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import argparse
 import pickle
-import h5py
 import logging
 import numpy as np
 import sys
@@ -13,6 +12,7 @@ import theano.tensor as T
 from sloika.cmdargs import (AutoBool, display_version_and_exit, FileExists,
                                Positive)
 
+from sloika import util
 from sloika.version import __version__
 
 logging.getLogger("theano.gof.compilelock").setLevel(logging.WARNING)
@@ -32,7 +32,7 @@ parser.add_argument('--version', nargs=0, action=display_version_and_exit, metav
 parser.add_argument('model', action=FileExists,
                     help='File to read model description from')
 parser.add_argument('input', action=FileExists,
-                    help='HDF5 file containing chunks')
+                    help='HDF5 file containing chunks, or manifest of shards')
 
 
 def remove_blanks(labels):
@@ -63,10 +63,7 @@ if __name__ == '__main__':
     fv = wrap_network(network)
 
     sys.stdout.write('* Loading data from {}\n'.format(args.input))
-    with h5py.File(args.input, 'r') as h5:
-        full_chunks = h5['chunks'][:]
-        full_labels = h5['labels'][:]
-        full_bad = h5['bad'][:]
+    full_chunks, full_labels, full_bad = util.read_chunks(args.input, ['chunks', 'labels', 'bad'])
     if not args.transducer:
         remove_blanks(full_labels)
     if args.bad:
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import sys
+import time
+import tracemalloc
+
+from sloika import decode, olddecode, transducer
+from sloika.cmdargs import NonNegative, Positive, proportion
+
+
+BENCHMARKS = ['viterbi', 'decode_profile', 'map_to_sequence', 'map_to_sequence_slip', 'align']
+
+parser = argparse.ArgumentParser(
+    description='Time decoders on synthetic posteriors',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--align_length', default=200, metavar='events', type=Positive(int),
+                    help='Length of transducers for alignment (quadratic cost)')
+parser.add_argument('--benchmarks', default=None, nargs='+', choices=BENCHMARKS,
+                    help='Benchmarks to run (default all)')
+parser.add_argument('--kmer_len', default=[3, 5], nargs='+', metavar='length', type=Positive(int),
+                    help='Lengths of kmer')
+parser.add_argument('--lengths', default=[1000, 4000], nargs='+', metavar='events', type=Positive(int),
+                    help='Lengths of posteriors')
+parser.add_argument('--noise', default=0.3, metavar='proportion', type=proportion,
+                    help='Proportion of posterior of each block not on true state')
+parser.add_argument('--repeats', default=3, metavar='n', type=Positive(int),
+                    help='Number of times to repeat each timing, fastest is reported')
+parser.add_argument('--seed', default=None, metavar='integer', type=Positive(int),
+                    help='Set random number seed')
+parser.add_argument('--skip', default=0.05, metavar='proportion', type=proportion,
+                    help='Probability of skipping a kmer')
+parser.add_argument('--slip', default=5.0, metavar='penalty', type=NonNegative(float),
+                    help='Slip penalty for mapping with slips')
+parser.add_argument('--stay', default=0.3, metavar='proportion', type=proportion,
+                    help='Probability of staying in a kmer')
+
+
+def synthetic_path(nev, klen, stay, skip, nbase=4):
+    """ Path of kmers through blocks, as would be emitted for a random sequence
+
+    :param nev: number of blocks
+    :param klen: length of kmer
+    :param stay: probability of each block being a stay
+    :param skip: probability of each move being a skip
+
+    :returns: tuple of kmer of each block, whether each block is a stay, and
+        the kmers of the underlying sequence
+    """
+    is_stay = np.random.random_sample(nev) < stay
+    is_stay[0] = False
+    moves = np.where(np.random.random_sample(nev) < skip, 2, 1)
+    moves[is_stay] = 0
+    moves[0] = klen
+    nbases = np.sum(moves)
+    bases = np.random.randint(nbase, size=nbases)
+    seq_kmers = decode._bases_to_kmer_path(bases, klen, nbase=nbase)
+    kmers = seq_kmers[np.cumsum(moves) - klen]
+    return kmers, is_stay, seq_kmers
+
+
+def synthetic_posterior(kmers, is_stay, nstate, noise, stay_state=0):
+    """ Posterior peaked on the state of each block
+
+    :param kmers: kmer of each block
+    :param is_stay: whether each block is a stay
+    :param nstate: number of states, including any stay
+    :param noise: proportion of posterior spread over all states at random
+    :param stay_state: column of stay, kmers are in the remaining columns, or
+        None if there is no stay and the kmer is repeated instead
+
+    :returns: 2D :class:`ndarray` of posterior
+    """
+    nev = len(kmers)
+    post = noise * np.random.dirichlet(np.repeat(0.1, nstate), size=nev)
+    if stay_state is None:
+        state = kmers
+    else:
+        state = np.where(is_stay, stay_state, kmers + (kmers >= stay_state))
+    post[np.arange(nev), state] += 1.0 - noise
+    return post.astype(np.float32)
+
+
+def log_posterior(post, eta=1e-10):
+    """ Log of posterior sanitised as for decoding, see :func:`basecall.decode_post`
+
+    :param post: 2D :class:`ndarray` of posterior
+    :param eta: small constant for avoiding log(0)
+
+    :returns: 2D :class:`ndarray` of log posterior
+    """
+    return np.log(decode.prepare_post(post[:, None]) + eta)
+
+
+def measure(fn, repeats):
+    """ Time function, reporting fastest of repeats and peak memory allocated
+
+    :param fn: function of no arguments
+    :param repeats: number of times to run function
+
+    :returns: tuple of time in seconds and peak memory in bytes
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmarks(nev, klen, args):
+    """ Benchmarks for posterior of given size
+
+    :returns: list of tuples of name, number of events and function to time
+    """
+    kmers, is_stay, seq_kmers = synthetic_path(nev, klen, args.stay, args.skip)
+    nkmer = 4 ** klen
+    post = synthetic_posterior(kmers, is_stay, nkmer + 1, args.noise)
+    profile_post = synthetic_posterior(kmers, is_stay, nkmer, args.noise, stay_state=None)
+    lpost = log_posterior(post)
+    sequence = seq_kmers + 1
+
+    res = [('viterbi', nev, lambda: decode.viterbi(post, klen)),
+           ('decode_profile', nev, lambda: olddecode.decode_profile(profile_post)),
+           ('map_to_sequence', nev, lambda: transducer.map_to_sequence(lpost, sequence)),
+           ('map_to_sequence_slip', nev, lambda: transducer.map_to_sequence(lpost, sequence, slip=args.slip))]
+
+    #  Alignment is between base-level transducers, stay last
+    nalign = min(nev, args.align_length)
+    bases = kmers[:nalign] % 4
+    trans1 = log_posterior(synthetic_posterior(bases, is_stay[:nalign], 5, args.noise, stay_state=4))
+    trans2 = log_posterior(synthetic_posterior(bases, is_stay[:nalign], 5, args.noise, stay_state=4))
+    res.append(('align', nalign, lambda: transducer.align(trans1, trans2, -5.0, -5.0, -1.0, rev=False)))
+    return res
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    sys.stdout.write('benchmark\tkmer_len\tevents\tseconds\tevents_per_s\tpeak_mb\n')
+    for klen in args.kmer_len:
+        for nev in args.lengths:
+            for name, n, fn in benchmarks(nev, klen, args):
+                if args.benchmarks is not None and name not in args.benchmarks:
+                    continue
+                dt, peak = measure(fn, args.repeats)
+                line = '{}\t{}\t{}\t{:.4f}\t{:.1f}\t{:.1f}\n'.format(name, klen, n, dt, n / dt, peak / 1e6)
+                sys.stdout.write(line)
+                sys.stdout.flush()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import os
+import pickle
+import sys
+import time
+
+from sloika import batch, helpers
+from sloika.cmdargs import FileExists, NonNegative, Positive
+from sloika.iterators import grouper_it
+
+
+parser = argparse.ArgumentParser(
+    description='Time batched network evaluation for remapping on synthetic reads',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--batch', default=[1, 8, 32], nargs='+', metavar='reads', type=Positive(int),
+                    help='Numbers of reads gathered for evaluation, as --remap_batch of chunkify')
+parser.add_argument('--lengths', default=(4000, 12000), nargs=2, metavar=('min', 'max'), type=Positive(int),
+                    help='Range of lengths of reads')
+parser.add_argument('--nfeature', default=1, metavar='n', type=Positive(int),
+                    help='Number of features of input to network')
+parser.add_argument('--nread', default=64, metavar='reads', type=Positive(int),
+                    help='Number of reads')
+parser.add_argument('--pad', default=[0.0, 0.05, 0.2], nargs='+', metavar='proportion', type=NonNegative(float),
+                    help='Maximum padding of reads, as --remap_pad of chunkify')
+parser.add_argument('--repeats', default=2, metavar='n', type=Positive(int),
+                    help='Number of times to repeat each timing, fastest is reported')
+parser.add_argument('--seed', default=None, metavar='integer', type=Positive(int),
+                    help='Set random number seed')
+parser.add_argument('model', action=FileExists, help='Pickled model file')
+
+
+def measure(inMats, nbatch, pad, repeats):
+    """ Time evaluating network on inputs gathered in groups of `nbatch`
+
+    :returns: tuple of fastest time and posteriors
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.time()
+        posts = []
+        for group in grouper_it(inMats, nbatch):
+            posts += batch.calc_post_batch(list(group), max_pad=pad)
+        times.append(time.time() - t0)
+    return min(times), posts
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    compiled_file = helpers.compile_model(args.model)
+    from sloika.config import sloika_dtype
+    with open(compiled_file, 'rb') as fh:
+        batch.calc_post = pickle.load(fh)
+    os.remove(compiled_file)
+
+    ntime = np.random.randint(args.lengths[0], args.lengths[1] + 1, size=args.nread)
+    inMats = [np.random.normal(size=(n, 1, args.nfeature)).astype(sloika_dtype) for n in ntime]
+    nsample = np.sum(ntime)
+    _, expected = measure(inMats, 1, 0.0, 1)
+
+    sys.stdout.write('batch\tpad\tseconds\treads_per_s\tsamples_per_s\tmax_post_diff\n')
+    for nbatch in args.batch:
+        for pad in args.pad:
+            dt, posts = measure(inMats, nbatch, pad, args.repeats)
+            diff = max(np.amax(np.fabs(p - e)) for p, e in zip(posts, expected))
+            sys.stdout.write('{}\t{}\t{:.3f}\t{:.1f}\t{:.1f}\t{:.2e}\n'.format(
+                nbatch, pad, dt, args.nread / dt, nsample / dt, diff))
+            sys.stdout.flush()
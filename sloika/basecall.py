@@ -1,8 +1,8 @@
 import numpy as np
 import sys
 
-from sloika import bio, fast5
-from sloika.maths import mad
+from sloika import fast5
+from sloika.maths import med_mad
 
 from sloika import util
 from sloika.variables import nstate, DEFAULT_ALPHABET
@@ -22,7 +22,8 @@ def init_worker(model):
         calc_post = pickle.load(fh)
 
 
-def decode_post(post, kmer_len, transducer, bad, min_prob, skip=5.0, trans=None, nbase=4, eta=1e-10):
+def decode_post(post, kmer_len, transducer, bad, min_prob, skip=5.0, trans=None, nbase=4, eta=1e-10,
+                beam=None, polish=None, sparse=None, quality=False):
     """ Decode Viterbi state sequence from posterior matrix
 
     :param post: posterior matrix
@@ -35,23 +36,84 @@ def decode_post(post, kmer_len, transducer, bad, min_prob, skip=5.0, trans=None,
     :param skip: skip penalty for transducer model
     :param eta: small constant for avoiding log(0)
     :param nbase: number of distinct bases
+    :param beam: width of beam for transducer model or None for exact Viterbi
+    :param polish: (iterations, seconds) budget for refining the call of a
+        transducer model using forward scores, or None for no refinement.
+        Skips have probability exp(-skip), so skip should be positive, and
+        the score returned is the forward score of the refined call
+    :param sparse: number of most probable kmers to retain per block for sparse
+        Viterbi of transducer model, falling back to exact Viterbi if the
+        sparse call scores poorly, or None to always use exact Viterbi
+    :param quality: calculate summary of read quality, see `read_quality`
 
-    :returns: score, Viterbi path
+    :returns: score, Viterbi path, read quality or None.  The score is the
+        Viterbi score of the path, or its forward score if polished
     """
     from sloika import decode, olddecode
     assert post.shape[2] == nstate(kmer_len, transducer=transducer, bad_state=bad, nbase=nbase)
     post = decode.prepare_post(post, min_prob=min_prob, drop_bad=bad and not transducer)
-    if transducer:
-        score, call = decode.viterbi(post, kmer_len, skip_pen=skip, nbase=nbase)
+    lpost = np.log(eta + post) if transducer or quality else None
+    if transducer and beam is not None:
+        score, call = decode.beam_search(lpost, kmer_len, beam_width=beam, skip_pen=skip, log=True, nbase=nbase)
+    elif transducer and sparse is not None:
+        score, call = decode.sparse_decode(lpost, kmer_len, top=sparse, skip_pen=skip, log=True, nbase=nbase)
+    elif transducer:
+        score, call = decode.viterbi(lpost, kmer_len, skip_pen=skip, log=True, nbase=nbase)
     else:
         assert nbase == 4, "Modified bases not supported by old decoder"
         trans = olddecode.estimate_transitions(post, trans=trans)
         score, call = olddecode.decode_profile(post, trans=np.log(eta + trans), log=False)
-    return score, call
+    if transducer and polish is not None:
+        max_iter, max_time = polish
+        score, call, _ = decode.polish(post, call, kmer_len, nbase=nbase, skip_prob=np.exp(-skip),
+                                       max_iter=int(max_iter), max_time=max_time)
+    qual = read_quality(score, call, len(post), transducer, post=post, lpost=lpost) if quality else None
+    return score, call, qual
+
+
+QUALITY_FIELDS = ('score_per_block', 'mean_entropy', 'stay_fraction')
+
+
+def read_quality(score, call, nblock, transducer, post=None, lpost=None):
+    """ Summary of the quality of a read
+
+    :param score: score of call
+    :param call: Viterbi path, as returned by `decode_post`
+    :param nblock: number of blocks of posterior decoded
+    :param transducer: call is from transducer model, so contains only the
+        kmers entered rather than the state of every block
+    :param post: posterior matrix, as prepared for decoding, or None if not available
+    :param lpost: log of `post`
+
+    :returns: dictionary of `QUALITY_FIELDS`; mean entropy of posterior is
+        nan if the posterior is not available
+    """
+    if transducer:
+        stay_fraction = 1.0 - len(call) / nblock
+    else:
+        stay_fraction = np.mean(np.equal(call[1:], call[:-1])) if nblock > 1 else 0.0
+    if post is not None:
+        entropy = -np.einsum('ij,ij', post, lpost) / nblock
+    else:
+        entropy = np.nan
+    return {'score_per_block': score / nblock, 'mean_entropy': entropy, 'stay_fraction': stay_fraction}
+
+
+def decode_graph_output(out):
+    """ Score and call from the output of a network ending in a :class:`layers.Decode`
+
+    :param out: output of network for a single read
+
+    :returns: score, Viterbi path
+    """
+    out = np.squeeze(out, axis=1)
+    call = out[:, 0]
+    return out[-1, 1], call[call >= 0].astype(np.int)
 
 
 def events_worker(fast5_file_name, section, segmentation, trim, kmer_len, transducer,
-                  bad, min_prob, alphabet=DEFAULT_ALPHABET, skip=5.0, trans=None):
+                  bad, min_prob, alphabet=DEFAULT_ALPHABET, skip=5.0, trans=None, beam=None,
+                  polish=None, sparse=None, quality=False, graph_decode=False):
     """ Worker function for basecall_network.py for basecalling from events
 
     This worker used the global variable `calc_post` which is set by
@@ -61,9 +123,26 @@ def events_worker(fast5_file_name, section, segmentation, trim, kmer_len, transd
     :param section: part of read to basecall, 'template' or 'complement'
     :param segmentation: location of segmentation analysis for extracting target read section
     :param trim: (int, int) events to remove from read beginning and end
-    :param kmer_len, min_prob, transducer, bad, trans, skip: see `decode_post`
+    :param kmer_len, min_prob, transducer, bad, trans, skip, beam, polish, sparse, quality: see `decode_post`
+    :param graph_decode: see `decode_worker`
     :param fast5_file_name: filename for single-read fast5 file with event detection and segmentation
     """
+    res = events_posterior_worker(fast5_file_name, section, segmentation, trim)
+    return decode_worker(res, kmer_len, transducer, bad, min_prob, alphabet=alphabet, skip=skip,
+                         trans=trans, beam=beam, polish=polish, sparse=sparse, quality=quality,
+                         graph_decode=graph_decode)
+
+
+def events_posterior_worker(fast5_file_name, section, segmentation, trim):
+    """ Worker function for basecall_network.py for calculating posteriors from events
+
+    This worker used the global variable `calc_post` which is set by
+    init_worker.
+
+    :param section, segmentation, trim, fast5_file_name: see `events_worker`
+
+    :returns: tuple of read name, posterior matrix and number of events
+    """
     from sloika import features
     try:
         with fast5.Reader(fast5_file_name) as f5:
@@ -79,13 +158,12 @@ def events_worker(fast5_file_name, section, segmentation, trim, kmer_len, transd
         return None
 
     inMat = features.from_events(ev, tag='')[:, None, :]
-    score, call = decode_post(calc_post(inMat), kmer_len, transducer, bad, min_prob, skip, trans, nbase=len(alphabet))
-
-    return sn, score, call, inMat.shape[0]
+    return sn, calc_post(inMat), inMat.shape[0]
 
 
 def raw_worker(fast5_file_name, trim, open_pore_fraction, kmer_len, transducer, bad, min_prob,
-               alphabet=DEFAULT_ALPHABET, skip=5.0, trans=None):
+               alphabet=DEFAULT_ALPHABET, skip=5.0, trans=None, beam=None, polish=None,
+               sparse=None, quality=False, graph_decode=False, mad_method='exact', open_pore_method='mad'):
     """ Worker function for basecall_network.py for basecalling from raw data
 
     This worker used the global variable `calc_post` which is set by
@@ -95,29 +173,104 @@ def raw_worker(fast5_file_name, trim, open_pore_fraction, kmer_len, transducer,
     :param open_pore_fraction: maximum allowed fraction of signal length to
         trim due to classification as open pore signal
     :param trim: (int, int) events to remove from read beginning and end
-    :param kmer_len, min_prob, transducer, bad, trans, skip: see `decode_post`
+    :param kmer_len, min_prob, transducer, bad, trans, skip, beam, polish, sparse, quality: see `decode_post`
+    :param graph_decode: see `decode_worker`
+    :param mad_method: method of calculating median and MAD of signal, see :func:`maths.med_mad`
+    :param open_pore_method: method of calculating local variation of signal
+        to locate open pore, see :func:`batch.open_pore_bounds`
     :param fast5_file_name: filename for single-read fast5 file with raw data
     """
+    res = raw_posterior_worker(fast5_file_name, trim, open_pore_fraction, mad_method=mad_method,
+                               open_pore_method=open_pore_method)
+    return decode_worker(res, kmer_len, transducer, bad, min_prob, alphabet=alphabet, skip=skip,
+                         trans=trans, beam=beam, polish=polish, sparse=sparse, quality=quality,
+                         graph_decode=graph_decode)
+
+
+def raw_posterior_worker(fast5_file_name, trim, open_pore_fraction, mad_method='exact', open_pore_method='mad'):
+    """ Worker function for basecall_network.py for calculating posteriors from raw data
+
+    This worker used the global variable `calc_post` which is set by
+    init_worker.
+
+    :param trim, open_pore_fraction, mad_method, open_pore_method, fast5_file_name: see `raw_worker`
+
+    :returns: tuple of read name, posterior matrix and number of samples
+    """
     from sloika import batch, config
     try:
         with fast5.Reader(fast5_file_name) as f5:
-            signal = f5.get_read(raw=True)
+            #  Locate read on ADC values and only scale those within it
+            signal = f5.get_read(raw=True, scale=False)
+            start, end = batch.open_pore_bounds(signal, open_pore_fraction, var_method=open_pore_method,
+                                                mad_method=mad_method)
+            signal = f5.scale_raw(signal[start:end])
             sn = f5.filename_short
     except Exception as e:
         sys.stderr.write("Error getting raw data for file {}\n{!r}\n".format(fast5_file_name, e))
         return None
 
-    signal = batch.trim_open_pore(signal, open_pore_fraction)
     signal = util.trim_array(signal, *trim)
     if signal.size == 0:
         sys.stderr.write("Read too short in file {}\n".format(fast5_file_name))
         return None
 
-    inMat = (signal - np.median(signal)) / mad(signal)
+    signal_median, signal_mad = med_mad(signal, method=mad_method)
+    inMat = (signal - signal_median) / signal_mad
     inMat = inMat[:, None, None].astype(config.sloika_dtype)
-    score, call = decode_post(calc_post(inMat), kmer_len, transducer, bad, min_prob, skip, trans, nbase=len(alphabet))
+    return sn, calc_post(inMat), inMat.shape[0]
+
+
+def decode_worker(res, kmer_len, transducer, bad, min_prob, alphabet=DEFAULT_ALPHABET, skip=5.0,
+                  trans=None, beam=None, polish=None, sparse=None, quality=False, graph_decode=False):
+    """ Worker function for basecall_network.py for decoding posteriors
+
+    Decoding of transducer models with exact Viterbi releases the GIL, so
+    this function may be mapped over a pool of threads.
 
-    return sn, score, call, inMat.shape[0]
+    :param res: tuple of read name, posterior matrix and length of input, as
+        returned by `events_posterior_worker` or `raw_posterior_worker`, or None
+    :param kmer_len, min_prob, transducer, bad, trans, skip, beam, polish, sparse, quality: see `decode_post`
+    :param graph_decode: network has been compiled with a :class:`layers.Decode`
+        layer and so outputs calls rather than posteriors
+
+    :returns: tuple of read name, score, call, length of input and read
+        quality (None unless requested)
+    """
+    if res is None:
+        return None
+    sn, post, nev = res
+    if graph_decode:
+        score, call = decode_graph_output(post)
+        qual = read_quality(score, call, len(post), transducer) if quality else None
+    else:
+        score, call, qual = decode_post(post, kmer_len, transducer, bad, min_prob, skip, trans,
+                                        nbase=len(alphabet), beam=beam, polish=polish, sparse=sparse,
+                                        quality=quality)
+
+    return sn, score, call, nev, qual
+
+
+def threaded_worker(fast5_file_names, posterior_worker, posterior_kwargs, decode_kwargs, decode_threads):
+    """ Worker function for basecall_network.py overlapping network evaluation with decoding
+
+    Posteriors for each read are calculated in turn by the calling thread
+    while those already calculated are decoded by a pool of threads, so
+    posterior matrices never leave the worker process.
+
+    :param fast5_file_names: list of filenames for single-read fast5 files
+    :param posterior_worker: function to calculate posteriors from a single
+        file, `events_posterior_worker` or `raw_posterior_worker`
+    :param posterior_kwargs: dictionary of keyword arguments for `posterior_worker`
+    :param decode_kwargs: dictionary of keyword arguments for `decode_worker`
+    :param decode_threads: number of threads for decoding
+
+    :returns: list of results of `decode_worker`, in order of completion
+    """
+    from sloika.iterators import imap_threads
+    posteriors = (posterior_worker(fn, **posterior_kwargs) for fn in fast5_file_names)
+    return list(imap_threads(decode_worker, posteriors, fix_kwargs=decode_kwargs,
+                             threads=decode_threads, unordered=True))
 
 
 class SeqPrinter(object):
@@ -136,12 +289,22 @@ class SeqPrinter(object):
     :param transducer: if True then transitions from a kmer back to itself
         are not allowed when converting kmers to a sequence
     :param fname: name of output file or None to use sys.stdout
+    :param alphabet: letters of alphabet, as bytes or string
+    :param quality_fname: name of tab separated file for read quality, see
+        `read_quality`, or None for no output
     """
-    def __init__(self, kmer_len, datatype="events", transducer=False, fname=None, alphabet=DEFAULT_ALPHABET):
-        self.kmers = bio.all_kmers(kmer_len, alphabet=alphabet)
+    def __init__(self, kmer_len, datatype="events", transducer=False, fname=None, alphabet=DEFAULT_ALPHABET,
+                 quality_fname=None):
+        self.kmer_len = kmer_len
+        self.alphabet = alphabet if isinstance(alphabet, bytes) else alphabet.encode('ascii')
         self.transducer = transducer
         self.datatype = datatype
 
+        self.qual_fh = None
+        if quality_fname is not None:
+            self.qual_fh = open(quality_fname, 'w')
+            self.qual_fh.write('\t'.join(('read', datatype, 'bases') + QUALITY_FIELDS) + '\n')
+
         if fname is None:
             self.fh = sys.stdout
             self.close_fh = False
@@ -152,11 +315,17 @@ class SeqPrinter(object):
     def __del__(self):
         if self.close_fh:
             self.fh.close()
+        if self.qual_fh is not None:
+            self.qual_fh.close()
 
-    def write(self, read_name, score, call, nev):
-        kmer_path = [self.kmers[i] for i in call]
-        seq = bio.kmers_to_sequence(kmer_path, always_move=self.transducer)
+    def write(self, read_name, score, call, nev, quality=None):
+        from sloika import decode
+        seq = decode.kmer_path_to_sequence(call, self.kmer_len, self.alphabet,
+                                           always_move=self.transducer).decode('ascii')
         self.fh.write(">{} score {:.0f}, {} {} to {} bases\n".format(read_name, score,
                                                                      nev, self.datatype, len(seq)))
         self.fh.write(seq + '\n')
+        if self.qual_fh is not None and quality is not None:
+            fields = ['{:.4f}'.format(quality[f]) for f in QUALITY_FIELDS]
+            self.qual_fh.write('\t'.join([read_name, str(nev), str(len(seq))] + fields) + '\n')
         return len(seq)
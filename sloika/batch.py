@@ -12,7 +12,7 @@ import sloika.decode
 import sloika.util
 
 
-TRIM_OPEN_PORE_LOCAL_VAR_METHODS = frozenset(['mad', 'std'])
+TRIM_OPEN_PORE_LOCAL_VAR_METHODS = frozenset(['mad', 'range', 'std'])
 
 DEFAULT_NORMALISATION = 'per-read'
 
@@ -33,48 +33,31 @@ def chunkify(ev, chunk_len, kmer_len, use_scaled, normalisation):
     ub = ml * chunk_len
     tag = 'scaled_' if use_scaled else ''
 
+    assert normalisation in AVAILABLE_NORMALISATIONS
+    normalise = normalisation == 'per-read'
+
+    #
+    # we may pass bigger ev range to from_events() function than we would
+    # actually use later, so that features could be studentized using
+    # moments computed using this bigger range and the step delta of the
+    # last event of each chunk looks ahead; we reset the range in (*) and (**)
+    #
+    new_inMat = sloika.features.from_events(ev, tag=tag, normalise=normalise)
+    new_inMat = new_inMat[0 : ub].reshape((ml, chunk_len, -1))  # reset range (*)
     if normalisation == 'per-chunk':
-        new_inMat = []
-        for chunk_index in range(ml):
-            chunk_start = chunk_index * chunk_len
-            chunk_finish = chunk_start + chunk_len
-
-            # padding of 1 is needed for features to calculate step deltas
-            chunk_finish_maybe_with_padding = min(chunk_finish + 1, len(ev))
-
-            chunk_features = sloika.features.from_events(
-                ev[chunk_start : chunk_finish_maybe_with_padding], tag=tag, normalise=True)
-            new_inMat.append(chunk_features[:chunk_len])
-        new_inMat = np.concatenate(new_inMat)
-    else:
-        assert normalisation in ['none', 'per-read']
-        normalise = normalisation == 'per-read'
-
-        #
-        # we may pass bigger ev range to from_events() function than we would
-        # actually use later, so that features could be studentized using
-        # moments computed using this bigger range; we reset the range in (*) and (**)
-        #
-        new_inMat = sloika.features.from_events(ev, tag=tag, normalise=normalise)
-        new_inMat = new_inMat[0 : ub]  # reset range (*)
-
-    new_inMat = new_inMat.reshape((ml, chunk_len, -1))
+        new_inMat = np.ascontiguousarray(maths.studentise(new_inMat, axis=1), dtype=new_inMat.dtype)
+
     ev = ev[0 : ub]  # reset range (**)
 
     #
-    # 'model' in the name 'model_kmer_len' refers to the model that was used
-    # to map the reads read from fast5 file
+    # kmers in fast5 file are those of the model that was used to map the
+    # reads; use rightmost middle kmer of these
     #
-    model_kmer_len = len(ev['kmer'][0])
-    # Use rightmost middle kmer
-    kl = (model_kmer_len - kmer_len + 1) // 2
-    ku = kl + kmer_len
-    new_labels = 1 + np.array([kmer_to_state[k[kl : ku]] for k in ev['kmer']], dtype=np.int32)
+    new_labels = 1 + bio.kmer_array_to_states(ev['kmer'], kmer_len, alphabet=kmer_alphabet).astype(np.int32)
 
     new_labels = new_labels.reshape(ml, chunk_len)
-    change = ev['seq_pos'].reshape(ml, chunk_len)
-    change = np.apply_along_axis(np.ediff1d, 1, change, to_begin=1)
-    new_labels[change == 0] = 0
+    seq_pos = ev['seq_pos'].reshape(ml, chunk_len)
+    new_labels[:, 1:][seq_pos[:, 1:] == seq_pos[:, :-1]] = 0
 
     new_bad = np.logical_not(ev['good_emission'])
     new_bad = new_bad.reshape(ml, chunk_len)
@@ -103,7 +86,9 @@ def chunk_worker(fn, section, chunk_len, kmer_len, min_length, trim, use_scaled,
     (X, chunk_len, nfeatures) containing the features for the batch,
     a 2D :class:`ndarray` of size (X, chunk_len) containing the
     associated labels, and a 2D :class:`ndarray` of size (X, chunk_len)
-    indicating bad events.  1 <= X <= batch_size.
+    indicating bad events.  1 <= X <= batch_size.  X is zero if the read
+    is too short, see :func:`util.empty_chunks`, and None is returned if the
+    read could not be processed.
     """
     # Import within worker to avoid initialising GPU in main thread
     import sloika.features
@@ -118,14 +103,14 @@ def chunk_worker(fn, section, chunk_len, kmer_len, min_length, trim, use_scaled,
     ev = trim_ends_and_filter(ev, trim, min_length, chunk_len)
     if ev is None:
         sys.stderr.write('{} is too short.\n'.format(fn))
-        return None
+        return sloika.util.empty_chunks(chunk_len, sloika.features.NFEATURE)
 
     return chunkify(ev, chunk_len, kmer_len, use_scaled, normalisation)
 
 
 def init_chunk_identity_worker(kmer_len, alphabet):
-    global kmer_to_state
-    kmer_to_state = bio.kmer_mapping(kmer_len, alphabet=alphabet)
+    global kmer_alphabet
+    kmer_alphabet = alphabet
 
 
 def init_chunk_remap_worker(model, kmer_len, alphabet):
@@ -133,25 +118,105 @@ def init_chunk_remap_worker(model, kmer_len, alphabet):
     # Import within worker to avoid initialising GPU in main thread
     import sloika.features
     import sloika.transducer
-    global calc_post, kmer_to_state
-    kmer_to_state = bio.kmer_mapping(kmer_len, alphabet=alphabet)
+    global calc_post, kmer_alphabet
+    kmer_alphabet = alphabet
     with open(model, 'rb') as fh:
         calc_post = pickle.load(fh)
 
 
-def remap(read_ref, ev, min_prob, kmer_len, prior, slip):
-    inMat = sloika.features.from_events(ev, tag='')
-    inMat = np.expand_dims(inMat, axis=1)
-    post = sloika.decode.prepare_post(calc_post(inMat), min_prob=min_prob, drop_bad=False)
+#  Length of input used to find stride of network, divisible by all strides up to ten
+_STRIDE_PROBE_LEN = 2520
+
+
+def network_stride(nfeature, dtype):
+    """ Stride of network in global variable `calc_post`
+
+    Found by evaluating the network on an input of length divisible by any
+    stride up to ten, assuming the output of a network of stride `s` for an
+    input of length `n` has `ceil(n / s)` blocks, as for convolutions with
+    'same' padding.  The result is cached for the network.
+
+    :param nfeature: number of features of input
+    :param dtype: type of input
+
+    :returns: stride of network
+    """
+    global _network_stride
+    if _network_stride is None or _network_stride[0] is not calc_post:
+        nblock = len(calc_post(np.zeros((_STRIDE_PROBE_LEN, 1, nfeature), dtype=dtype)))
+        assert _STRIDE_PROBE_LEN % nblock == 0, "Could not determine stride of network"
+        _network_stride = (calc_post, _STRIDE_PROBE_LEN // nblock)
+    return _network_stride[1]
+
+
+#  Network and its stride, as found by network_stride
+_network_stride = None
+
+
+def calc_post_batch(inMats, max_pad=0.0):
+    """ Evaluate network on several inputs in batches of similar length
+
+    Inputs are sorted by length and grouped so that each is padded with zeros
+    at its end by no more than `max_pad` times its length to the length of
+    the longest in its group.  Each group is evaluated as a single batch and
+    the posterior of each input cropped to the blocks it would have alone.
+
+    With `max_pad` zero, only inputs of equal length are batched together and
+    the posterior of each is that of evaluating it alone.  Otherwise, a
+    network containing reversed layers sees the padding before the end of
+    each shorter input, so its posterior over roughly the last `max_pad`
+    proportion of that input may differ from evaluating the input alone.
+
+    :param inMats: list of 3D :class:`ndarray` of inputs, each of shape
+        (time, 1, features)
+    :param max_pad: maximum padding of an input, as a proportion of its length
+
+    :returns: list of 3D :class:`ndarray` of posteriors, one for each input
+    """
+    order = sorted(range(len(inMats)), key=lambda i: len(inMats[i]))
+    groups = []
+    for i in order:
+        if len(groups) > 0 and len(inMats[i]) <= len(inMats[groups[-1][0]]) * (1.0 + max_pad):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+
+    posts = [None] * len(inMats)
+    for idx in groups:
+        ntime = [len(inMats[i]) for i in idx]
+        max_time = max(ntime)
+        if min(ntime) < max_time:
+            stride = network_stride(inMats[idx[0]].shape[2], inMats[idx[0]].dtype)
+        batch_in = np.zeros((max_time, len(idx), inMats[idx[0]].shape[2]), dtype=inMats[idx[0]].dtype)
+        for j, i in enumerate(idx):
+            batch_in[:ntime[j], j] = inMats[i][:, 0]
+        post = calc_post(batch_in)
+        for j, i in enumerate(idx):
+            nblock = len(post) if ntime[j] == max_time else -(-ntime[j] // stride)
+            posts[i] = post[:nblock, j : j + 1]
+    return posts
+
+
+def remap_input(ev):
+    return np.expand_dims(sloika.features.from_events(ev, tag=''), axis=1)
+
+
+def remap(read_ref, ev, min_prob, kmer_len, prior, slip, anchor=None, post=None):
+    if post is None:
+        post = calc_post(remap_input(ev))
+    post = sloika.decode.prepare_post(post, min_prob=min_prob, drop_bad=False)
 
     kmers = np.array(bio.seq_to_kmers(read_ref, kmer_len))
-    seq = [kmer_to_state[k] + 1 for k in kmers]
+    seq = bio.seq_to_states(read_ref, kmer_len, alphabet=kmer_alphabet) + 1
     prior0 = None if prior[0] is None else sloika.util.geometric_prior(len(seq), prior[0])
     prior1 = None if prior[1] is None else sloika.util.geometric_prior(len(seq), prior[1], rev=True)
 
+    band = None if anchor is None else sloika.transducer.anchor_band(post, seq, anchor)
+
     score, path = sloika.transducer.map_to_sequence(post, seq, slip=slip,
                                                     prior_initial=prior0,
-                                                    prior_final=prior1, log=False)
+                                                    prior_final=prior1, log=False,
+                                                    band=band)
 
     ev = nprf.append_fields(ev, ['seq_pos', 'kmer', 'good_emission'],
                             [path, kmers[path], np.repeat(True, len(ev))])
@@ -159,8 +224,7 @@ def remap(read_ref, ev, min_prob, kmer_len, prior, slip):
     return (score, ev, path, seq)
 
 
-def chunk_remap_worker(fn, trim, min_prob, kmer_len, prior, slip, chunk_len, use_scaled,
-                       normalisation, min_length, section, segmentation, references):
+def _read_remap_events(fn, trim, chunk_len, min_length, section, segmentation, references):
     try:
         with fast5.Reader(fn) as f5:
             sn = f5.filename_short
@@ -183,37 +247,92 @@ def chunk_remap_worker(fn, trim, min_prob, kmer_len, prior, slip, chunk_len, use
         sys.stderr.write('{} is too short.\n'.format(fn))
         return None
 
-    (score, ev, path, seq) = remap(read_ref, ev, min_prob, kmer_len, prior, slip)
-    (chunks, labels, bad_ev) = chunkify(ev, chunk_len, kmer_len, use_scaled, normalisation)
+    return sn, ev, read_ref
+
+
+def chunk_remap_worker(fn, trim, min_prob, kmer_len, prior, slip, chunk_len, use_scaled,
+                       normalisation, min_length, section, segmentation, references, anchor=None):
+    return chunk_remap_batch_worker([fn], trim, min_prob, kmer_len, prior, slip, chunk_len, use_scaled,
+                                    normalisation, min_length, section, segmentation, references,
+                                    anchor=anchor)[0]
+
 
-    return sn + '.fast5', score, len(ev), path, seq, chunks, labels, bad_ev
+def chunk_remap_batch_worker(fns, trim, min_prob, kmer_len, prior, slip, chunk_len, use_scaled,
+                             normalisation, min_length, section, segmentation, references, anchor=None,
+                             remap_pad=0.0):
+    """ Remap several reads, evaluating the network on them in batches, see
+    :func:`calc_post_batch`
+
+    :param fns: list of filenames to read from
+    :param remap_pad: maximum padding of a read when batched, as a proportion of its length
+    Other parameters as for :func:`chunk_remap_worker`
+
+    :returns: list containing the result of :func:`chunk_remap_worker` for
+        each file
+    """
+    reads = [_read_remap_events(fn, trim, chunk_len, min_length, section, segmentation, references)
+             for fn in fns]
+    inMats = [remap_input(ev) for _, ev, _ in filter(None, reads)]
+    posts = iter(calc_post_batch(inMats, max_pad=remap_pad) if len(inMats) > 0 else [])
+
+    res = []
+    for read in reads:
+        if read is None:
+            res.append(None)
+            continue
+        sn, ev, read_ref = read
+        (score, ev, path, seq) = remap(read_ref, ev, min_prob, kmer_len, prior, slip, anchor=anchor,
+                                       post=next(posts))
+        (chunks, labels, bad_ev) = chunkify(ev, chunk_len, kmer_len, use_scaled, normalisation)
+        res.append((sn + '.fast5', score, len(ev), path, seq, chunks, labels, bad_ev))
+    return res
 
 
 # TODO: this is a hack, find a nicer way
-def trim_open_pore(signal, max_op_fraction=0.3, var_method='mad', window_size=100):
+def open_pore_bounds(signal, max_op_fraction=0.3, var_method='mad', window_size=100, mad_method='exact'):
     """Locate raw read in signal by thresholding local variance
 
+    The signal may be integer ADC values, which are not converted to floats
+    except where required by `var_method`.  The 'range' method, the range
+    of values within each window, is the cheapest.
+
     :param signal: raw data containing a read
     :param max_op_fraction: (float) Maximum expected fraction of signal that
         consists of open pore. Higher values will find smaller reads at the
         cost of slightly truncating longer reads.
-    :param var_method: ('std' | 'mad') method used to compute the local
-        variation. std: standard deviation, mad: Median Absolute Deviation
+    :param var_method: ('std' | 'mad' | 'range') method used to compute the
+        local variation. std: standard deviation, mad: Median Absolute
+        Deviation, range: difference between maximum and minimum
     :param window_size: size of patches used to estimate local variance
+    :param mad_method: method of calculating MAD, see :func:`maths.med_mad`
+
+    :returns: tuple of start and end of read in signal
     """
     assert var_method in TRIM_OPEN_PORE_LOCAL_VAR_METHODS, "var_method not understood: {}".format(var_method)
 
     ml = len(signal) // window_size
     ub = ml * window_size
+    sig_chunks = signal[:ub].reshape((ml, window_size))
 
     if var_method == 'std':
-        local_var = signal[:ub].reshape((ml, window_size)).std(1)
+        local_var = sig_chunks.std(1)
     if var_method == 'mad':
-        sig_chunks = signal[:ub].reshape((ml, window_size))
-        local_var = maths.mad(sig_chunks, axis=1)
+        local_var = maths.mad(sig_chunks, axis=1, method=mad_method)
+    if var_method == 'range':
+        #  Widen integers so difference cannot overflow
+        local_var = np.amax(sig_chunks, axis=1).astype(np.float64) - np.amin(sig_chunks, axis=1)
 
-    probably_read = (local_var > np.percentile(local_var, 100 * max_op_fraction))
-    ix = np.arange(local_var.shape[0])[probably_read]
-    start = ix.min() * window_size
-    end = (ix.max() + 1) * window_size
+    probably_read = np.flatnonzero(local_var > np.percentile(local_var, 100 * max_op_fraction))
+    start = probably_read[0] * window_size
+    end = (probably_read[-1] + 1) * window_size
+    return start, end
+
+
+def trim_open_pore(signal, max_op_fraction=0.3, var_method='mad', window_size=100, mad_method='exact'):
+    """Trim signal to raw read, see :func:`open_pore_bounds`
+
+    :returns: view of signal containing read
+    """
+    start, end = open_pore_bounds(signal, max_op_fraction=max_op_fraction, var_method=var_method,
+                                  window_size=window_size, mad_method=mad_method)
     return signal[start:end]
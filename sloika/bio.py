@@ -1,6 +1,8 @@
 """ Module containing collection of functions for operating on sequences
 represented as strings, and lists thereof.
 """
+import numpy as np
+
 from sloika.iterators import product, window
 
 # Base complements
@@ -36,6 +38,77 @@ def kmer_mapping(length, alphabet='ACGT'):
     return {k : i for i, k in enumerate(all_kmers(length, alphabet))}
 
 
+def _base_codes(alphabet):
+    if not isinstance(alphabet, bytes):
+        alphabet = alphabet.encode('ascii')
+    codes = np.full(256, -1, dtype=np.int)
+    codes[np.frombuffer(alphabet, dtype=np.uint8)] = np.arange(len(alphabet))
+    return codes
+
+
+def _as_bytes_array(x):
+    x = np.ascontiguousarray(x)
+    if x.dtype.kind == 'U':
+        x = x.astype('S{}'.format(x.dtype.itemsize // 4))
+    return x
+
+
+def kmer_array_to_states(kmers, length=None, alphabet='ACGT'):
+    """ Vectorised lookup of the states of an array of kmers
+
+    Equivalent to looking up each kmer in :func:`kmer_mapping` but using a
+    table of the letters of the alphabet and arithmetic on their indices.
+    Where the kmers of the array are longer than `length`, the rightmost
+    middle kmer of `length` is used.
+
+    :param kmers: :class:`ndarray` of fixed width strings, e.g. `S5`
+    :param length: length of kmer to determine state or None for all of kmer
+    :param alphabet: string from which characters are drawn
+
+    :returns: :class:`ndarray` of states, same shape as `kmers`
+    """
+    kmers = _as_bytes_array(kmers)
+    kmer_len = kmers.dtype.itemsize
+    if length is None:
+        length = kmer_len
+    assert length <= kmer_len, "Kmers of length {} too short for length {}".format(kmer_len, length)
+
+    offset = (kmer_len - length + 1) // 2
+    letters = kmers.view(np.uint8).reshape(kmers.shape + (kmer_len,))
+    codes = _base_codes(alphabet)[letters[..., offset : offset + length]]
+    assert np.all(codes >= 0), "Kmer contains letter not in alphabet"
+
+    states = np.zeros(kmers.shape, dtype=np.int)
+    for i in range(length):
+        states = states * len(alphabet) + codes[..., i]
+    return states
+
+
+def seq_to_states(seq, length, alphabet='ACGT'):
+    """ States of the overlapping kmers of a sequence
+
+    Equivalent to looking up each kmer of :func:`seq_to_kmers` in
+    :func:`kmer_mapping` but using arithmetic over sliding windows of the
+    indices of letters.
+
+    :param seq: character string
+    :param length: length of kmers
+    :param alphabet: string from which characters are drawn
+
+    :returns: 1D :class:`ndarray` of states
+    """
+    if not isinstance(seq, bytes):
+        seq = seq.encode('ascii')
+    codes = _base_codes(alphabet)[np.frombuffer(seq, dtype=np.uint8)]
+    assert np.all(codes >= 0), "Sequence contains letter not in alphabet"
+
+    nkmer = max(len(codes) - length + 1, 0)
+    states = np.zeros(nkmer, dtype=np.int)
+    for i in range(length):
+        states = states * len(alphabet) + codes[i : i + nkmer]
+    return states
+
+
 def all_multimers(length, alphabet='ACGT'):
     """  All possible multimers up to given length
 
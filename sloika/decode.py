@@ -1,5 +1,13 @@
 import numpy as np
+import time
 import sloika.variables as sv
+from sloika import viterbi_helpers
+from sloika.transitions import best_predecessor, kmer_transitions
+
+
+_MAX_TRACEBACK = 1 << 30
+_SPARSE_PRUNE = 20.0
+_SPARSE_MAX_GAP = 0.1
 
 
 def argmax(post, zero_is_blank=True):
@@ -36,63 +44,459 @@ def prepare_post(post, min_prob=1e-5, drop_bad=False):
     return min_prob + (1.0 - min_prob) * post
 
 
-def viterbi(post, klen, skip_pen=0.0, log=False, nbase=4):
+def _viterbi_step(pscore, lpost, trans, skip_pen):
+    """  Single iteration of forwards Viterbi for kmer transducer
+
+    :param pscore: A 1D :class:`ndarray` of scores for kmers at previous block
+    :param lpost: A 1D :class:`ndarray` of log posteriors for current block
+    :param trans: A :class:`KmerTransitions` for the kmers
+    :param skip_pen: Penalty for skips (in log-space)
+
+    :returns: A tuple containing scores for kmers at current block and
+        traceback, where negative entries indicate a stay
+    """
+    #  Kmers grouped by predecessors of skip, then by predecessors of step
+    shape = (-1, trans.nskip // trans.nstep, trans.nstep)
+    #  Step
+    score_step, from_step = best_predecessor(pscore, trans.step_from)
+    score_step = score_step.reshape(shape[:-1] + (1,))
+    from_step = from_step.reshape(shape[:-1] + (1,))
+    #  Skip
+    score_skip, from_skip = best_predecessor(pscore, trans.skip_from)
+    score_skip = score_skip.reshape((-1, 1, 1)) - skip_pen
+    from_skip = from_skip.reshape((-1, 1, 1))
+    #  Best score for step and skip
+    vscore = lpost[1:].reshape(shape) + np.maximum(score_step, score_skip)
+    traceback = np.where(score_step > score_skip, from_step, from_skip)
+    traceback = np.broadcast_to(traceback, vscore.shape).reshape(-1)
+    vscore = vscore.reshape(-1)
+
+    #  Stay -- set traceback to be negative
+    pscore = pscore.reshape(-1)
+    score_stay = pscore + lpost[0]
+    traceback = np.where(vscore > score_stay, traceback, -1)
+    vscore = np.maximum(vscore, score_stay)
+
+    return vscore, traceback
+
+
+def viterbi(post, klen, skip_pen=0.0, log=False, nbase=4, max_traceback=_MAX_TRACEBACK):
     """  Viterbi decoding of a kmer transducer
 
+    Traceback is held as one byte per kmer per block.  Where this would
+    exceed `max_traceback`, the posterior is decoded in segments: scores are
+    kept only at the start of each segment and the traceback of each segment
+    is recomputed from them on the way back, at the cost of a second
+    forwards pass.
+
     :param post: A 2d :class:`ndarray`
     :param klen: Length of kmer
+    :param skip_pen: Penalty for skips (in log-space)
     :param log: post array is in log space
+    :param nbase: Number of letters in alphabet
+    :param max_traceback: Maximum size of traceback held in memory, in bytes
 
-    :returns:
+    :returns: A tuple containing score of best path and list of kmer states
     """
     _ETA = 1e-10
     nev, nst = post.shape
     assert klen >= 3, "Kmer not long enough to apply Viterbi with skips"
     nkmer = sv.nkmer(klen, nbase=nbase)
     assert sv.nstate(klen, transducer=True, nbase=nbase) == nst
-    nstep = nbase
-    nskip = nbase ** 2
+    trans = kmer_transitions(klen, nbase=nbase)
+    seglen = max(1, max_traceback // nkmer)
 
     lpost = np.log(post + _ETA) if not log else post
-    vscore = lpost[0][1:].copy()
-    pscore = np.empty(nkmer)
-    traceback = np.empty((nev, nkmer), dtype=np.int16)
-    for i in range(1, nev):
-        #  Forwards Viterbi iteration
-        pscore, vscore = vscore, pscore
+    #  Forwards Viterbi iterations, compiled and releasing the GIL.  Scores at
+    #  start of each segment are retained
+    starts = list(range(0, nev, seglen))
+    init = [None]
+    for start in starts:
+        vscore, traceback = viterbi_helpers.viterbi_forward(lpost[start : start + seglen], trans.step_from,
+                                                            trans.skip_from, skip_pen, init=init[-1])
+        init.append(vscore)
+
+    state = np.argmax(vscore)
+    seq = [state]
+    for start, vinit in zip(starts[::-1], init[-2::-1]):
+        if start != starts[-1]:
+            _, traceback = viterbi_helpers.viterbi_forward(lpost[start : start + seglen], trans.step_from,
+                                                           trans.skip_from, skip_pen, init=vinit)
+        for i in range(len(traceback) - 1, 0 if start == 0 else -1, -1):
+            #  Viterbi traceback, see KmerTransitions.predecessor for moves
+            move = traceback[i, state]
+            if move > trans.nstep:
+                state = trans.skip_from[state // trans.nskip, move - 1 - trans.nstep]
+                seq.append(state)
+            elif move > 0:
+                state = trans.step_from[state // trans.nstep, move - 1]
+                seq.append(state)
 
-        #  Step
-        pscore = pscore.reshape(nstep, -1)
-        nrem = pscore.shape[1]
-        score_step = np.repeat(np.amax(pscore, axis=0), nstep)
-        from_step = np.repeat(nrem * np.argmax(pscore, axis=0) + list(range(nrem)), nstep)
-        #  Skip
-        pscore = pscore.reshape(nskip, -1)
-        nrem = pscore.shape[1]
-        score_skip = np.repeat(np.amax(pscore, axis=0), nskip) - skip_pen
-        from_skip = np.repeat(nrem * np.argmax(pscore, axis=0) + list(range(nrem)), nskip)
-        #  Best score for step and skip
-        vscore = lpost[i][1:] + np.maximum(score_step, score_skip)
-        traceback[i] = np.where(score_step > score_skip, from_step, from_skip)
-
-        #  Stay -- set traceback to be negative
-        pscore = pscore.reshape(-1)
-        score_stay = pscore + lpost[i][0]
-        traceback[i] = np.where(vscore > score_stay, traceback[i], -1)
-        vscore = np.maximum(vscore, score_stay)
-
-    stseq = np.empty(nev, dtype=np.int16)
-    seq = [np.argmax(vscore)]
-    for i in range(nev - 1, 0, -1):
-        #  Viterbi traceback
-        tstate = traceback[i][seq[-1]]
+    return np.amax(vscore), seq[::-1]
+
+
+class SparsePost(object):
+    """  Sparse posterior of a kmer transducer
+
+    Stay is retained for every block but only a subset of kmers, stored
+    block-after-block in compressed row form: the kmers of block `i` are
+    `state[offset[i]:offset[i + 1]]` with log posteriors `lpost` in the
+    same positions.  Every block should retain at least one kmer.
+
+    :param stay: A 1D :class:`ndarray` of log posterior of stay for each block
+    :param offset: A 1D :class:`ndarray` of start of each block, plus end
+    :param state: A 1D :class:`ndarray` of kmers retained
+    :param lpost: A 1D :class:`ndarray` of log posterior of kmers retained
+    :param nkmer: Number of kmers in dense posterior
+    """
+
+    def __init__(self, stay, offset, state, lpost, nkmer):
+        assert len(offset) == len(stay) + 1, "Offsets and blocks have different lengths"
+        assert len(state) == len(lpost) == offset[-1], "Kmers and posteriors have different lengths"
+        self.stay = stay
+        self.offset = offset
+        self.state = state
+        self.lpost = lpost
+        self.nkmer = nkmer
+
+    def __len__(self):
+        return len(self.stay)
+
+    @property
+    def nbytes(self):
+        return self.stay.nbytes + self.offset.nbytes + self.state.nbytes + self.lpost.nbytes
+
+    def upper_bound(self):
+        """  Upper bound on score of any path through posterior
+
+        :returns: Sum over blocks of best log posterior
+        """
+        best = np.maximum.reduceat(self.lpost, self.offset[:-1])
+        return np.sum(np.maximum(self.stay, best))
+
+
+def sparsify_post(post, top=None, mass=None, log=False):
+    """  Retain only the most probable kmers of each block of posterior
+
+    :param post: A 2D :class:`ndarray`, first column is stay
+    :param top: Retain at most this many kmers per block, or None for no limit
+    :param mass: Retain the fewest kmers whose combined posterior is at least
+        this proportion of the kmer posterior of the block, or None to retain all
+    :param log: post array is in log space
+
+    :returns: A :class:`SparsePost`
+    """
+    _ETA = 1e-10
+    assert top is None or top > 0, "Must retain at least one kmer per block"
+    assert mass is None or 0.0 < mass <= 1.0, "Mass should be a proportion"
+    nev, nst = post.shape
+    nkmer = nst - 1
+    #  Ranking of kmers is the same in log space
+    kpost = post[:, 1:]
+    rows = np.arange(nev).reshape((-1, 1))
+
+    #  Candidates in each block ordered by decreasing posterior
+    ntop = nkmer if top is None else min(top, nkmer)
+    if ntop < nkmer:
+        cand = viterbi_helpers.top_columns(kpost, ntop)
+    else:
+        cand = np.argsort(-kpost, axis=1, kind='mergesort')
+    cpost = kpost[rows, cand]
+
+    nkeep = np.repeat(ntop, nev)
+    if mass is not None:
+        cprob = np.cumsum(np.exp(cpost) if log else cpost, axis=1)
+        total = np.sum(np.exp(kpost) if log else kpost, axis=1, keepdims=True)
+        nkeep = np.minimum(np.sum(cprob < mass * total, axis=1) + 1, ntop)
+
+    keep = np.arange(ntop) < nkeep.reshape((-1, 1))
+    offset = np.concatenate([[0], np.cumsum(nkeep)]).astype(viterbi_helpers.ITYPE)
+    state = cand[keep].astype(viterbi_helpers.ITYPE)
+    stay = post[:, 0] if log else np.log(post[:, 0] + _ETA)
+    lpost = cpost[keep] if log else np.log(cpost[keep] + _ETA)
+    return SparsePost(np.ascontiguousarray(stay), offset, state, lpost, nkmer)
+
+
+def sparse_viterbi(spost, klen, skip_pen=0.0, nbase=4, prune=_SPARSE_PRUNE):
+    """  Viterbi decoding of a kmer transducer restricted to sparse posterior
+
+    Kmers may only be entered at blocks where they were retained in the
+    posterior, other than at the first block where kmers not retained are
+    scored as the least probable retained kmer.  With all kmers retained and no pruning, the result is the
+    same as :func:`viterbi`.
+
+    :param spost: A :class:`SparsePost`
+    :param klen: Length of kmer
+    :param skip_pen: Penalty for skips (in log-space)
+    :param nbase: Number of letters in alphabet
+    :param prune: Discard kmers this far below best score at each block
+        (in log-space), or None for no pruning
+
+    :returns: A tuple containing score of best path and list of kmer states,
+        or score of -inf and None if no path is possible
+    """
+    assert klen >= 3, "Kmer not long enough to apply Viterbi with skips"
+    assert sv.nkmer(klen, nbase=nbase) == spost.nkmer
+    prune = np.inf if prune is None else prune
+
+    states, vscore, traceback = viterbi_helpers.sparse_viterbi_forward(
+        spost.stay, spost.offset, spost.state, spost.lpost, nbase, spost.nkmer, skip_pen, prune)
+    if len(states) == 0:
+        return -np.inf, None
+
+    state = states[np.argmax(vscore)]
+    seq = [state]
+    for kmers, tstates in traceback[:0:-1]:
+        #  Traceback, active kmers of each block are unique
+        tstate = tstates[np.flatnonzero(kmers == state)[0]]
         if tstate >= 0:
             seq.append(tstate)
-        stseq[i - 1] = tstate
+            state = tstate
 
     return np.amax(vscore), seq[::-1]
 
 
+def sparse_decode(post, klen, top=None, mass=None, skip_pen=0.0, log=False, nbase=4,
+                  prune=_SPARSE_PRUNE, max_gap=_SPARSE_MAX_GAP):
+    """  Viterbi decoding of a sparsified posterior, falling back to full decoding
+
+    The score of the sparse path is compared to an upper bound on the score
+    of any path; if it falls short by more than `max_gap` per block, the
+    sparse candidates are deemed to have missed the call and the full
+    posterior is decoded with :func:`viterbi` instead.
+
+    :param post: A 2D :class:`ndarray`
+    :param klen: Length of kmer
+    :param top: Retain at most this many kmers per block
+    :param mass: Retain fewest kmers with at least this proportion of posterior
+    :param skip_pen: Penalty for skips (in log-space)
+    :param log: post array is in log space
+    :param nbase: Number of letters in alphabet
+    :param prune: Discard kmers this far below best score at each block
+    :param max_gap: Maximum shortfall of score per block before falling back,
+        or None to never fall back
+
+    :returns: A tuple containing score of best path and list of kmer states
+    """
+    spost = sparsify_post(post, top=top, mass=mass, log=log)
+    score, seq = sparse_viterbi(spost, klen, skip_pen=skip_pen, nbase=nbase, prune=prune)
+    if max_gap is not None and (spost.upper_bound() - score) > max_gap * len(spost):
+        return viterbi(post, klen, skip_pen=skip_pen, log=log, nbase=nbase)
+    return score, seq
+
+
+class ViterbiStream(object):
+    """  Streaming Viterbi decoding of a kmer transducer
+
+    Blocks of the posterior matrix are consumed as they become available.
+    Traceback is only held for blocks where the best paths ending in each
+    kmer have not yet merged; once they share a common ancestor, the call up
+    to that ancestor can no longer change and is emitted.  Memory is bounded
+    by the convergence window rather than the length of the read.
+
+    :param klen: Length of kmer
+    :param skip_pen: Penalty for skips (in log-space)
+    :param log: Blocks are in log space
+    :param nbase: Number of letters in alphabet
+    :param max_window: Maximum number of blocks of traceback to hold between
+        updates, or None for no limit.  If paths have not merged within the
+        window, the call along the currently best path is emitted and the
+        final call may then differ from that of :func:`viterbi`.
+    """
+
+    def __init__(self, klen, skip_pen=0.0, log=False, nbase=4, max_window=None):
+        assert klen >= 3, "Kmer not long enough to apply Viterbi with skips"
+        assert max_window is None or max_window > 0, "Window should be positive"
+        self.klen = klen
+        self.skip_pen = skip_pen
+        self.log = log
+        self.nbase = nbase
+        self.max_window = max_window
+        self.nkmer = sv.nkmer(klen, nbase=nbase)
+        self.nstate = sv.nstate(klen, transducer=True, nbase=nbase)
+        self.trans = kmer_transitions(klen, nbase=nbase)
+        self.tbtype = np.min_scalar_type(-self.nkmer)
+
+        self.vscore = None
+        #  Traceback for blocks after the last settled block
+        self.traceback = []
+        self.started = False
+
+    @property
+    def score(self):
+        return np.amax(self.vscore)
+
+    @property
+    def window(self):
+        return len(self.traceback)
+
+    def update(self, post):
+        """  Consume further blocks of posterior
+
+        :param post: A 2D :class:`ndarray` containing one or more blocks
+
+        :returns: A list of kmer states of the call that have been settled
+        """
+        _ETA = 1e-10
+        assert post.shape[1] == self.nstate
+        lpost = np.log(post + _ETA) if not self.log else post
+        for row in lpost:
+            if self.vscore is None:
+                self.vscore = row[1:].copy()
+            else:
+                self.vscore, tb = _viterbi_step(self.vscore, row, self.trans, self.skip_pen)
+                self.traceback.append(tb.astype(self.tbtype))
+
+        settled, state = self._converged()
+        if self.max_window is not None and self.window - settled > self.max_window:
+            #  Force settlement along currently best path
+            settled = self.window - self.max_window
+            state = self._trace(settled, np.argmax(self.vscore))
+        return self._emit(settled, state) if settled > 0 else []
+
+    def finish(self):
+        """  Settle remainder of call from the best final kmer
+
+        :returns: A list of kmer states
+        """
+        return self._emit(self.window, np.argmax(self.vscore))
+
+    def _trace(self, upto, state):
+        """  Trace state at last block back to given position in window
+        """
+        for i in range(self.window - 1, upto - 1, -1):
+            tstate = self.traceback[i][state]
+            state = tstate if tstate >= 0 else state
+        return state
+
+    def _converged(self):
+        """  Latest position in window at which paths from all kmers have
+        merged, and the kmer at that position
+        """
+        states = np.arange(self.nkmer)
+        for i in range(self.window - 1, -1, -1):
+            tstates = self.traceback[i][states]
+            states = np.unique(np.where(tstates >= 0, tstates, states))
+            if len(states) == 1:
+                return i, states[0]
+        return 0, None
+
+    def _emit(self, upto, state):
+        """  Emit call up to position in window, ending in given kmer
+        """
+        seq = []
+        for i in range(upto - 1, -1, -1):
+            tstate = self.traceback[i][state]
+            if tstate >= 0:
+                seq.append(state)
+                state = tstate
+        if not self.started:
+            seq.append(state)
+            self.started = True
+        self.traceback = self.traceback[upto:]
+        return seq[::-1]
+
+
+def beam_search(post, klen, beam_width=16, skip_pen=0.0, merge=False, log=False, nbase=4):
+    """  Beam search decoding of a kmer transducer
+
+    Hypotheses are kmer paths, stored as nodes of a prefix tree.  At each
+    block every hypothesis may stay, step or skip; only the best `beam_width`
+    hypotheses are retained so the cost per block is proportional to the
+    width of the beam rather than the number of kmers.
+
+    :param post: A 2d :class:`ndarray`
+    :param klen: Length of kmer
+    :param beam_width: Number of hypotheses to retain after each block
+    :param skip_pen: Penalty for skips (in log-space)
+    :param merge: Merge hypotheses with identical kmer paths by summing their
+        probabilities (prefix merging).  If False, the best alignment is kept.
+    :param log: post array is in log space
+    :param nbase: Number of letters in alphabet
+
+    :returns: A tuple containing score for best path and list of kmer states
+    """
+    _ETA = 1e-10
+    nev, nst = post.shape
+    assert klen >= 3, "Kmer not long enough to apply beam search with skips"
+    assert beam_width > 0, "Beam width should be positive"
+    nkmer = sv.nkmer(klen, nbase=nbase)
+    assert sv.nstate(klen, transducer=True, nbase=nbase) == nst
+    nstep = nbase
+    nskip = nbase ** 2
+
+    lpost = np.log(post + _ETA) if not log else post
+    combine = np.logaddexp if merge else np.maximum
+
+    #  Prefix tree of kmer paths.  A node is identified by the key
+    #  (parent_node + 1) * nkmer + state, with -1 being the root.
+    node_of_key = {}
+    node_parent = []
+    node_state = []
+
+    def add_nodes(keys):
+        nodes = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys.tolist()):
+            node = node_of_key.get(key)
+            if node is None:
+                node = len(node_state)
+                node_of_key[key] = node
+                node_parent.append(key // nkmer - 1)
+                node_state.append(key % nkmer)
+            nodes[i] = node
+        return nodes
+
+    #  Initial beam
+    nkeep = min(beam_width, nkmer)
+    hstate = np.argpartition(-lpost[0][1:], nkeep - 1)[:nkeep]
+    hscore = lpost[0][1:][hstate]
+    hnode = add_nodes(hstate.astype(np.int64))
+    hparent = np.repeat(-1, nkeep)
+
+    step_offset = np.arange(nstep)
+    skip_offset = np.arange(nskip)
+    for i in range(1, nev):
+        #  Stay -- key of existing node
+        stay_key = (hparent + 1) * nkmer + hstate
+        stay_score = hscore + lpost[i][0]
+        #  Step
+        step_state = ((hstate * nstep) % nkmer)[:, None] + step_offset
+        step_key = (hnode[:, None] + 1) * nkmer + step_state
+        step_score = hscore[:, None] + lpost[i][1:][step_state]
+        #  Skip
+        skip_state = ((hstate * nskip) % nkmer)[:, None] + skip_offset
+        skip_key = (hnode[:, None] + 1) * nkmer + skip_state
+        skip_score = hscore[:, None] + lpost[i][1:][skip_state] - skip_pen
+
+        keys = np.concatenate((stay_key, step_key.ravel(), skip_key.ravel()))
+        scores = np.concatenate((stay_score, step_score.ravel(), skip_score.ravel()))
+
+        #  Recombine hypotheses with identical kmer paths
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        starts = np.flatnonzero(np.ediff1d(keys, to_begin=1))
+        keys = keys[starts]
+        merged = combine.reduceat(scores[order], starts)
+
+        #  Prune to beam
+        nkeep = min(beam_width, len(keys))
+        best = np.argpartition(-merged, nkeep - 1)[:nkeep]
+        hscore = merged[best]
+        hstate = keys[best] % nkmer
+        hparent = keys[best] // nkmer - 1
+        hnode = add_nodes(keys[best])
+
+    #  Traceback through prefix tree
+    ibest = np.argmax(hscore)
+    node = hnode[ibest]
+    seq = []
+    while node >= 0:
+        seq.append(node_state[node])
+        node = node_parent[node]
+
+    return hscore[ibest], seq[::-1]
+
+
 def score(post, seq, full=False):
     """  Compute score of a sequence
 
@@ -153,9 +557,11 @@ def forwards_transpose(post, seq, skip_prob=0.0):
     :returns: score
     """
     nev, nstate = post.shape
+    stay = np.ascontiguousarray(post[:, -1], dtype=np.float64)
+    post_t = np.ascontiguousarray(post.T, dtype=np.float64)
 
     fprev = np.zeros(nev + 1)
-    fwd = np.concatenate(([1.0], np.cumprod(post[:, -1])))
+    fwd = np.concatenate(([1.0], np.cumprod(stay)))
     m = np.sum(fwd)
     fwd /= m
     score = np.log(m)
@@ -165,9 +571,8 @@ def forwards_transpose(post, seq, skip_prob=0.0):
 
         # Iteration through sequence
         fwd = fprev * skip_prob
-        fwd[1:] += fprev[:-1] * post[:, s]
-        for i in range(nev):
-            fwd[i + 1] += fwd[i] * post[i, -1]
+        fwd[1:] += fprev[:-1] * post_t[s]
+        viterbi_helpers.forward_scan(fwd, stay)
 
         m = np.sum(fwd)
         fwd /= m
@@ -190,9 +595,11 @@ def backwards_transpose(post, seq, skip_prob=0.0):
     :returns: score
     """
     nev, nstate = post.shape
+    stay = np.ascontiguousarray(post[:, -1], dtype=np.float64)
+    post_t = np.ascontiguousarray(post.T, dtype=np.float64)
 
     bnext = np.zeros(nev + 1)
-    bwd = np.concatenate(([1.0], np.cumprod(post[::-1, -1])))[::-1]
+    bwd = np.concatenate(([1.0], np.cumprod(stay[::-1])))[::-1]
     m = np.sum(bwd)
     bwd /= m
     score = np.log(m)
@@ -201,11 +608,239 @@ def backwards_transpose(post, seq, skip_prob=0.0):
         bwd, bnext = bnext, bwd
 
         bwd = bnext * skip_prob
-        bwd[:-1] += bnext[1:] * post[:, s]
-        for i in range(nev, 0, -1):
-            bwd[i - 1] += bwd[i] * post[i - 1, -1]
+        bwd[:-1] += bnext[1:] * post_t[s]
+        viterbi_helpers.backward_scan(bwd, stay)
 
         m = np.sum(bwd)
         bwd /= m
         score += np.log(m)
     return score + np.log(bwd[0])
+
+
+def kmer_path_to_bases(path, klen, nbase=4, always_move=True):
+    """  Convert a path of kmer states into a sequence of bases
+
+    The move between successive kmers is the smallest non-zero shift for
+    which they overlap, as for :func:`bio.kmers_to_sequence`, and is found
+    by integer arithmetic on the kmer states rather than comparing strings.
+
+    :param path: A 1D :class:`ndarray` or list of kmer states
+    :param klen: Length of kmer
+    :param nbase: Number of letters in alphabet
+    :param always_move: Successive identical kmers are a move rather than a stay
+
+    :returns: A 1D :class:`ndarray` of bases, encoded as integers
+    """
+    path = np.asarray(path, dtype=np.int64)
+    if len(path) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    moves = np.repeat(klen, len(path) - 1)
+    for move in range(klen - 1, 0, -1):
+        overlap = path[:-1] % nbase ** (klen - move) == path[1:] // nbase ** move
+        moves[overlap] = move
+    if not always_move:
+        moves[path[:-1] == path[1:]] = 0
+
+    digits = (path[:, None] // nbase ** np.arange(klen - 1, -1, -1)) % nbase
+    is_new = np.arange(klen) >= klen - moves[:, None]
+    return np.concatenate((digits[0], digits[1:][is_new]))
+
+
+def kmer_path_to_sequence(path, klen, alphabet=sv.DEFAULT_ALPHABET, always_move=True):
+    """  Convert a path of kmer states into a sequence
+
+    :param path: A 1D :class:`ndarray` or list of kmer states
+    :param klen: Length of kmer
+    :param alphabet: Letters of alphabet, as bytes
+    :param always_move: see :func:`kmer_path_to_bases`
+
+    :returns: Sequence as bytes
+    """
+    letters = np.frombuffer(alphabet, dtype=np.uint8)
+    bases = kmer_path_to_bases(path, klen, nbase=len(letters), always_move=always_move)
+    return letters[bases].tobytes()
+
+
+def _bases_to_kmer_path(bases, klen, nbase=4):
+    """  Kmer states for all overlapping kmers of a sequence of bases
+    """
+    nk = max(0, len(bases) - klen + 1)
+    path = np.zeros(nk, dtype=np.int64)
+    for i in range(klen):
+        path = path * nbase + bases[i : i + nk]
+    return path
+
+
+def _transpose_step(fprev, emit, stay, skip_prob):
+    """  Single step of transposed forwards recursion, returning normalised
+    vector and log of normalising constant
+    """
+    fwd = fprev * skip_prob
+    fwd[1:] += fprev[:-1] * emit
+    viterbi_helpers.forward_scan(fwd, stay)
+    m = np.sum(fwd)
+    fwd /= m
+    return fwd, np.log(m)
+
+
+def _transpose_matrices(post_t, cols, stay, skip_prob):
+    """  Forwards and (pre-scan) backwards matrices through sequence
+
+    Row m of the forward matrix is the probability of the first m symbols
+    having been emitted by each block, row m of the backward matrix the
+    probability of the remaining blocks emitting symbols m onwards starting
+    with an emission of symbol m.  Rows are normalised and their log-scales
+    returned separately.
+    """
+    nsym = len(cols)
+    nev = len(stay)
+
+    fwd = np.empty((nsym + 1, nev + 1))
+    fscale = np.zeros(nsym + 1)
+    fwd[0, 0] = 1.0
+    fwd[0, 1:] = np.cumprod(stay)
+    m = np.sum(fwd[0])
+    fwd[0] /= m
+    fscale[0] = np.log(m)
+    for i, c in enumerate(cols):
+        fwd[i + 1], m = _transpose_step(fwd[i], post_t[c], stay, skip_prob)
+        fscale[i + 1] = fscale[i] + m
+
+    bwd = np.zeros((nsym + 1, nev + 1))
+    bscale = np.zeros(nsym + 1)
+    bwd[nsym, nev] = 1.0
+    bnext = viterbi_helpers.backward_scan(bwd[nsym].copy(), stay)
+    m = np.sum(bnext)
+    bnext /= m
+    snext = np.log(m)
+    for i in range(nsym - 1, -1, -1):
+        b = bnext * skip_prob
+        b[:-1] += bnext[1:] * post_t[cols[i]]
+        m = np.sum(b)
+        bwd[i] = b / m
+        bscale[i] = snext + np.log(m)
+
+        bnext = viterbi_helpers.backward_scan(bwd[i].copy(), stay)
+        m = np.sum(bnext)
+        bnext /= m
+        snext = bscale[i] + np.log(m)
+
+    return fwd, fscale, bwd, bscale
+
+
+def polish(post, path, klen, nbase=4, skip_prob=0.0, max_iter=5, max_time=None):
+    """  Iteratively refine a call using transducer forward scores
+
+    Starting from a path of kmer states, e.g. from :func:`viterbi`, single
+    base substitutions, insertions and deletions are scored against the
+    forward and backward matrices computed through the sequence.  Only the
+    kmers overlapping an edit are recalculated so each candidate costs
+    O(klen x nev).  Improving edits that do not interact are accepted
+    together, falling back to the single best edit if the combination does
+    not improve the score.
+
+    :param post: A 2D :class:`ndarray` as returned by :func:`prepare_post`
+    :param path: A list of kmer states to start from
+    :param klen: Length of kmer
+    :param nbase: Number of letters in alphabet
+    :param skip_prob: Probability of skip
+    :param max_iter: Maximum number of rounds of refinement
+    :param max_time: Maximum wall time in seconds (None for no limit).  The
+        round in progress when the limit is reached is cut short.
+
+    :returns: A tuple containing forward score of the refined sequence, list
+        of kmer states and number of rounds of refinement performed
+    """
+    t0 = time.time()
+    nev, nst = post.shape
+    assert sv.nstate(klen, transducer=True, nbase=nbase) == nst
+    stay = np.ascontiguousarray(post[:, 0], dtype=np.float64)
+    post_t = np.ascontiguousarray(post.T, dtype=np.float64)
+
+    def out_of_time():
+        return max_time is not None and time.time() - t0 > max_time
+
+    bases = kmer_path_to_bases(path, klen, nbase=nbase)
+    cols = 1 + _bases_to_kmer_path(bases, klen, nbase=nbase)
+    fwd, fscale, bwd, bscale = _transpose_matrices(post_t, cols, stay, skip_prob)
+    score = np.log(fwd[-1, -1]) + fscale[-1]
+
+    niter = 0
+    while niter < max_iter and not out_of_time() and len(bases) >= klen:
+        niter += 1
+        nbases = len(bases)
+        nsym = len(cols)
+        edits = []
+        for pos in range(nbases + 1):
+            if out_of_time():
+                break
+            #  Symbols [lb, ub) contain base, or are adjacent to insertion
+            lb = max(0, pos - klen + 1)
+            ub = min(pos + 1, nsym)
+            window = bases[lb : ub + klen - 1]
+            wpos = pos - lb
+
+            candidates = []
+            if pos < nbases:
+                candidates.append((pos, 'del', None, np.delete(window, wpos)))
+                for b in range(nbase):
+                    if b != bases[pos]:
+                        new_window = window.copy()
+                        new_window[wpos] = b
+                        candidates.append((pos, 'sub', b, new_window))
+            for b in range(nbase):
+                if pos > 0 and bases[pos - 1] == b:
+                    #  Equivalent to insertion at previous position
+                    continue
+                candidates.append((pos, 'ins', b, np.insert(window, wpos, b)))
+
+            for pos, kind, b, new_window in candidates:
+                f = fwd[lb]
+                fs = fscale[lb]
+                for c in 1 + _bases_to_kmer_path(new_window, klen, nbase=nbase):
+                    f, m = _transpose_step(f, post_t[c], stay, skip_prob)
+                    fs += m
+                new_score = np.log(np.dot(f, bwd[ub])) + fs + bscale[ub]
+                if new_score > score:
+                    edits.append((new_score, pos, kind, b))
+
+        if len(edits) == 0:
+            break
+
+        #  Accept best edits separated by more than a kmer
+        edits.sort(key=lambda x: x[0], reverse=True)
+        accepted = []
+        for edit in edits:
+            if all(abs(edit[1] - other[1]) > klen for other in accepted):
+                accepted.append(edit)
+
+        new_bases = _apply_edits(bases, accepted)
+        new_cols = 1 + _bases_to_kmer_path(new_bases, klen, nbase=nbase)
+        new_fwd, new_fscale, new_bwd, new_bscale = _transpose_matrices(post_t, new_cols, stay, skip_prob)
+        new_score = np.log(new_fwd[-1, -1]) + new_fscale[-1]
+        if len(accepted) > 1 and new_score < edits[0][0]:
+            #  Edits interfere -- fall back to best single edit
+            new_bases = _apply_edits(bases, edits[:1])
+            new_cols = 1 + _bases_to_kmer_path(new_bases, klen, nbase=nbase)
+            new_fwd, new_fscale, new_bwd, new_bscale = _transpose_matrices(post_t, new_cols, stay, skip_prob)
+            new_score = np.log(new_fwd[-1, -1]) + new_fscale[-1]
+
+        bases, cols, score = new_bases, new_cols, new_score
+        fwd, fscale, bwd, bscale = new_fwd, new_fscale, new_bwd, new_bscale
+
+    return score, list(cols - 1), niter
+
+
+def _apply_edits(bases, edits):
+    """  Apply a list of (score, position, kind, base) edits to a sequence
+    """
+    bases = bases.copy()
+    for _, pos, kind, b in sorted(edits, key=lambda x: x[1], reverse=True):
+        if kind == 'sub':
+            bases[pos] = b
+        elif kind == 'del':
+            bases = np.delete(bases, pos)
+        else:
+            bases = np.insert(bases, pos, b)
+    return bases
@@ -139,10 +139,11 @@ class Reader(h5py.File):
     ###
     # Extracting read event data
 
-    def get_reads(self, group=False, raw=False, read_numbers=None):
+    def get_reads(self, group=False, raw=False, read_numbers=None, scale=True):
         """Iterator across event data for all reads in file
 
         :param group: return hdf group rather than event data
+        :param scale: scale raw data to pA (rather than ADC values)
         """
         if not raw:
             event_group = self.get_analysis_latest(__event_detect_name__)
@@ -152,7 +153,7 @@ class Reader(h5py.File):
             try:
                 reads = self[__raw_path__]
             except:
-                yield self.get_raw()[0]
+                yield self.get_raw(scale=scale)[0]
 
         if read_numbers is None:
             it = list(reads.keys())
@@ -171,17 +172,18 @@ class Reader(h5py.File):
                 if not raw:
                     yield self._get_read_data(reads[read])
                 else:
-                    yield self._get_read_data_raw(reads[read])
+                    yield self._get_read_data_raw(reads[read], scale=scale)
 
-    def get_read(self, group=False, raw=False, read_number=None):
+    def get_read(self, group=False, raw=False, read_number=None, scale=True):
         """Like get_reads, but only the first read in the file
 
         :param group: return hdf group rather than event/raw data
+        :param scale: scale raw data to pA (rather than ADC values)
         """
         if read_number is None:
-            return next(self.get_reads(group, raw))
+            return next(self.get_reads(group, raw, scale=scale))
         else:
-            return next(self.get_reads(group, raw, read_numbers=[read_number]))
+            return next(self.get_reads(group, raw, read_numbers=[read_number], scale=scale))
 
     def _get_read_data(self, read, indices=None):
         """Private accessor to read event data"""
@@ -223,27 +225,44 @@ class Reader(h5py.File):
     def _get_read_data_raw(self, read, indices=None, scale=True):
         """Private accessor to read raw data"""
         raw = read['Signal']
-        dtype = float if scale else int
 
         data = None
-        with raw.astype(dtype):
-            if indices is None:
-                data = raw[()]
-            else:
-                try:
-                    data = raw[indices[0]:indices[1]]
-                except:
-                    raise ValueError(
-                        'Cannot retrieve events using {} as indices'.format(indices)
-                    )
+        if indices is None:
+            data = raw[()]
+        else:
+            try:
+                data = raw[indices[0]:indices[1]]
+            except:
+                raise ValueError(
+                    'Cannot retrieve events using {} as indices'.format(indices)
+                )
 
-        # Scale data to pA
         if scale:
-            meta = self.channel_meta
-            raw_unit = meta['range'] / meta['digitisation']
-            data = (data + meta['offset']) * raw_unit
+            data = self.scale_raw(data)
         return data
 
+    def scale_raw(self, data):
+        """Scale raw ADC values to pA
+
+        Scaling is from the same metadata as .get_read(raw=True), that of the
+        channel for MinKnow conformant files or of the raw data for previous
+        Tang files.
+
+        :param data: :class:`ndarray` of ADC values, as returned by
+            .get_read(raw=True, scale=False)
+
+        :returns: :class:`ndarray` of floats
+        """
+        if __raw_path__ in self:
+            meta = self.channel_meta
+        else:
+            try:
+                meta = self[__raw_meta_path_old__].attrs
+            except KeyError:
+                raise KeyError('No raw data available.')
+        raw_unit = meta['range'] / meta['digitisation']
+        return (data + meta['offset']) * raw_unit
+
     def get_read_stats(self):
         """Combines stats based on events with output of .summary, assumes a
         one read file.
@@ -3,6 +3,10 @@ from sloika.config import sloika_dtype
 from sloika.maths import studentise
 
 
+#  Number of features of each event
+NFEATURE = 4
+
+
 def from_events(ev, tag='scaled_', normalise=True, nanonet=False):
     """  Create a matrix of features from
 
@@ -14,7 +18,7 @@ def from_events(ev, tag='scaled_', normalise=True, nanonet=False):
     :returns: A :class:`ndarray` with studentised features
     """
     nev = len(ev)
-    features = np.zeros((nev, 4), dtype=sloika_dtype)
+    features = np.zeros((nev, NFEATURE), dtype=sloika_dtype)
     features[:, 0] = ev[tag + 'mean']
     features[:, 1] = ev[tag + 'stdv']
     features[:, 2] = ev['length']
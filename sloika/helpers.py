@@ -7,7 +7,11 @@ import tempfile
 import warnings
 
 
-def _compile_model(outqueue, model_file, output_file=None):
+#  Exit code of compilation process where decoding is requested for a compiled network
+_DECODE_COMPILED_EXIT = 2
+
+
+def _compile_model(outqueue, model_file, output_file=None, decode=None):
     """  Compile network if necessary
 
     Where the network is already compiled, a temporary copy
@@ -16,6 +20,8 @@ def _compile_model(outqueue, model_file, output_file=None):
     :param outqueue: Queue to output filename
     :param model_file: File to read network from
     :param output_file: File to output to.  If None, generate a filename
+    :param decode: Dictionary of arguments for a :class:`layers.Decode` to
+        append to the network, or None to output posteriors
 
     :returns: places name of a file containined compiled model into queue
     """
@@ -39,11 +45,17 @@ def _compile_model(outqueue, model_file, output_file=None):
             warnings.warn("Support for python 2 pickles will be dropped: {}".format(model_file))
     if isinstance(network, layers.Layer):
         #  File contains network to compile
+        if decode is not None:
+            network = layers.Serial([network, layers.Decode(**decode)])
         with open(output_file, 'wb') as fh:
             compiled_network = network.compile()
             pickle.dump(compiled_network, fh, protocol=pickle.HIGHEST_PROTOCOL)
     elif isinstance(network, theano.compile.function_module.Function):
         #  Network is already compiled - make temporary copy
+        if decode is not None:
+            sys.stderr.write("Decoding within network requires an uncompiled model, "
+                             "but {} is already compiled\n".format(model_file))
+            sys.exit(_DECODE_COMPILED_EXIT)
         shutil.copy(model_file, output_file)
     else:
         sys.exit(1)
@@ -51,7 +63,7 @@ def _compile_model(outqueue, model_file, output_file=None):
     outqueue.put(output_file)
 
 
-def compile_model(model_file, output_file=None):
+def compile_model(model_file, output_file=None, decode=None):
     """  Compile network in separate thread
 
     To avoid initialising Theano in main thread, compilation must be done in a
@@ -63,14 +75,20 @@ def compile_model(model_file, output_file=None):
 
     :param model_file: File to read network from
     :param output_file: File to output to.  If None, generate a filename
+    :param decode: Dictionary of arguments for a :class:`layers.Decode` to
+        append to the network, so the compiled network outputs calls rather
+        than posteriors.  Only possible for networks that are not compiled.
 
     :returns: A filename containing a compiled network.
     """
     queue = SimpleQueue()
-    p = Process(target=_compile_model, args=(queue, model_file, output_file))
+    p = Process(target=_compile_model, args=(queue, model_file, output_file, decode))
     p.start()
     p.join()
-    if p.exitcode != 0:
+    if p.exitcode == _DECODE_COMPILED_EXIT:
+        raise ValueError("Decoding within network requires an uncompiled model, "
+                         "but {} is already compiled".format(model_file))
+    elif p.exitcode != 0:
         output_file = None
         raise ValueError("Model file {} was neither a network nor compiled network".format(model_file))
     else:
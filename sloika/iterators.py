@@ -13,6 +13,8 @@ import operator
 import numpy as np
 import random
 from multiprocessing import Pool
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from sloika.decorators import try_except_pass
 
@@ -349,3 +351,127 @@ def imap_mp(
             yield r
         pool.close()
         pool.join()
+
+
+def _apply_indexed(index_arg, function):
+    index, arg = index_arg
+    return index, function(arg)
+
+
+def imap_mp_reorder(function, args, fix_args=__NotGiven(), fix_kwargs=__NotGiven(),
+                    threads=1, max_pending=None, init=None, initargs=()):
+    """Map a function using multiple processes, yielding results in order
+
+    Calls are made as by :func:`imap_mp` with `unordered=True` but results
+    are tagged with the index of their argument and held in a reorder buffer
+    until all earlier results have been yielded.  Unlike an ordered map, a
+    slow call does not stop results of later calls being collected, while
+    the order of results does not depend on scheduling.
+
+    :param function: the function to apply, must be pickalable
+    :param args: iterable of argument values of function to map over
+    :param fix_args: arguments to hold fixed
+    :param fix_kwargs: keyword arguments to hold fixed
+    :param threads: number of subprocesses
+    :param max_pending: maximum number of arguments drawn beyond the earliest
+        whose result has not been yielded, bounding the reorder buffer
+        (None = four times the number of threads)
+    :param init: function to each thread to call when it is created.
+    :param initargs: list of arguments for init
+
+    .. note::
+        This function is a generator, the caller will need to consume this.
+    """
+    if max_pending is None:
+        max_pending = 4 * threads
+    assert max_pending > 0, "Maximum pending calls should be strictly positive, got {0}".format(max_pending)
+
+    my_function = function
+    if not isinstance(fix_args, __NotGiven):
+        my_function = partial(my_function, *fix_args)
+    if not isinstance(fix_kwargs, __NotGiven):
+        my_function = partial(my_function, **fix_kwargs)
+
+    #  Arguments are drawn by the pool in another thread, which waits while
+    #  too far ahead of the earliest result not yet yielded.  If the consumer
+    #  stops early, that thread is released so the pool can be shut down.
+    next_index = [0]
+    stopped = [False]
+    advanced = threading.Condition()
+
+    def throttled_args():
+        for index, arg in enumerate(args):
+            with advanced:
+                while not stopped[0] and index >= next_index[0] + max_pending:
+                    advanced.wait()
+                if stopped[0]:
+                    return
+            yield index, arg
+
+    buffered = {}
+    try:
+        for index, res in imap_mp(_apply_indexed, throttled_args(), fix_kwargs={'function': my_function},
+                                  threads=threads, unordered=True, init=init, initargs=initargs):
+            buffered[index] = res
+            while next_index[0] in buffered:
+                res = buffered.pop(next_index[0])
+                with advanced:
+                    next_index[0] += 1
+                    advanced.notify_all()
+                yield res
+    finally:
+        with advanced:
+            stopped[0] = True
+            advanced.notify_all()
+
+
+def imap_threads(function, args, fix_args=__NotGiven(), fix_kwargs=__NotGiven(),
+                 threads=1, unordered=False, max_pending=None):
+    """Map a function using a pool of threads
+
+    :param function: the function to apply
+    :param args: iterable of argument values of function to map over
+    :param fix_args: arguments to hold fixed
+    :param fix_kwargs: keyword arguments to hold fixed
+    :param threads: number of threads
+    :param unordered: yield results as they are completed
+    :param max_pending: maximum number of calls submitted but not yet yielded
+        (None = twice the number of threads)
+
+    .. note::
+        This function is a generator, the caller will need to consume this.
+        Arguments are only drawn from `args` as results are consumed, so work
+        done producing them in the calling thread overlaps with the calls
+        running in the pool.  Only functions that release the GIL, such as
+        the compiled decoding kernels, will run concurrently.  Nothing is
+        pickled, so large arrays are passed to the threads without copying.
+    """
+    assert threads > 0, "Number of threads should be strictly positive, got {0}".format(threads)
+    if max_pending is None:
+        max_pending = 2 * threads
+    assert max_pending > 0, "Maximum pending calls should be strictly positive, got {0}".format(max_pending)
+
+    my_function = function
+    if not isinstance(fix_args, __NotGiven):
+        my_function = partial(my_function, *fix_args)
+    if not isinstance(fix_kwargs, __NotGiven):
+        my_function = partial(my_function, **fix_kwargs)
+
+    pending = deque()
+
+    def drain(nleft):
+        """Yield results until no more than nleft calls are pending"""
+        while len(pending) > nleft:
+            if unordered:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            else:
+                done = [pending[0]]
+            for future in done:
+                pending.remove(future)
+                yield future.result()
+
+    with ThreadPoolExecutor(threads) as executor:
+        for arg in args:
+            pending.append(executor.submit(my_function, arg))
+            yield from drain(max_pending - 1)
+        yield from drain(0)
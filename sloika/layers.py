@@ -6,14 +6,14 @@ import numpy as np
 
 from sloika import activation, conv
 from sloika.config import sloika_dtype
-from sloika.variables import DEFAULT_NBASE, nkmer
+from sloika.transitions import kmer_transitions
+from sloika.variables import DEFAULT_NBASE
 from functools import reduce
 
 
 """  Convention: inMat row major (C ordering) as (time, batch, state)
 """
-_NSTEP = DEFAULT_NBASE
-_NSKIP = DEFAULT_NBASE * DEFAULT_NBASE
+_ETA = 1e-10
 _FORGET_BIAS = 2.0
 _INDENT = ' ' * 4
 
@@ -1561,62 +1561,108 @@ class Serial(Layer):
 
 
 class Decode(RNN):
-    """ Forward pass of a Viterbi decoder
+    """ Viterbi decoding of a kmer transducer
 
+    Input is the posterior of a transducer network, stay first.  For each
+    block and read of the batch, the output contains the kmer moved to at
+    that block along the best path, or -1 for a stay, followed by the score
+    of the best path up to that block.  The call for a read is given by the
+    non-negative entries of the first column and its score by the final
+    entry of the second (c.f. :func:`sloika.decode.viterbi`).
+
+    :param k: Length of kmer
     :param name: Name for layer
+    :param nbase: Number of letters in alphabet
+    :param skip_pen: Penalty for skips (in log-space)
+    :param min_prob: Minimum posterior probability, as for
+        :func:`sloika.decode.prepare_post`
     """
 
-    def __init__(self, k, name='ForwardsViterbi'):
-        self._NBASE = T.constant(DEFAULT_NBASE, dtype='int32')
-        self._NSTEP = T.constant(_NSTEP, dtype='int32')
-        self._NSKIP = T.constant(_NSKIP, dtype='int32')
-        self.size = T.constant(nkmer(k), dtype='int32')
-        self.rstep = T.constant(DEFAULT_NBASE ** (k - 1), dtype='int32')
-        self.rskip = T.constant(DEFAULT_NBASE ** (k - 2), dtype='int32')
+    def __init__(self, k, name='ForwardsViterbi', nbase=DEFAULT_NBASE, skip_pen=0.0, min_prob=0.0):
+        trans = kmer_transitions(k, nbase=nbase)
+        self.kmer = k
+        self.nbase = nbase
+        self.skip_pen = skip_pen
+        self.min_prob = min_prob
+        self._NSTEP = T.constant(trans.nstep, dtype='int32')
+        self._NSKIP = T.constant(trans.nskip, dtype='int32')
+        self._insize = trans.nkmer + 1
+        self._size = 2
+        self.step_from = T.constant(trans.step_from, dtype='int32')
+        self.skip_from = T.constant(trans.skip_from, dtype='int32')
         self._name = name
 
     def params(self):
         return []
 
     def json(self, params=False):
-        return OrderedDict([('type', "decode")])
+        return OrderedDict([('type', "decode"),
+                            ('kmer', self.kmer),
+                            ('nbase', self.nbase),
+                            ('skip_pen', self.skip_pen),
+                            ('min_prob', self.min_prob)])
 
     def set_params(self, values):
         return
 
+    def _best_predecessor(self, pscore, pred, nmove):
+        """  Best score and predecessor for each kmer under a move
+
+        :param pscore: Scores for kmers (batch x kmer)
+        :param pred: Table of predecessors for each group of kmers
+        :param nmove: Number of kmers in each group
+        """
+        pscore = pscore[:, pred]
+        best = T.max(pscore, axis=2)
+        ibest = pred[T.arange(pred.shape[0]), T.argmax(pscore, axis=2)]
+        return T.repeat(best, nmove, axis=1), T.repeat(ibest, nmove, axis=1)
+
     def step(self, in_vec, in_state):
-        pscore = in_state[:, :self.size]
+        """  Single step of forwards Viterbi
+
+        :param in_vec: Log posterior for block (batch x state)
+        :param in_state: Scores of kmers at previous block (batch x kmer)
+
+        :returns: Scores of kmers and traceback, where -1 indicates a stay
+        """
+        # Step and skip
+        score_step, from_step = self._best_predecessor(in_state, self.step_from, self._NSTEP)
+        score_skip, from_skip = self._best_predecessor(in_state, self.skip_from, self._NSKIP)
+        score_skip -= T.constant(self.skip_pen, dtype=sloika_dtype)
+        score = in_vec[:, 1:] + T.maximum(score_step, score_skip)
+        iscore = T.switch(T.gt(score_step, score_skip), from_step, from_skip)
         # Stay
-        score = pscore
-        iscore = T.zeros_like(score)
-        iscore += T.arange(0.0, stop=self.size)
-        # Step
-        pscore = pscore.reshape((-1, self._NSTEP, self.rstep))
-        score2 = T.repeat(T.max(pscore, axis=1), self._NSTEP)
-        iscore2 = T.repeat(self.rstep * T.argmax(pscore, axis=1) + T.arange(0.0,
-                                                                            stop=self.rstep,
-                                                                            dtype=sloika_dtype), self._NSTEP)
-        iscore2 = iscore2.reshape((-1, self.size))
-        score2 = score2.reshape((-1, self.size))
-        iscore = T.switch(T.gt(score, score2), iscore, iscore2)
-        score = T.maximum(score, score2)
-        # Skip
-        pscore = pscore.reshape((-1, self._NSKIP, self.rskip))
-        score2 = T.repeat(T.max(pscore, axis=1), self._NSKIP)
-        iscore2 = T.repeat(self.rstep * T.argmax(pscore, axis=1) + T.arange(0.0, stop=self.rskip), self._NSKIP)
-        iscore2 = iscore2.reshape((-1, self.size))
-        score2 = score2.reshape((-1, self.size))
-        iscore = T.switch(T.gt(score, score2), iscore, iscore2)
-        score = T.maximum(score, score2)
-
-        score += T.log(T.nnet.softmax(in_vec))
-        return T.concatenate((iscore, score), axis=1)
+        score_stay = in_state + T.shape_padright(in_vec[:, 0])
+        iscore = T.switch(T.gt(score, score_stay), iscore, -1)
+        score = T.maximum(score, score_stay)
+        return score, iscore
 
     def run(self, inMat):
-        nbatch = T.shape(inMat)[1]
-        out, _ = th.scan(self.step, sequences=inMat,
-                         outputs_info=T.zeros((nbatch, 2 * self.size)))
-        return out[:, :, self.size]
+        min_prob = T.constant(self.min_prob, dtype=sloika_dtype)
+        eta = T.constant(_ETA, dtype=sloika_dtype)
+        lpost = T.log(min_prob + (T.constant(1.0, dtype=sloika_dtype) - min_prob) * inMat + eta)
+
+        # Forwards
+        (score, traceback), _ = th.scan(self.step, sequences=lpost[1:],
+                                        outputs_info=[lpost[0, :, 1:], None])
+        score = T.concatenate((lpost[:1, :, 1:], score))
+
+        # Backwards
+        batch = T.arange(inMat.shape[1])
+        final = T.argmax(score[-1], axis=1)
+
+        def traceback_step(tb, state):
+            from_state = tb[batch, state]
+            moved = T.ge(from_state, 0)
+            return T.switch(moved, from_state, state), T.switch(moved, state, -1)
+
+        (path, moves), _ = th.scan(traceback_step, sequences=traceback[::-1],
+                                   outputs_info=[final, None])
+        path = T.concatenate((path[::-1], T.shape_padleft(final)))
+        moves = T.concatenate((path[:1], moves[::-1]))
+
+        path_score = score[T.arange(path.shape[0]).dimshuffle(0, 'x'), batch.dimshuffle('x', 0), path]
+        return T.stack((T.cast(moves, sloika_dtype), path_score), axis=2)
 
 
 def birnn(forward, backward, name='BiRNN'):
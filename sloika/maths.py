@@ -1,23 +1,44 @@
 import numpy as np
 
 
-def med_mad(data, factor=None, axis=None, keepdims=False):
+MED_MAD_METHODS = frozenset(['exact', 'fast'])
+
+_MED_MAD_NBIN = 4096
+_MED_MAD_SORT_RATIO = 8
+
+
+def med_mad(data, factor=None, axis=None, keepdims=False, method='exact', nbin=_MED_MAD_NBIN):
     """Compute the Median Absolute Deviation, i.e., the median
     of the absolute deviations from the median, and the median
 
+    The exact method partitions the data twice.  The fast method makes a
+    single pass over the data to form a histogram of `nbin` equal width
+    bins spanning its range, taking the centres of bins as values.  The
+    median is then within half the width of a bin of the exact median and
+    the unscaled MAD within the width of a bin.  For integer data, e.g. raw
+    ADC values, spanning fewer than `nbin` values, each bin contains a
+    single value and the result is exact.
+
     :param data: A :class:`ndarray` object
     :param factor: Factor to scale MAD by. Default (None) is to be consistent
     with the standard deviation of a normal distribution
     (i.e. mad( N(0,\sigma^2) ) = \sigma).
     :param axis: For multidimensional arrays, which axis to calculate over
     :param keepdims: If True, axis is kept as dimension of length 1
+    :param method: 'exact' or 'fast'
+    :param nbin: Number of bins of histogram for fast method
 
     :returns: a tuple containing the median and MAD of the data
     """
+    assert method in MED_MAD_METHODS, "method not understood: {}".format(method)
     if factor is None:
         factor = 1.4826
-    dmed = np.median(data, axis=axis, keepdims=True)
-    dmad = factor * np.median(abs(data - dmed), axis=axis, keepdims=True)
+    if method == 'exact':
+        dmed = np.median(data, axis=axis, keepdims=True)
+        dmad = factor * np.median(abs(data - dmed), axis=axis, keepdims=True)
+    else:
+        dmed, dmad = _hist_med_mad(data, axis, nbin)
+        dmad *= factor
     if axis is None:
         dmed = dmed.flatten()[0]
         dmad = dmad.flatten()[0]
@@ -27,7 +48,82 @@ def med_mad(data, factor=None, axis=None, keepdims=False):
     return dmed, dmad
 
 
-def mad(data, factor=None, axis=None, keepdims=False):
+def _hist_counts(x, lo, width, nbin):
+    """ Counts of values of each row of x in bins of given start and width"""
+    nrow = len(x)
+    idx = ((x - lo[:, None]) / width[:, None]).astype(np.intp)
+    np.clip(idx, 0, nbin - 1, out=idx)
+    idx += nbin * np.arange(nrow)[:, None]
+    return np.bincount(idx.ravel(), minlength=nrow * nbin).reshape((nrow, nbin))
+
+
+def _hist_median(counts, centre, nvalue):
+    """ Median of binned values, taking values as centres of bins"""
+    cum = np.cumsum(counts, axis=1)
+    lower = np.sum(cum <= (nvalue - 1) // 2, axis=1)
+    upper = np.sum(cum <= nvalue // 2, axis=1)
+    rows = np.arange(len(counts))
+    return 0.5 * (centre[rows, lower] + centre[rows, upper])
+
+
+def _hist_med_mad(data, axis, nbin):
+    """ Median and unscaled MAD from histograms of data, keeping dimensions"""
+    data = np.asarray(data)
+    if axis is None:
+        x = data.reshape((1, -1))
+    else:
+        x = np.rollaxis(data, axis, data.ndim)
+        x = x.reshape((-1, x.shape[-1]))
+    nrow, nvalue = x.shape
+
+    lo = np.amin(x, axis=1).astype(np.float64)
+    hi = np.amax(x, axis=1).astype(np.float64)
+    is_constant = hi == lo
+    is_exact = data.dtype.kind in 'iu' and np.all(hi - lo < nbin)
+    if is_exact:
+        #  Bins of width one centred on each integer value
+        nbin = int(np.amax(hi - lo)) + 1
+        lo -= 0.5
+        width = np.ones(nrow)
+    else:
+        width = np.where(hi > lo, (hi - lo) / nbin, 1.0)
+    counts = _hist_counts(x, lo, width, nbin)
+    centre = lo[:, None] + (np.arange(nbin) + 0.5) * width[:, None]
+    dmed = _hist_median(counts, centre, nvalue)
+
+    if nbin * _MED_MAD_SORT_RATIO <= nvalue:
+        #  Few bins compared to values: deviations are those of centres of bins
+        dev = np.fabs(centre - dmed[:, None])
+        order = np.argsort(dev, axis=1)
+        rows = np.arange(nrow)[:, None]
+        dmad = _hist_median(counts[rows, order], dev[rows, order], nvalue)
+    else:
+        #  Histogram of deviations.  For integers, the median and so the
+        #  deviations are multiples of one half; otherwise, the median is the
+        #  centre of a bin and deviations span no more than the range.
+        dev = np.fabs(x - dmed[:, None])
+        if is_exact:
+            nbin *= 2
+            lo = np.repeat(-0.25, nrow)
+            width = np.repeat(0.5, nrow)
+        else:
+            lo = np.zeros(nrow)
+        counts = _hist_counts(dev, lo, width, nbin)
+        dmad = _hist_median(counts, lo[:, None] + (np.arange(nbin) + 0.5) * width[:, None], nvalue)
+
+    #  Bins of constant rows have no width, so their centres are not values
+    dmed = np.where(is_constant, hi, dmed)
+    dmad = np.where(is_constant, 0.0, dmad)
+
+    shape = list(data.shape)
+    if axis is None:
+        shape = [1] * data.ndim
+    else:
+        shape[axis] = 1
+    return dmed.reshape(shape), dmad.reshape(shape)
+
+
+def mad(data, factor=None, axis=None, keepdims=False, method='exact'):
     """Compute the Median Absolute Deviation, i.e., the median
     of the absolute deviations from the median, and (by default)
     adjust by a factor for asymptotically normal consistency.
@@ -38,10 +134,11 @@ def mad(data, factor=None, axis=None, keepdims=False):
     (i.e. mad( N(0,\sigma^2) ) = \sigma).
     :param axis: For multidimensional arrays, which axis to calculate the median over.
     :param keepdims: If True, axis is kept as dimension of length 1
+    :param method: 'exact' or 'fast', see :func:`med_mad`
 
     :returns: the (scaled) MAD
     """
-    _ , dmad = med_mad(data, factor=factor, axis=axis, keepdims=keepdims)
+    _ , dmad = med_mad(data, factor=factor, axis=axis, keepdims=keepdims, method=method)
     return dmad
 
 
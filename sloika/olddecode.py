@@ -1,6 +1,8 @@
 import itertools
 import numpy as np
 
+from sloika.transitions import best_predecessor, kmer_transitions
+
 _ETA = 1e-10
 _BASES = ['A', 'C', 'G', 'T']
 _DIBASES = [b1 + b2 for b1 in _BASES for b2 in _BASES]
@@ -18,7 +20,7 @@ def decode_profile(post, trans=None, log=False, slip=0.0):
     per-transition log-scaled weights. None == no transition weights.
     :param log: Posterior probabilities are in log-space.
     """
-    nstate = post.shape[1]
+    nev, nstate = post.shape
     lpost = post.copy()
     if not log:
         np.add(_ETA, lpost, lpost)
@@ -33,36 +35,55 @@ def decode_profile(post, trans=None, log=False, slip=0.0):
 
     log_slip = np.log(_ETA + slip)
 
-    pscore = lpost[0]
+    klen = int(round(np.log(nstate) / np.log(_NSTEP)))
+    assert nstate == _NSTEP ** klen, 'Number of states is not a number of kmers'
+    kmer_trans = kmer_transitions(klen, nbase=_NSTEP)
+
+    #  Preallocated buffers for scores and traceback
+    pscore = lpost[0].copy()
+    score = np.empty(nstate)
+    iscore = np.empty(nstate)
+    is_new = np.empty(nstate, dtype=bool)
+    all_states = np.arange(nstate)
+    #  Views of buffers grouped by predecessors of step and skip
+    score_by_step = score.reshape(kmer_trans.step_from.shape)
+    iscore_by_step = iscore.reshape(kmer_trans.step_from.shape)
+    is_new_by_step = is_new.reshape(kmer_trans.step_from.shape)
+    score_by_skip = score.reshape(kmer_trans.skip_from.shape)
+    iscore_by_skip = iscore.reshape(kmer_trans.skip_from.shape)
+    is_new_by_skip = is_new.reshape(kmer_trans.skip_from.shape)
+
     trans_iter = trans.__iter__()
-    for ev in range(1, len(post)):
+    for ev in range(1, nev):
         # Forward Viterbi iteration
         ev_trans = next(trans_iter)
         # Stay
-        score = pscore + ev_trans[0]
-        iscore = list(range(nstate))
+        np.add(pscore, ev_trans[0], out=score)
+        iscore[:] = all_states
         # Slip
-        scoreNew = np.amax(pscore) + log_slip
         iscoreNew = np.argmax(pscore)
-        iscore = np.where(score > scoreNew, iscore, iscoreNew)
-        score = np.fmax(score, scoreNew)
+        scoreNew = pscore[iscoreNew] + log_slip
+        np.greater(score, scoreNew, out=is_new)
+        np.logical_not(is_new, out=is_new)
+        iscore[is_new] = iscoreNew
+        np.fmax(score, scoreNew, out=score)
         # Step
-        pscore = pscore.reshape((_NSTEP, -1))
-        nrem = pscore.shape[1]
-        scoreNew = np.repeat(np.amax(pscore, axis=0), _NSTEP) + ev_trans[1]
-        iscoreNew = np.repeat(nrem * np.argmax(pscore, axis=0) + list(range(nrem)), _NSTEP)
-        iscore = np.where(score > scoreNew, iscore, iscoreNew)
-        score = np.fmax(score, scoreNew)
+        step_score, iscoreNew = best_predecessor(pscore, kmer_trans.step_from)
+        step_score += ev_trans[1]
+        np.greater(score_by_step, step_score[:, None], out=is_new_by_step)
+        np.logical_not(is_new, out=is_new)
+        np.copyto(iscore_by_step, iscoreNew[:, None], where=is_new_by_step)
+        np.fmax(score_by_step, step_score[:, None], out=score_by_step)
         # Skip
-        pscore = pscore.reshape((_NSKIP, -1))
-        nrem = pscore.shape[1]
-        scoreNew = np.repeat(np.amax(pscore, axis=0), _NSKIP) + ev_trans[2]
-        iscoreNew = np.repeat(nrem * np.argmax(pscore, axis=0) + list(range(nrem)), _NSKIP)
-        iscore = np.where(score > scoreNew, iscore, iscoreNew)
-        score = np.fmax(score, scoreNew)
+        skip_score, iscoreNew = best_predecessor(pscore, kmer_trans.skip_from)
+        skip_score += ev_trans[2]
+        np.greater(score_by_skip, skip_score[:, None], out=is_new_by_skip)
+        np.logical_not(is_new, out=is_new)
+        np.copyto(iscore_by_skip, iscoreNew[:, None], where=is_new_by_skip)
+        np.fmax(score_by_skip, skip_score[:, None], out=score_by_skip)
         # Store
         lpost[ev - 1] = iscore
-        pscore = score + lpost[ev]
+        np.add(score, lpost[ev], out=pscore)
 
     state_seq = np.zeros(len(post), dtype=int)
     state_seq[-1] = np.argmax(pscore)
@@ -96,16 +117,22 @@ def estimate_transitions(post, trans=None):
     :param trans: prior belief of transition behaviour (None = use global estimate)
     """
     assert trans is None or len(trans) == 3, 'Incorrect number of transitions'
-    res = np.zeros((len(post), 3))
+    nev, nstate = post.shape
+    res = np.zeros((nev, 3))
     res[:] = _ETA
 
-    for ev in range(1, len(post)):
-        stay = np.sum(post[ev - 1] * post[ev])
-        p = post[ev].reshape((-1, _NSTEP))
-        step = np.sum(post[ev - 1] * np.tile(np.sum(p, axis=1), _NSTEP)) / _NSTEP
-        p = post[ev].reshape((-1, _NSKIP))
-        skip = np.sum(post[ev - 1] * np.tile(np.sum(p, axis=1), _NSKIP)) / _NSKIP
-        res[ev - 1] = [stay, step, skip]
+    prev = post[:-1]
+    curr = post[1:]
+    #  Stay: same state in successive events
+    res[:-1, 0] = np.einsum('ij,ij->i', prev, curr)
+    #  Step: previous state's suffix matches prefix of current state
+    step_to = curr.reshape((nev - 1, nstate // _NSTEP, _NSTEP)).sum(axis=2)
+    step_from = prev.reshape((nev - 1, _NSTEP, nstate // _NSTEP)).sum(axis=1)
+    res[:-1, 1] = np.einsum('ij,ij->i', step_from, step_to) / _NSTEP
+    #  Skip
+    skip_to = curr.reshape((nev - 1, nstate // _NSKIP, _NSKIP)).sum(axis=2)
+    skip_from = prev.reshape((nev - 1, _NSKIP, nstate // _NSKIP)).sum(axis=1)
+    res[:-1, 2] = np.einsum('ij,ij->i', skip_from, skip_to) / _NSKIP
 
     if trans is None:
         trans = np.sum(res, axis=0)
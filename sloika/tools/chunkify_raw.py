@@ -1,4 +1,5 @@
 from Bio import SeqIO
+from itertools import chain
 import numpy as np
 import os
 import sys
@@ -6,8 +7,8 @@ import sys
 import sloika
 from sloika import util, helpers, batch
 from sloika import bio, fast5
-from sloika.iterators import imap_mp
-from sloika.maths import mad
+from sloika.iterators import grouper_it
+from sloika.maths import med_mad
 
 
 DEFAULT_NORMALISATION = 'per-read'
@@ -115,7 +116,7 @@ def interpolate_labels(mapping_table, att):
     """
     def interp(t, k=5):
         pos = interpolate_pos(mapping_table, att)(t, k)
-        return np.array([batch.kmer_to_state[att['reference'][i: i + k]] for i in pos]) + 1
+        return bio.seq_to_states(att['reference'], k, alphabet=batch.kmer_alphabet)[pos] + 1
 
     return interp
 
@@ -128,23 +129,14 @@ def labels_from_mapping_table(kmer_array, kmer_len, index_from=1):
 
     :returns: an array of labels
     """
-    kmer_array = np.ascontiguousarray(kmer_array)
+    labels = bio.kmer_array_to_states(kmer_array, kmer_len, alphabet=batch.kmer_alphabet) + index_from
 
-    old_kmer_len = len(kmer_array.flat[0])
-    assert kmer_len <= old_kmer_len
-
-    offset = (old_kmer_len - kmer_len + 1) // 2
-    extracted = np.chararray(kmer_array.shape, kmer_len, buffer=kmer_array.data,
-                             offset=offset, strides=kmer_array.strides)
-
-    labels = np.array(list(map(lambda k: batch.kmer_to_state[k], extracted.flat))) + index_from
-
-    return labels.reshape(kmer_array.shape).astype('i4')
+    return labels.astype('i4')
 
 
 def replace_repeats_with_zero(arr):
-    """Replace repeated elements in 1d array with 0"""
-    arr[np.ediff1d(arr, to_begin=1) == 0] = 0
+    """Replace repeated elements along last axis of array with 0"""
+    arr[..., 1:][arr[..., 1:] == arr[..., :-1]] = 0
     return arr
 
 
@@ -162,8 +154,11 @@ def index_of_previous_non_zero(input_array):
 
 
 def raw_chunkify(signal, mapping_table, chunk_len, kmer_len, normalisation,
-                 downsample_factor, interpolation, mapping_attrs=None):
+                 downsample_factor, interpolation, mapping_attrs=None, mad_method='exact'):
     """ Generate labelled data chunks from raw signal and mapping table
+
+    :param mad_method: method of calculating median and MAD for
+        normalisation, see :func:`maths.med_mad`
     """
     assert len(signal) >= chunk_len
     assert normalisation in AVAILABLE_NORMALISATIONS
@@ -176,11 +171,11 @@ def raw_chunkify(signal, mapping_table, chunk_len, kmer_len, normalisation,
     new_inMat = signal.reshape((ml, chunk_len, 1))
 
     if normalisation == "per-chunk":
-        chunk_medians = np.median(new_inMat, axis=1, keepdims=True)
-        chunk_mads = mad(new_inMat, axis=1, keepdims=True)
+        chunk_medians, chunk_mads = med_mad(new_inMat, axis=1, keepdims=True, method=mad_method)
         new_inMat = (new_inMat - chunk_medians) / chunk_mads
     elif normalisation == "per-read":
-        new_inMat = (new_inMat - np.median(new_inMat)) / mad(new_inMat)
+        read_median, read_mad = med_mad(new_inMat, method=mad_method)
+        new_inMat = (new_inMat - read_median) / read_mad
     else:
         assert normalisation == "none"
 
@@ -200,7 +195,7 @@ def raw_chunkify(signal, mapping_table, chunk_len, kmer_len, normalisation,
         idx[starts] = np.arange(len(labels)) + 1
         idx = fill_zeros_with_prev(idx)
         idx = idx.reshape((ml, chunk_len))[:, ::downsample_factor]
-        idx = np.apply_along_axis(replace_repeats_with_zero, 1, idx)
+        idx = replace_repeats_with_zero(idx)
 
         sig_labels = np.concatenate([[0], labels])[idx].astype('i4')
 
@@ -211,7 +206,7 @@ def raw_chunkify(signal, mapping_table, chunk_len, kmer_len, normalisation,
 
 
 def raw_chunk_worker(fn, chunk_len, kmer_len, min_length, trim, normalisation,
-                     downsample_factor, interpolation=False):
+                     downsample_factor, interpolation=False, mad_method='exact'):
     """ Worker for creating labelled features from raw data
 
     :param fn: A filename to read from.
@@ -223,6 +218,11 @@ def raw_chunk_worker(fn, chunk_len, kmer_len, min_length, trim, normalisation,
     :param downsample_factor: factor by which to downsample labels
     :param interpolation: interpolate sequence positions between those in
         mapping table
+    :param mad_method: method of calculating median and MAD, see :func:`maths.med_mad`
+
+    :returns: tuple of chunks, labels and bad, containing no chunks if the
+        read is unsuitable (see :func:`util.empty_chunks`), or None if the
+        read could not be processed
     """
     try:
         with fast5.Reader(fn) as f5:
@@ -243,36 +243,52 @@ def raw_chunk_worker(fn, chunk_len, kmer_len, min_length, trim, normalisation,
         assert mapping_table_is_registered(mapped_signal, mapping_table)
     except Exception as e:
         sys.stderr.write('Failed to properly register raw signal and mapping table in {}.\n{}\n'.format(fn, repr(e)))
-        return None
+        return util.empty_chunks(chunk_len, 1)
 
     if len(mapped_signal) < max(chunk_len, min_length):
         sys.stderr.write('{} is too short.\n'.format(fn))
-        return None
+        return util.empty_chunks(chunk_len, 1)
 
     new_inMat, sig_labels, sig_bad = raw_chunkify(mapped_signal, mapping_table, chunk_len, kmer_len, normalisation,
-                                                  downsample_factor, interpolation, att)
+                                                  downsample_factor, interpolation, att, mad_method=mad_method)
 
     return (np.ascontiguousarray(new_inMat),
             np.ascontiguousarray(sig_labels),
             np.ascontiguousarray(sig_bad))
 
 
-def raw_remap(ref, signal, min_prob, kmer_len, prior, slip):
-    """ Map raw signal to reference sequence using transducer model"""
+def raw_remap_input(signal, mad_method='exact'):
+    """ Network input for mapping raw signal"""
     from sloika import config  # local import to avoid CUDA init in main thread
 
-    inMat = (signal - np.median(signal)) / mad(signal)
-    inMat = inMat[:, None, None].astype(config.sloika_dtype)
-    post = sloika.decode.prepare_post(batch.calc_post(inMat), min_prob=min_prob, drop_bad=False)
+    signal_median, signal_mad = med_mad(signal, method=mad_method)
+    inMat = (signal - signal_median) / signal_mad
+    return inMat[:, None, None].astype(config.sloika_dtype)
+
+
+def raw_remap(ref, signal, min_prob, kmer_len, prior, slip, anchor=None, post=None, mad_method='exact'):
+    """ Map raw signal to reference sequence using transducer model
+
+    :param post: posterior of network for signal, e.g. from
+        :func:`batch.calc_post_batch`, or None to evaluate network
+    :param mad_method: method of calculating median and MAD of signal
+        when evaluating network, see :func:`maths.med_mad`
+    """
+    if post is None:
+        post = batch.calc_post(raw_remap_input(signal, mad_method=mad_method))
+    post = sloika.decode.prepare_post(post, min_prob=min_prob, drop_bad=False)
 
     kmers = np.array(bio.seq_to_kmers(ref, kmer_len))
-    seq = [batch.kmer_to_state[k] + 1 for k in kmers]
+    seq = bio.seq_to_states(ref, kmer_len, alphabet=batch.kmer_alphabet) + 1
     prior0 = None if prior[0] is None else sloika.util.geometric_prior(len(seq), prior[0])
     prior1 = None if prior[1] is None else sloika.util.geometric_prior(len(seq), prior[1], rev=True)
 
+    band = None if anchor is None else sloika.transducer.anchor_band(post, seq, anchor)
+
     score, path = sloika.transducer.map_to_sequence(post, seq, slip=slip,
                                                     prior_initial=prior0,
-                                                    prior_final=prior1, log=False)
+                                                    prior_final=prior1, log=False,
+                                                    band=band)
 
     mapping_dtype = [
         ('start', '<i8'),
@@ -297,13 +313,15 @@ def raw_remap(ref, signal, min_prob, kmer_len, prior, slip):
     return (score, mapping_table, path, seq)
 
 
-def raw_chunk_remap_worker(fn, trim, min_prob, kmer_len, min_length,
-                           prior, slip, chunk_len, normalisation, downsample_factor,
-                           interpolation, open_pore_fraction, references):
-    """ Worker function for `chunkify raw_remap` remapping reads using raw signal"""
+def _read_remap_signal(fn, trim, chunk_len, min_length, open_pore_fraction, references, mad_method,
+                       open_pore_method):
     try:
         with fast5.Reader(fn) as f5:
-            signal = f5.get_read(raw=True)
+            #  Locate read on ADC values and only scale those within it
+            signal = f5.get_read(raw=True, scale=False)
+            start, end = batch.open_pore_bounds(signal, open_pore_fraction, var_method=open_pore_method,
+                                                mad_method=mad_method)
+            signal = f5.scale_raw(signal[start:end])
             sn = f5.filename_short
     except Exception as e:
         sys.stderr.write('Failure reading events from {}.\n{}\n'.format(fn, repr(e)))
@@ -315,28 +333,73 @@ def raw_chunk_remap_worker(fn, trim, min_prob, kmer_len, min_length,
         sys.stderr.write('No reference found for {}.\n{}\n'.format(fn, repr(e)))
         return None
 
-    signal = batch.trim_open_pore(signal, open_pore_fraction)
     signal = util.trim_array(signal, *trim)
 
     if len(signal) < max(chunk_len, min_length):
         sys.stderr.write('{} is too short.\n'.format(fn))
         return None
 
+    return sn, signal, read_ref
+
+
+def raw_chunk_remap_worker(fn, trim, min_prob, kmer_len, min_length,
+                           prior, slip, chunk_len, normalisation, downsample_factor,
+                           interpolation, open_pore_fraction, references, anchor=None, mad_method='exact',
+                           open_pore_method='mad'):
+    """ Worker function for `chunkify raw_remap` remapping reads using raw signal"""
+    return raw_chunk_remap_batch_worker([fn], trim, min_prob, kmer_len, min_length, prior, slip, chunk_len,
+                                        normalisation, downsample_factor, interpolation, open_pore_fraction,
+                                        references, anchor=anchor, mad_method=mad_method,
+                                        open_pore_method=open_pore_method)[0]
+
+
+def raw_chunk_remap_batch_worker(fns, trim, min_prob, kmer_len, min_length,
+                                 prior, slip, chunk_len, normalisation, downsample_factor,
+                                 interpolation, open_pore_fraction, references, anchor=None, mad_method='exact',
+                                 open_pore_method='mad', remap_pad=0.0):
+    """ Worker function for `chunkify raw_remap` remapping several reads,
+    evaluating the network on them in batches, see :func:`batch.calc_post_batch`
+
+    :param fns: list of filenames to read from
+    :param remap_pad: maximum padding of a read when batched, as a proportion of its length
+    Other parameters as for :func:`raw_chunk_remap_worker`
+
+    :returns: list containing the result of :func:`raw_chunk_remap_worker`
+        for each file
+    """
+    reads = [_read_remap_signal(fn, trim, chunk_len, min_length, open_pore_fraction, references, mad_method,
+                                open_pore_method) for fn in fns]
+    inMats = [raw_remap_input(signal, mad_method=mad_method) for _, signal, _ in filter(None, reads)]
     try:
-        (score, mapping_table, path, seq) = raw_remap(read_ref, signal, min_prob, kmer_len, prior, slip)
+        posts = iter(batch.calc_post_batch(inMats, max_pad=remap_pad) if len(inMats) > 0 else [])
     except Exception as e:
-        sys.stderr.write("Failure remapping read {}.\n{}\n".format(sn, repr(e)))
-        return None
-    # mapping_attrs required if using interpolation
-    mapping_attrs = {
-        'reference': read_ref,
-        'direction': '+',
-        'ref_start': 0,
-    }
-    (chunks, labels, bad_ev) = raw_chunkify(signal, mapping_table, chunk_len, kmer_len, normalisation,
-                                            downsample_factor, interpolation, mapping_attrs)
-
-    return sn + '.fast5', score, len(mapping_table), path, seq, chunks, labels, bad_ev
+        sys.stderr.write("Failure evaluating network for reads {}.\n{}\n".format(fns, repr(e)))
+        return [None] * len(fns)
+
+    res = []
+    for read in reads:
+        if read is None:
+            res.append(None)
+            continue
+        sn, signal, read_ref = read
+        try:
+            (score, mapping_table, path, seq) = raw_remap(read_ref, signal, min_prob, kmer_len, prior, slip,
+                                                          anchor=anchor, post=next(posts))
+        except Exception as e:
+            sys.stderr.write("Failure remapping read {}.\n{}\n".format(sn, repr(e)))
+            res.append(None)
+            continue
+        # mapping_attrs required if using interpolation
+        mapping_attrs = {
+            'reference': read_ref,
+            'direction': '+',
+            'ref_start': 0,
+        }
+        (chunks, labels, bad_ev) = raw_chunkify(signal, mapping_table, chunk_len, kmer_len, normalisation,
+                                                downsample_factor, interpolation, mapping_attrs,
+                                                mad_method=mad_method)
+        res.append((sn + '.fast5', score, len(mapping_table), path, seq, chunks, labels, bad_ev))
+    return res
 
 
 def raw_chunkify_with_identity_main(args):
@@ -353,42 +416,41 @@ def raw_chunkify_with_identity_main(args):
 
     print('* Processing data using', args.jobs, 'threads')
 
-    kwarg_names = ['chunk_len', 'kmer_len', 'min_length', 'trim', 'normalisation', 'downsample_factor', 'interpolation']
+    kwarg_names = ['chunk_len', 'kmer_len', 'min_length', 'trim', 'normalisation', 'downsample_factor', 'interpolation',
+                   'mad_method']
+    hdf5_attributes = {
+        'chunk': args.chunk_len,
+        'downsample_factor': args.downsample_factor,
+        'input_type': 'raw',
+        'interpolation': args.interpolation,
+        'kmer': args.kmer_len,
+        'normalisation': args.normalisation,
+        'section': 'template',
+        'trim': args.trim,
+        'alphabet': args.alphabet,
+    }
+    kwargs = util.get_kwargs(args, kwarg_names)
     i = 0
-    bad_list = []
-    chunk_list = []
-    label_list = []
-    for res in imap_mp(raw_chunk_worker, fast5_files, threads=args.jobs,
-                       unordered=True, fix_kwargs=util.get_kwargs(args, kwarg_names),
-                       init=batch.init_chunk_identity_worker, initargs=[args.kmer_len, args.alphabet]):
-        if res is not None:
-            i = util.progress_report(i)
-
-            (chunks, labels, bad_ev) = res
-
-            chunk_list.append(chunks)
-            label_list.append(labels)
-            bad_list.append(bad_ev)
-
-    if chunk_list == []:
+    with util.chunks_writer(args.output, hdf5_attributes, args.shard_size) as writer:
+        for res in util.imap_cached(args.cache, dict(kwargs, alphabet=args.alphabet), raw_chunk_worker,
+                                    fast5_files, kwargs, deterministic=args.deterministic, threads=args.jobs,
+                                    init=batch.init_chunk_identity_worker, initargs=[args.kmer_len, args.alphabet]):
+            if res is not None:
+                i = util.progress_report(i)
+
+                (chunks, labels, bad_ev) = res
+
+                writer.append(chunks, labels, bad_ev)
+
+        if writer.nchunk > 0:
+            print('\n* Finalising HDF5')
+            blanks = np.percentile(writer.blank_fraction, args.blanks_percentile)
+            writer.finalise(blanks)
+
+    if writer.nchunk == 0:
+        os.remove(args.output)
         print("no chunks were produced", file=sys.stderr)
         sys.exit(1)
-    else:
-        print('\n* Writing out to HDF5')
-        hdf5_attributes = {
-            'chunk': args.chunk_len,
-            'downsample_factor': args.downsample_factor,
-            'input_type': 'raw',
-            'interpolation': args.interpolation,
-            'kmer': args.kmer_len,
-            'normalisation': args.normalisation,
-            'section': 'template',
-            'trim': args.trim,
-            'alphabet': args.alphabet,
-        }
-        blanks_per_chunk = np.concatenate([(l == 0).mean(1) for l in label_list])
-        blanks = np.percentile(blanks_per_chunk, args.blanks_percentile)
-        util.create_labelled_chunks_hdf5(args.output, blanks, hdf5_attributes, chunk_list, label_list, bad_list)
 
 
 def raw_chunkify_with_remap_main(args):
@@ -411,53 +473,55 @@ def raw_chunkify_with_remap_main(args):
 
     kwarg_names = ['trim', 'min_prob', 'kmer_len', 'min_length',
                    'prior', 'slip', 'chunk_len', 'normalisation', 'downsample_factor',
-                   'interpolation', 'open_pore_fraction']
+                   'interpolation', 'open_pore_fraction', 'open_pore_method', 'anchor', 'mad_method',
+                   'remap_pad']
     kwargs = util.get_kwargs(args, kwarg_names)
     kwargs['references'] = references
 
+    hdf5_attributes = {
+        'chunk': args.chunk_len,
+        'downsample_factor': args.downsample_factor,
+        'input_type': 'raw',
+        'interpolation': args.interpolation,
+        'kmer': args.kmer_len,
+        'normalisation': args.normalisation,
+        'section': 'template',
+        'trim': args.trim,
+        'alphabet': args.alphabet,
+    }
+
     i = 0
     compiled_file = helpers.compile_model(args.model, args.compile)
     output_strand_list_entries = []
-    bad_list = []
-    chunk_list = []
-    label_list = []
-    with open(args.output_strand_list, 'w') as slfh:
+    with open(args.output_strand_list, 'w') as slfh, \
+            util.chunks_writer(args.output, hdf5_attributes, args.shard_size) as writer:
         slfh.write(u'\t'.join(['filename', 'nblocks', 'score', 'nstay', 'seqlen', 'start', 'end']) + u'\n')
-        for res in imap_mp(raw_chunk_remap_worker, fast5_files, threads=args.jobs,
-                        fix_kwargs=kwargs, unordered=True, init=batch.init_chunk_remap_worker,
-                        initargs=[compiled_file, args.kmer_len, args.alphabet]):
+        fast5_groups = (list(fns) for fns in grouper_it(fast5_files, args.remap_batch))
+        results = util.imap_chunkify(raw_chunk_remap_batch_worker, fast5_groups, kwargs,
+                                     deterministic=args.deterministic, threads=args.jobs,
+                                     init=batch.init_chunk_remap_worker,
+                                     initargs=[compiled_file, args.kmer_len, args.alphabet])
+        for res in chain.from_iterable(results):
             if res is not None:
                 i = util.progress_report(i)
 
                 read, score, nblocks, path, seq, chunks, labels, bad_ev = res
 
-                chunk_list.append(chunks)
-                label_list.append(labels)
-                bad_list.append(bad_ev)
+                writer.append(chunks, labels, bad_ev)
                 strand_data = [read, nblocks, -score / nblocks,
                                np.sum(np.ediff1d(path, to_begin=1) == 0),
                                len(seq), min(path), max(path)]
                 slfh.write('\t'.join([str(x) for x in strand_data]) + '\n')
 
+        if writer.nchunk > 0:
+            print('\n* Finalising HDF5')
+            blanks = np.percentile(writer.blank_fraction, args.blanks_percentile)
+            writer.finalise(blanks)
+
     if compiled_file != args.compile:
         os.remove(compiled_file)
 
-    if chunk_list == []:
+    if writer.nchunk == 0:
+        os.remove(args.output)
         print("no chunks were produced", file=sys.stderr)
         sys.exit(1)
-    else:
-        print('\n* Writing out to HDF5')
-        hdf5_attributes = {
-            'chunk': args.chunk_len,
-            'downsample_factor': args.downsample_factor,
-            'input_type': 'raw',
-            'interpolation': args.interpolation,
-            'kmer': args.kmer_len,
-            'normalisation': args.normalisation,
-            'section': 'template',
-            'trim': args.trim,
-            'alphabet': args.alphabet,
-        }
-        blanks_per_chunk = np.concatenate([(l == 0).mean(1) for l in label_list])
-        blanks = np.percentile(blanks_per_chunk, args.blanks_percentile)
-        util.create_labelled_chunks_hdf5(args.output, blanks, hdf5_attributes, chunk_list, label_list, bad_list)
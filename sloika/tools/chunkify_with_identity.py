@@ -4,8 +4,6 @@ import sys
 import numpy as np
 
 from sloika import batch, util
-
-from sloika.iterators import imap_mp
 from sloika import fast5
 
 
@@ -23,35 +21,34 @@ def chunkify_with_identity_main(args):
     print('* Processing data using', args.jobs, 'threads')
 
     kwarg_names = ['section', 'chunk_len', 'kmer_len', 'min_length', 'trim', 'use_scaled', 'normalisation']
+    hdf5_attributes = {
+        'chunk': args.chunk_len,
+        'input_type': 'events',
+        'kmer': args.kmer_len,
+        'normalisation': args.normalisation,
+        'scaled': args.use_scaled,
+        'section': args.section,
+        'trim': args.trim,
+        'alphabet': args.alphabet,
+    }
+    kwargs = util.get_kwargs(args, kwarg_names)
     i = 0
-    bad_list = []
-    chunk_list = []
-    label_list = []
-    for res in imap_mp(batch.chunk_worker, fast5_files, threads=args.jobs,
-                       unordered=True, fix_kwargs=util.get_kwargs(args, kwarg_names),
-                       init=batch.init_chunk_identity_worker, initargs=[args.kmer_len, args.alphabet]):
-        if res is not None:
-            i = util.progress_report(i)
-
-            (chunks, labels, bad_ev) = res
-
-            chunk_list.append(chunks)
-            label_list.append(labels)
-            bad_list.append(bad_ev)
-
-    if chunk_list == []:
+    with util.chunks_writer(args.output, hdf5_attributes, args.shard_size) as writer:
+        for res in util.imap_cached(args.cache, dict(kwargs, alphabet=args.alphabet), batch.chunk_worker,
+                                    fast5_files, kwargs, deterministic=args.deterministic, threads=args.jobs,
+                                    init=batch.init_chunk_identity_worker, initargs=[args.kmer_len, args.alphabet]):
+            if res is not None:
+                i = util.progress_report(i)
+
+                (chunks, labels, bad_ev) = res
+
+                writer.append(chunks, labels, bad_ev)
+
+        if writer.nchunk > 0:
+            print('\n* Finalising HDF5')
+            writer.finalise(args.blanks)
+
+    if writer.nchunk == 0:
+        os.remove(args.output)
         print("no chunks were produced", file=sys.stderr)
         sys.exit(1)
-    else:
-        print('\n* Writing out to HDF5')
-        hdf5_attributes = {
-            'chunk': args.chunk_len,
-            'input_type': 'events',
-            'kmer': args.kmer_len,
-            'normalisation': args.normalisation,
-            'scaled': args.use_scaled,
-            'section': args.section,
-            'trim': args.trim,
-            'alphabet': args.alphabet,
-        }
-        util.create_labelled_chunks_hdf5(args.output, args.blanks, hdf5_attributes, chunk_list, label_list, bad_list)
@@ -1,4 +1,5 @@
 import argparse
+from itertools import chain
 import pickle
 import os
 import posixpath
@@ -7,7 +8,7 @@ import time
 import numpy as np
 
 from sloika import fast5
-from sloika.iterators import imap_mp
+from sloika.iterators import grouper_it
 
 from sloika import helpers, batch, util
 
@@ -31,49 +32,51 @@ def chunkify_with_remap_main(args):
 
     kwarg_names = ['trim', 'min_prob', 'kmer_len', 'min_length',
                    'prior', 'slip', 'chunk_len', 'use_scaled', 'normalisation',
-                   'section', 'segmentation']
+                   'section', 'segmentation', 'anchor', 'remap_pad']
     kwargs = util.get_kwargs(args, kwarg_names)
     kwargs['references'] = references
 
+    hdf5_attributes = {
+        'chunk': args.chunk_len,
+        'input_type': 'events',
+        'kmer': args.kmer_len,
+        'normalisation': args.normalisation,
+        'scaled': args.use_scaled,
+        'section': args.section,
+        'trim': args.trim,
+        'alphabet': args.alphabet,
+    }
+
     i = 0
     compiled_file = helpers.compile_model(args.model, args.compile)
     output_strand_list_entries = []
-    bad_list = []
-    chunk_list = []
-    label_list = []
-    with open(args.output_strand_list, 'w') as slfh:
+    with open(args.output_strand_list, 'w') as slfh, \
+            util.chunks_writer(args.output, hdf5_attributes, args.shard_size) as writer:
         slfh.write(u'\t'.join(['filename', 'nev', 'score', 'nstay', 'seqlen', 'start', 'end']) + u'\n')
-        for res in imap_mp(batch.chunk_remap_worker, fast5_files, threads=args.jobs,
-                        fix_kwargs=kwargs, unordered=True, init=batch.init_chunk_remap_worker,
-                        initargs=[compiled_file, args.kmer_len, args.alphabet]):
+        fast5_groups = (list(fns) for fns in grouper_it(fast5_files, args.remap_batch))
+        results = util.imap_chunkify(batch.chunk_remap_batch_worker, fast5_groups, kwargs,
+                                     deterministic=args.deterministic, threads=args.jobs,
+                                     init=batch.init_chunk_remap_worker,
+                                     initargs=[compiled_file, args.kmer_len, args.alphabet])
+        for res in chain.from_iterable(results):
             if res is not None:
                 i = util.progress_report(i)
 
                 read, score, nev, path, seq, chunks, labels, bad_ev = res
 
-                chunk_list.append(chunks)
-                label_list.append(labels)
-                bad_list.append(bad_ev)
+                writer.append(chunks, labels, bad_ev)
                 strand_data = [read, nev, -score / nev, np.sum(np.ediff1d(path, to_begin=1) == 0),
                                len(seq), min(path), max(path)]
                 slfh.write('\t'.join([str(x) for x in strand_data]) + '\n')
 
+        if writer.nchunk > 0:
+            print('\n* Finalising HDF5')
+            writer.finalise(args.blanks)
+
     if compiled_file != args.compile:
         os.remove(compiled_file)
 
-    if chunk_list == []:
+    if writer.nchunk == 0:
+        os.remove(args.output)
         print("no chunks were produced", file=sys.stderr)
         sys.exit(1)
-    else:
-        print('\n* Creating HDF5 file')
-        hdf5_attributes = {
-            'chunk': args.chunk_len,
-            'input_type': 'events',
-            'kmer': args.kmer_len,
-            'normalisation': args.normalisation,
-            'scaled': args.use_scaled,
-            'section': args.section,
-            'trim': args.trim,
-            'alphabet': args.alphabet,
-        }
-        util.create_labelled_chunks_hdf5(args.output, args.blanks, hdf5_attributes, chunk_list, label_list, bad_list)
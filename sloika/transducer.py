@@ -1,9 +1,11 @@
+import bisect
 import numpy as np
 from sloika import viterbi_helpers
 from sloika.config import sloika_dtype
 
 _NEG_LARGE = -50000.0
 _STAY = 0
+_SEED_LEN = 4
 
 
 def argmax(*args):
@@ -189,20 +191,54 @@ def alignment_to_call(trans1, trans2, alignment, rev=True):
     return states
 
 
-def map_to_sequence(trans, sequence, slip=None, prior_initial=None, prior_final=None, log=True):
+def map_to_sequence(trans, sequence, slip=None, prior_initial=None, prior_final=None, log=True,
+                    band=None):
     """  Find Viterbi path through sequence for transducer
 
+    The forwards pass is compiled and releases the GIL, so several mappings
+    may run concurrently in separate threads.
+
     :param trans: A 2D :class:`nd.array` Transducer to be mapped
     :param sequence: A 1D :class:`nd.array` Sequence of bases to be mapped against
     :param slip: slip penalty (in log-space)
     :param prior_initial: A 1D :class:`nd.array` containing prior over initial position
     :param prior_final: A 1D :class:`nd.array` containing prior over final position
     :param log: Transducer is log-scaled
+    :param band: Tuple of 1D :class:`nd.array` containing the first and one
+        past the last position of sequence allowed for each block, e.g. from
+        :func:`anchor_band`, or None to allow all positions
 
     :returns: Tuple containing score for path and array containing path
     """
     assert slip is None or slip >= 0.0, 'Slip penalty should be non-negative'
-    slip = np.float32(slip)
+    ltrans = trans if log else np.log(trans)
+    ltrans = np.ascontiguousarray(ltrans, dtype=sloika_dtype)
+    sequence = np.ascontiguousarray(sequence, dtype=np.int)
+
+    # Initialisation
+    pscore = np.zeros(len(sequence), dtype=sloika_dtype)
+    if prior_initial is not None:
+        pscore += prior_initial
+    pscore += np.fmax(ltrans[0][sequence], ltrans[0][_STAY])
+
+    if band is not None:
+        return _map_to_band(ltrans, sequence, pscore, band, slip, prior_final)
+
+    # Main loop
+    vmat = viterbi_helpers.map_forward(ltrans, sequence, pscore, slip=slip)
+
+    if prior_final is not None:
+        pscore += prior_final
+
+    return _map_traceback(pscore, vmat)
+
+
+def _map_to_sequence_numpy(trans, sequence, slip=None, prior_initial=None, prior_final=None, log=True):
+    """  Reference implementation of :func:`map_to_sequence` using NumPy
+    """
+    assert slip is None or slip >= 0.0, 'Slip penalty should be non-negative'
+    if slip is not None:
+        slip = np.float32(slip)
     nev = len(trans)
     npos = len(sequence)
     ltrans = trans if log else np.log(trans)
@@ -241,7 +277,18 @@ def map_to_sequence(trans, sequence, slip=None, prior_initial=None, prior_final=
     if prior_final is not None:
         pscore += prior_final
 
-    # Viterbi traceback
+    return _map_traceback(pscore, vmat)
+
+
+def _map_traceback(pscore, vmat):
+    """  Viterbi traceback of path through sequence
+
+    :param pscore: A 1D :class:`nd.array` of scores for final position
+    :param vmat: A 2D :class:`nd.array` of traceback pointers
+
+    :returns: Tuple containing score for path and array containing path
+    """
+    nev = len(vmat)
     path = np.empty(nev, dtype=np.int16)
     path[0] = np.argmax(pscore)
     max_score = pscore[path[0]]
@@ -249,3 +296,151 @@ def map_to_sequence(trans, sequence, slip=None, prior_initial=None, prior_final=
         path[i] = vmat[nev - i][path[i - 1]]
 
     return max_score, path[::-1]
+
+
+def _map_to_band(ltrans, sequence, pscore, band, slip, prior_final):
+    """  Viterbi path through sequence for transducer, constrained to a band
+
+    :param ltrans: A 2D :class:`nd.array` Log-scaled transducer to be mapped
+    :param sequence: A 1D :class:`nd.array` of states of sequence
+    :param pscore: A 1D :class:`nd.array` containing initial score for every position
+    :param band, slip, prior_final: see :func:`map_to_sequence`
+
+    :returns: Tuple containing score for path and array containing path
+    """
+    lower = np.ascontiguousarray(band[0], dtype=np.int)
+    upper = np.ascontiguousarray(band[1], dtype=np.int)
+    assert lower[0] >= 0 and upper[-1] <= len(sequence), 'Band outside of sequence'
+    pscore = pscore[lower[0]:upper[0]].copy()
+    pscore, traceback, offset = viterbi_helpers.map_forward_band(ltrans, sequence, pscore,
+                                                                 lower, upper, slip=slip)
+    if prior_final is not None:
+        pscore += prior_final[lower[-1]:upper[-1]]
+
+    nev = len(ltrans)
+    path = np.empty(nev, dtype=np.int)
+    path[-1] = lower[-1] + np.argmax(pscore)
+    max_score = pscore[path[-1] - lower[-1]]
+    for i in range(nev - 1, 0, -1):
+        path[i - 1] = traceback[offset[i] + path[i] - lower[i]]
+
+    return max_score, path
+
+
+def find_anchors(post, sequence, seed_len=_SEED_LEN):
+    """  Find high-confidence matches between a quick call and a sequence
+
+    Runs of `seed_len` consecutive kmers in the argmax call of a transducer
+    are matched against the sequence.  Only runs that occur exactly once in
+    both the call and the sequence are kept and the matches are then chained
+    so both blocks and positions are strictly increasing.
+
+    :param post: A 2D :class:`nd.array` Transducer, stay first
+    :param sequence: A 1D :class:`nd.array` of states of sequence
+    :param seed_len: Number of consecutive kmers to match
+
+    :returns: Tuple of 1D :class:`nd.array` containing blocks and positions of anchors
+    """
+    sequence = np.asarray(sequence)
+    state = np.argmax(post, axis=1)
+    blocks = np.flatnonzero(state != _STAY)
+    call = state[blocks]
+    nref = len(sequence) - seed_len + 1
+    ncall = len(call) - seed_len + 1
+    if nref < 1 or ncall < 1:
+        return np.zeros(0, dtype=np.int), np.zeros(0, dtype=np.int)
+
+    seeds = np.concatenate((_windows(sequence.astype(np.int), seed_len),
+                            _windows(call.astype(np.int), seed_len)))
+    _, seed_id = np.unique(seeds, return_inverse=True)
+    ref_id = seed_id[:nref]
+    call_id = seed_id[nref:]
+    nseed = np.amax(seed_id) + 1
+    unique = (np.bincount(ref_id, minlength=nseed) == 1) & (np.bincount(call_id, minlength=nseed) == 1)
+    seed_pos = np.zeros(nseed, dtype=np.int)
+    seed_pos[ref_id] = np.arange(nref)
+
+    matched = np.flatnonzero(unique[call_id])
+    return _chain_anchors(blocks[matched], seed_pos[call_id[matched]])
+
+
+def _windows(x, n):
+    """  Sliding windows of a 1D array, each viewed as a single opaque item
+
+    :param x: A contiguous 1D :class:`nd.array`
+    :param n: Length of window
+
+    :returns: A 1D :class:`nd.array` of void items, one per window
+    """
+    x = np.ascontiguousarray(x)
+    nwin = len(x) - n + 1
+    win = np.lib.stride_tricks.as_strided(x, shape=(nwin, n), strides=(x.strides[0], x.strides[0]))
+    win = np.ascontiguousarray(win)
+    return win.view(np.dtype((np.void, x.itemsize * n))).ravel()
+
+
+def _chain_anchors(blocks, positions):
+    """  Longest chain of anchors with strictly increasing positions
+
+    :param blocks: A 1D :class:`nd.array` of strictly increasing blocks
+    :param positions: A 1D :class:`nd.array` of positions
+
+    :returns: Tuple of 1D :class:`nd.array` containing blocks and positions of chain
+    """
+    #  Patience sorting: tails[n] is the index of the anchor ending the
+    #  chain of length n + 1 with the smallest final position
+    tails = []
+    tail_pos = []
+    back = np.empty(len(positions), dtype=np.int)
+    for i, pos in enumerate(positions):
+        length = bisect.bisect_left(tail_pos, pos)
+        back[i] = tails[length - 1] if length > 0 else -1
+        if length == len(tails):
+            tails.append(i)
+            tail_pos.append(pos)
+        else:
+            tails[length] = i
+            tail_pos[length] = pos
+
+    chain = []
+    i = tails[-1] if tails else -1
+    while i >= 0:
+        chain.append(i)
+        i = back[i]
+    chain = np.array(chain[::-1], dtype=np.int)
+    return blocks[chain], positions[chain]
+
+
+def anchor_band(post, sequence, width, seed_len=_SEED_LEN):
+    """  Band of positions for mapping transducer, spanning consecutive anchors
+
+    Each block is allowed to map to positions from `width` before the
+    previous anchor to `width` after the next anchor.  Blocks before the
+    first anchor and after the last are allowed to map to the ends of the
+    sequence.
+
+    :param post: A 2D :class:`nd.array` Transducer, stay first
+    :param sequence: A 1D :class:`nd.array` of states of sequence
+    :param width: Number of positions either side of anchors to allow
+    :param seed_len: Number of consecutive kmers in seed (see :func:`find_anchors`)
+
+    :returns: Tuple of 1D :class:`nd.array` containing the first and one past
+        the last position allowed for each block, suitable for the `band`
+        argument of :func:`map_to_sequence`
+    """
+    nev = len(post)
+    npos = len(sequence)
+    blocks, positions = find_anchors(post, sequence, seed_len=seed_len)
+
+    #  Index of previous and next anchor for each block
+    iprev = np.searchsorted(blocks, np.arange(nev), side='right') - 1
+    inext = np.searchsorted(blocks, np.arange(nev), side='left')
+    lower = np.zeros(nev, dtype=np.int)
+    upper = np.empty(nev, dtype=np.int)
+    upper.fill(npos)
+    has_prev = iprev >= 0
+    has_next = inext < len(blocks)
+    lower[has_prev] = np.maximum(positions[iprev[has_prev]] - width, 0)
+    upper[has_next] = np.minimum(positions[inext[has_next]] + width + 1, npos)
+
+    return lower, upper
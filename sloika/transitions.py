@@ -0,0 +1,84 @@
+from functools import lru_cache
+import numpy as np
+
+from sloika.variables import DEFAULT_NBASE, nkmer
+
+
+class KmerTransitions(object):
+    """  Predecessors of kmers under step and skip moves
+
+    Kmers are indexed with the first base most significant, so the kmers
+    reachable from a given kmer by a move are contiguous and groups of
+    contiguous kmers share the same predecessors.  Row `i` of `step_from`
+    contains the kmers that step to each of `i * nstep, ..., (i + 1) * nstep - 1`
+    and row `i` of `skip_from` those that skip to each of
+    `i * nskip, ..., (i + 1) * nskip - 1`.
+
+    Instances are shared between decoders and so the tables are read-only;
+    use :func:`kmer_transitions` to obtain one.
+
+    :param kmer: Length of kmer
+    :param nbase: Number of letters in alphabet
+    """
+
+    def __init__(self, kmer, nbase=DEFAULT_NBASE):
+        assert kmer >= 2, "Kmer not long enough to skip"
+        self.kmer = kmer
+        self.nbase = nbase
+        self.nkmer = nkmer(kmer, nbase=nbase)
+        self.nstep = nbase
+        self.nskip = nbase * nbase
+        self.step_from = self._predecessors(self.nstep)
+        self.skip_from = self._predecessors(self.nskip)
+
+    def predecessor(self, kmer, move):
+        """  Kmers preceding given kmers by encoded moves
+
+        Moves are encoded as zero for a stay, `1 + j` for a step from column
+        `j` of `step_from` and `1 + nstep + j` for a skip from column `j` of
+        `skip_from`.
+
+        :param kmer: An :class:`ndarray` or integer of kmers
+        :param move: An :class:`ndarray` or integer of encoded moves into
+            each kmer
+
+        :returns: An :class:`ndarray` of preceding kmers, -1 for stays
+        """
+        kmer = np.asarray(kmer)
+        move = np.asarray(move, dtype=np.int)
+        step = self.step_from[kmer // self.nstep, np.clip(move - 1, 0, self.nstep - 1)]
+        skip = self.skip_from[kmer // self.nskip, np.clip(move - 1 - self.nstep, 0, self.nskip - 1)]
+        return np.where(move == 0, -1, np.where(move <= self.nstep, step, skip))
+
+    def _predecessors(self, nmove):
+        nrem = self.nkmer // nmove
+        pred = np.arange(nrem).reshape((-1, 1)) + nrem * np.arange(nmove)
+        pred.flags.writeable = False
+        return pred
+
+
+@lru_cache(maxsize=None)
+def kmer_transitions(kmer, nbase=DEFAULT_NBASE):
+    """  Cached transition structure for kmers
+
+    :param kmer: Length of kmer
+    :param nbase: Number of letters in alphabet
+
+    :returns: A :class:`KmerTransitions`
+    """
+    return KmerTransitions(kmer, nbase=nbase)
+
+
+def best_predecessor(score, pred):
+    """  Best scoring predecessor for each group of kmers
+
+    :param score: An :class:`ndarray` of scores, last axis indexed by kmer
+    :param pred: A 2D :class:`ndarray` of predecessors, e.g. `step_from` of
+        a :class:`KmerTransitions`
+
+    :returns: A tuple containing the best score and the kmer attaining it
+        for each row of `pred`
+    """
+    pscore = score[..., pred]
+    imax = np.argmax(pscore, axis=-1)
+    return np.amax(pscore, axis=-1), pred[np.arange(len(pred)), imax]
@@ -1,9 +1,13 @@
 from Bio import SeqIO
 import h5py
+import hashlib
+import json
 import numpy as np
 import os
 import sys
 
+from sloika.iterators import imap_mp, imap_mp_reorder
+
 
 def is_close(a, b, rel_tol=1e-09, abs_tol=0.0):
     return abs(a - b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
@@ -49,6 +53,405 @@ def progress_report(i):
     return i
 
 
+class LabelledChunksWriter(object):
+    """ Incrementally written hdf5 batch file of labelled chunks
+
+    Datasets are created resizable and extended as each set of chunks
+    arrives, flushing the file after each, so memory use does not grow with
+    the size of the output and an interrupted run leaves a usable file.
+    Weights depend on the proportion of blanks over all chunks and so are
+    only written when the file is finalised.  Datasets are created without
+    timestamps so identical chunks give byte-identical files.
+
+    :param output: name of hdf5 file to create
+    :param attributes: dictionary of attributes for root of file
+    """
+
+    def __init__(self, output, attributes):
+        output_dir = os.path.dirname(output)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(os.path.normpath(output_dir))
+
+        self.h5 = h5py.File(output, 'w')
+        for (key, value) in attributes.items():
+            self.h5['/'].attrs[key] = value
+        self.nchunk = 0
+        self.nblank = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+    def _append(self, name, x, dtype):
+        if name not in self.h5:
+            self.h5.create_dataset(name, (0,) + x.shape[1:], dtype=dtype, maxshape=(None,) + x.shape[1:],
+                                   chunks=True, compression="gzip", track_times=False)
+        ds = self.h5[name]
+        ds.resize(self.nchunk + len(x), axis=0)
+        ds[self.nchunk:] = x
+
+    def append(self, chunks, labels, bad):
+        """ Append chunks to file
+
+        :param chunks: event features
+        :param labels: state labels corresponding to chunks
+        :param bad: bad state masks corresponding to chunks
+        """
+        assert len(chunks) == len(labels) == len(bad)
+        if len(chunks) == 0:
+            return
+        self._append('bad', bad, 'i1')
+        self._append('chunks', chunks, 'f4')
+        self._append('labels', labels, 'i4')
+        self.nchunk += len(chunks)
+        self.nblank.append(np.sum(labels == 0, axis=1))
+        self.h5.flush()
+
+    @property
+    def blank_fraction(self):
+        """ Proportion of each chunk written that is blank
+        """
+        return np.concatenate(self.nblank) / self.h5['labels'].shape[1]
+
+    def finalise(self, blanks):
+        """ Write weights, marking chunks with too many blanks with a zero weight
+
+        :param blanks: maximum proportion of blanks allowed in a chunk
+        """
+        assert self.nchunk > 0
+        _write_weights(self.h5, np.concatenate(self.nblank), blanks)
+
+
+def _write_weights(h5, nblank, blanks):
+    max_blanks = int(h5['labels'].shape[1] * blanks)
+    weight_ds = h5.create_dataset('weights', nblank.shape, dtype='f4', compression="gzip", track_times=False)
+    weight_ds[:] = nblank < max_blanks
+
+
+class ShardedChunksWriter(object):
+    """ Incrementally written shards of labelled chunks, with a manifest
+
+    Chunks are written to a series of hdf5 files, each as from
+    :class:`LabelledChunksWriter`, starting a new shard once the current one
+    holds at least `shard_size` chunks.  The manifest is a json file
+    recording the path of each shard relative to the manifest, the number of
+    chunks it holds, and the attributes shared by all shards.  It is
+    written on creation and rewritten as each shard is completed.
+
+    :param output: name of manifest file to create; shards are named after it
+    :param attributes: dictionary of attributes for root of each shard
+    :param shard_size: number of chunks after which to start a new shard
+    """
+
+    def __init__(self, output, attributes, shard_size):
+        assert shard_size > 0
+        self.output = output
+        self.attributes = attributes
+        self.shard_size = shard_size
+        self.shards = []
+        self.writer = None
+        self.nchunk = 0
+        self.nblank = []
+        self.label_len = None
+        self._write_manifest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _shard_name(self, i):
+        return '{}_{:05d}.hdf5'.format(os.path.splitext(self.output)[0], i)
+
+    def _close_shard(self):
+        if self.writer is not None:
+            self.shards.append((self.writer.h5.filename, self.writer.nchunk))
+            self.nblank.append(np.concatenate(self.writer.nblank))
+            self.writer.close()
+            self.writer = None
+            self._write_manifest()
+
+    def _write_manifest(self):
+        output_dir = os.path.dirname(os.path.abspath(self.output))
+        manifest = {'attributes': {k: _json_value(v) for k, v in self.attributes.items()},
+                    'shards': [{'path': os.path.relpath(path, output_dir), 'nchunk': n}
+                               for path, n in self.shards]}
+        with open(self.output, 'w') as fh:
+            json.dump(manifest, fh, indent=4, sort_keys=True)
+
+    def close(self):
+        self._close_shard()
+
+    def append(self, chunks, labels, bad):
+        """ Append chunks to current shard, see :meth:`LabelledChunksWriter.append`
+        """
+        if len(chunks) == 0:
+            return
+        if self.writer is None:
+            self.writer = LabelledChunksWriter(self._shard_name(len(self.shards)), self.attributes)
+        self.writer.append(chunks, labels, bad)
+        self.nchunk += len(chunks)
+        self.label_len = labels.shape[1]
+        if self.writer.nchunk >= self.shard_size:
+            self._close_shard()
+
+    @property
+    def blank_fraction(self):
+        """ Proportion of each chunk written that is blank
+        """
+        nblank = self.nblank + ([np.concatenate(self.writer.nblank)] if self.writer is not None else [])
+        return np.concatenate(nblank) / self.label_len
+
+    def finalise(self, blanks):
+        """ Write weights of every shard, see :meth:`LabelledChunksWriter.finalise`
+        """
+        assert self.nchunk > 0
+        self._close_shard()
+        for (path, _), nblank in zip(self.shards, self.nblank):
+            with h5py.File(path, 'r+') as h5:
+                _write_weights(h5, nblank, blanks)
+
+
+def chunks_writer(output, attributes, shard_size=None):
+    """ Writer for labelled chunks
+
+    :param output: name of hdf5 file, or of manifest if sharded
+    :param attributes: dictionary of attributes for root of hdf5 file(s)
+    :param shard_size: number of chunks per shard or None for a single file
+
+    :returns: a :class:`LabelledChunksWriter` or :class:`ShardedChunksWriter`
+    """
+    if shard_size is None:
+        return LabelledChunksWriter(output, attributes)
+    return ShardedChunksWriter(output, attributes, shard_size)
+
+
+def _json_value(x):
+    if isinstance(x, bytes):
+        return x.decode('ascii')
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, (tuple, list)):
+        return [_json_value(y) for y in x]
+    return x
+
+
+def chunk_files(fname):
+    """ HDF5 files containing labelled chunks
+
+    :param fname: name of hdf5 file or of manifest of shards, as written by
+        :class:`ShardedChunksWriter`
+
+    :returns: list of names of hdf5 files
+    """
+    if h5py.is_hdf5(fname):
+        return [fname]
+    with open(fname, 'r') as fh:
+        manifest = json.load(fh)
+    manifest_dir = os.path.dirname(os.path.abspath(fname))
+    return [os.path.join(manifest_dir, shard['path']) for shard in manifest['shards']]
+
+
+def read_chunks(fname, names):
+    """ Read datasets of labelled chunks from hdf5 file or shards
+
+    :param fname: name of hdf5 file or manifest, see :func:`chunk_files`
+    :param names: names of datasets to read
+
+    :returns: list of :class:`ndarray`, one for each dataset concatenated
+        over all shards
+    """
+    res = [[] for _ in names]
+    for shard in chunk_files(fname):
+        with h5py.File(shard, 'r') as h5:
+            for r, name in zip(res, names):
+                r.append(h5[name][:])
+    return [r[0] if len(r) == 1 else np.concatenate(r) for r in res]
+
+
+def chunk_attributes(fname):
+    """ Attributes of labelled chunks in hdf5 file or shards
+
+    :param fname: name of hdf5 file or manifest, see :func:`chunk_files`
+
+    :returns: dictionary of attributes
+    """
+    with h5py.File(chunk_files(fname)[0], 'r') as h5:
+        return dict(h5.attrs.items())
+
+
+def _digest(x):
+    return hashlib.sha1(json.dumps(_json_value(x), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ChunkCache(object):
+    """ On-disk cache of the labelled chunks produced from each read
+
+    Entries are keyed by the path, modification time and size of the read's
+    file and grouped by the parameters used to produce them, so a read that
+    has changed or a change of parameters results in the read being
+    processed afresh.  Reads that produced no chunks are also cached, but
+    not reads that failed to be processed.  Each entry is written under a
+    temporary name and then renamed, so an interrupted write leaves no entry.
+
+    :param fname: name of hdf5 file to cache in, created if absent
+    :param params: dictionary of parameters determining the chunks produced
+    """
+
+    def __init__(self, fname, params):
+        self.h5 = h5py.File(fname, 'a')
+        self.group = self.h5.require_group(_digest(params))
+        self.group.attrs['params'] = json.dumps(_json_value(params), sort_keys=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.h5.close()
+
+    def _key(self, fn):
+        st = os.stat(fn)
+        return _digest([os.path.abspath(fn), st.st_mtime_ns, st.st_size])
+
+    def __contains__(self, fn):
+        key = self._key(fn)
+        return key in self.group and 'chunks' in self.group[key]
+
+    def get(self, fn):
+        """ Cached result for read
+
+        :param fn: name of file read was processed from
+
+        :returns: tuple of chunks, labels and bad, which may contain no chunks
+        """
+        entry = self.group[self._key(fn)]
+        return entry['chunks'][:], entry['labels'][:], entry['bad'][:]
+
+    def put(self, fn, res):
+        """ Cache result for read
+
+        :param fn: name of file read was processed from
+        :param res: tuple of chunks, labels and bad, which may contain no chunks
+        """
+        key = self._key(fn)
+        tmp_key = key + '.tmp'
+        if tmp_key in self.group:
+            del self.group[tmp_key]
+        entry = self.group.create_group(tmp_key)
+        for name, x in zip(['chunks', 'labels', 'bad'], res):
+            entry.create_dataset(name, data=x, compression='gzip' if len(x) > 0 else None)
+        if key in self.group:
+            del self.group[key]
+        self.group.move(tmp_key, key)
+        self.h5.flush()
+
+
+def empty_chunks(chunk_len, nfeature):
+    """ Result of chunking a read that produced no chunks
+
+    Chunking workers return this where a read is unsuitable, e.g. too short,
+    and None where it could not be processed, so only the former is cached
+    by :func:`imap_cached`.
+
+    :param chunk_len: length of each chunk
+    :param nfeature: number of features of chunks
+
+    :returns: tuple of chunks, labels and bad, containing no chunks
+    """
+    return (np.zeros((0, chunk_len, nfeature), dtype=np.float32),
+            np.zeros((0, chunk_len), dtype=np.int32),
+            np.zeros((0, chunk_len), dtype=bool))
+
+
+def _apply_keyed(fn, function, kwargs):
+    return fn, function(fn, **kwargs)
+
+
+def imap_chunkify(function, fnames, fix_kwargs, deterministic=False, **kwargs):
+    """ Map chunking function over files using multiple processes
+
+    :param function: function taking file name and `fix_kwargs`
+    :param fnames: iterable of file names
+    :param fix_kwargs: keyword arguments to hold fixed
+    :param deterministic: yield results in order of files, through a bounded
+        reorder buffer, rather than as they are completed
+    :param kwargs: further arguments for :func:`imap_mp`, e.g. `threads`
+
+    :yields: results of function
+    """
+    if deterministic:
+        return imap_mp_reorder(function, fnames, fix_kwargs=fix_kwargs, **kwargs)
+    return imap_mp(function, fnames, fix_kwargs=fix_kwargs, unordered=True, **kwargs)
+
+
+def _no_chunks_as_none(res):
+    return None if res is None or len(res[0]) == 0 else res
+
+
+def imap_cached(cache, params, function, fnames, fix_kwargs, deterministic=False, **kwargs):
+    """ Map chunking function over files, reusing results cached by earlier runs
+
+    Only results containing chunks, or containing no chunks, are cached;
+    failures, indicated by None, are retried on the next run.
+
+    :param cache: name of hdf5 file for :class:`ChunkCache` or None for no caching
+    :param params: dictionary of parameters determining the chunks produced
+    :param function: function taking file name and `fix_kwargs`, returning
+        tuple of chunks, labels and bad, which may contain no chunks, or None
+        if the file could not be processed
+    :param fnames: iterable of file names
+    :param fix_kwargs: keyword arguments to hold fixed
+    :param deterministic: yield results in order of files, see
+        :func:`imap_chunkify`; otherwise those found in cache are first
+    :param kwargs: further arguments for :func:`imap_mp`
+
+    :yields: results of function, with None for those containing no chunks
+    """
+    if cache is None:
+        for res in imap_chunkify(function, fnames, fix_kwargs, deterministic=deterministic, **kwargs):
+            yield _no_chunks_as_none(res)
+        return
+
+    with ChunkCache(cache, params) as chunk_cache:
+        fnames = list(fnames)
+        is_cached = [fn in chunk_cache for fn in fnames]
+        todo = [fn for fn, hit in zip(fnames, is_cached) if not hit]
+        sys.stderr.write('* Processing {} reads not in cache\n'.format(len(todo)))
+        if not deterministic:
+            for fn, hit in zip(fnames, is_cached):
+                if hit:
+                    yield _no_chunks_as_none(chunk_cache.get(fn))
+
+        results = imap_chunkify(_apply_keyed, todo, {'function': function, 'kwargs': fix_kwargs},
+                                deterministic=deterministic, **kwargs)
+        if deterministic:
+            #  Results of files not in cache are in order, so interleave
+            for fn, hit in zip(fnames, is_cached):
+                if hit:
+                    yield _no_chunks_as_none(chunk_cache.get(fn))
+                else:
+                    fn, res = next(results)
+                    if res is not None:
+                        chunk_cache.put(fn, res)
+                    yield _no_chunks_as_none(res)
+        else:
+            for fn, res in results:
+                if res is not None:
+                    chunk_cache.put(fn, res)
+                yield _no_chunks_as_none(res)
+
+
 def create_labelled_chunks_hdf5(output, blanks, attributes, chunk_list, label_list, bad_list):
     """ Helper function for chunkify to create hdf5 batch file
 
@@ -60,35 +463,10 @@ def create_labelled_chunks_hdf5(output, blanks, attributes, chunk_list, label_li
     assert len(chunk_list) == len(label_list) == len(bad_list)
     assert len(chunk_list) > 0
 
-    output_dir = os.path.dirname(output)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(os.path.normpath(output_dir))
-
-    all_chunks = np.concatenate(chunk_list)
-    all_labels = np.concatenate(label_list)
-    all_bad = np.concatenate(bad_list)
-
-    #  Mark chunks with too many blanks with a zero weight
-    nblank = np.sum(all_labels == 0, axis=1)
-    max_blanks = int(all_labels.shape[1] * blanks)
-    all_weights = nblank < max_blanks
-
-    with h5py.File(output, 'w') as h5:
-        bad_ds = h5.create_dataset('bad', all_bad.shape, dtype='i1',
-                                   compression="gzip")
-        chunk_ds = h5.create_dataset('chunks', all_chunks.shape, dtype='f4',
-                                     compression="gzip")
-        label_ds = h5.create_dataset('labels', all_labels.shape, dtype='i4',
-                                     compression="gzip")
-        weight_ds = h5.create_dataset('weights', all_weights.shape, dtype='f4',
-                                      compression="gzip")
-        bad_ds[:] = all_bad
-        chunk_ds[:] = all_chunks
-        label_ds[:] = all_labels
-        weight_ds[:] = all_weights
-
-        for (key, value) in attributes.items():
-            h5['/'].attrs[key] = value
+    with LabelledChunksWriter(output, attributes) as writer:
+        for chunks, labels, bad in zip(chunk_list, label_list, bad_list):
+            writer.append(chunks, labels, bad)
+        writer.finalise(blanks)
 
 
 def trim_array(x, from_start, from_end):
@@ -1,6 +1,7 @@
 import  numpy as np
 cimport numpy as np
 cimport cython
+from cython cimport floating
 
 DTYPE = np.float32
 ctypedef np.float32_t DTYPE_t
@@ -9,21 +10,17 @@ ctypedef np.int_t ITYPE_t
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-def slip_update(np.ndarray[DTYPE_t, ndim=1] x, DTYPE_t slip):
-    """  Efficiently compute the score for a geometric slip
-    :param x: A 1D :class:`nd.array`
-    :param slip: Slip penalty (in log-space)
-
-    :returns: A tuple containing the score for each move and where it came from
-    """
-    cdef int j
-    cdef np.ndarray[DTYPE_t, ndim=1] from_score = np.zeros(len(x), dtype=DTYPE)
-    cdef np.ndarray[ITYPE_t, ndim=1] from_pos = np.zeros(len(x), dtype=ITYPE)
+cdef void _slip_update(floating[:] x, floating slip, floating[:] from_score, ITYPE_t[:] from_pos) nogil:
+    cdef Py_ssize_t j
+    cdef Py_ssize_t n = x.shape[0]
 
-    from_score[0] = from_score[1] = -1e38
+    for j in range(min(n, 2)):
+        from_score[j] = -1e38
+    if n < 3:
+        return
     from_score[2] = x[0] - slip
     from_pos[2] = 0
-    for j in range(3, len(x)):
+    for j in range(3, n):
         if from_score[j - 1] >= x[j - 2]:
             from_pos[j] = from_pos[j - 1]
             from_score[j] = from_score[j - 1]
@@ -32,4 +29,490 @@ def slip_update(np.ndarray[DTYPE_t, ndim=1] x, DTYPE_t slip):
             from_score[j] = x[j - 2]
         from_score[j] -= slip
 
+
+def slip_update(floating[:] x, double slip):
+    """  Efficiently compute the score for a geometric slip
+
+    The GIL is released during the computation.
+    :param x: A 1D :class:`nd.array`
+    :param slip: Slip penalty (in log-space)
+
+    :returns: A tuple containing the score for each move and where it came from
+    """
+    dtype = np.float32 if floating is float else np.float64
+    from_score = np.zeros(x.shape[0], dtype=dtype)
+    from_pos = np.zeros(x.shape[0], dtype=ITYPE)
+    cdef floating[:] sv = from_score
+    cdef ITYPE_t[:] pv = from_pos
+
+    with nogil:
+        _slip_update(x, <floating>slip, sv, pv)
+
     return from_score, from_pos
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _best_predecessor(floating[:] pscore, const ITYPE_t[:, :] pred,
+                            floating[:] best, np.uint8_t[:] best_from) nogil:
+    cdef Py_ssize_t i, j
+    cdef ITYPE_t k
+
+    for i in range(pred.shape[0]):
+        best[i] = pscore[pred[i, 0]]
+        best_from[i] = 0
+        for j in range(1, pred.shape[1]):
+            k = pred[i, j]
+            if pscore[k] > best[i]:
+                best[i] = pscore[k]
+                best_from[i] = j
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _viterbi_update(floating[:] pscore, floating[:] lpost, const ITYPE_t[:, :] step_from,
+                          const ITYPE_t[:, :] skip_from, floating skip_pen,
+                          floating[:] best_step, np.uint8_t[:] from_step,
+                          floating[:] best_skip, np.uint8_t[:] from_skip,
+                          floating[:] vscore, np.uint8_t[:] traceback) nogil:
+    cdef Py_ssize_t i
+    cdef Py_ssize_t nkmer = pscore.shape[0]
+    cdef Py_ssize_t nstep = step_from.shape[1]
+    cdef Py_ssize_t nskip = skip_from.shape[1]
+    cdef floating score, score_skip, score_stay
+    cdef np.uint8_t tb
+
+    #  Best predecessor by step or skip for each destination
+    _best_predecessor(pscore, step_from, best_step, from_step)
+    _best_predecessor(pscore, skip_from, best_skip, from_skip)
+
+    for i in range(nkmer):
+        score = best_step[i // nstep]
+        tb = 1 + from_step[i // nstep]
+        score_skip = best_skip[i // nskip] - skip_pen
+        if not score > score_skip:
+            score = score_skip
+            tb = 1 + nstep + from_skip[i // nskip]
+        score = lpost[i + 1] + score
+        #  Stay -- move code zero
+        score_stay = pscore[i] + lpost[0]
+        if score > score_stay:
+            vscore[i] = score
+            traceback[i] = tb
+        else:
+            vscore[i] = score_stay
+            traceback[i] = 0
+
+
+def viterbi_forward(floating[:, :] lpost, const ITYPE_t[:, :] step_from, const ITYPE_t[:, :] skip_from,
+                    double skip_pen, floating[:] init=None):
+    """  Forwards pass of Viterbi for kmer transducer
+
+    Rather than the kmer each path came from, the traceback records the
+    move taken as a single byte: zero for a stay, `1 + j` for a step from
+    column `j` of `step_from` and `1 + nstep + j` for a skip from column `j`
+    of `skip_from` (see :meth:`sloika.transitions.KmerTransitions.predecessor`).
+    The GIL is released during the computation.
+    :param lpost: A 2D :class:`nd.array` of log posteriors, stay first
+    :param step_from: A 2D :class:`nd.array` of predecessors by step of
+        each group of kmers (see :class:`sloika.transitions.KmerTransitions`)
+    :param skip_from: A 2D :class:`nd.array` of predecessors by skip
+    :param skip_pen: Penalty for skips (in log-space)
+    :param init: A 1D :class:`nd.array` of scores for kmers before the first
+        block, or None to start from the first block
+
+    :returns: A tuple containing scores for kmers at final block and
+        traceback of moves into each block; if `init` is None, the first
+        row of traceback is not set.
+    """
+    cdef Py_ssize_t i, start
+    cdef Py_ssize_t nev = lpost.shape[0]
+    cdef Py_ssize_t nkmer = lpost.shape[1] - 1
+    assert nev > 0, 'Posterior is empty'
+    cdef Py_ssize_t nstep = step_from.shape[1]
+    cdef Py_ssize_t nskip = skip_from.shape[1]
+    assert step_from.shape[0] * nstep == nkmer, 'Step table does not match number of kmers'
+    assert skip_from.shape[0] * nskip == nkmer, 'Skip table does not match number of kmers'
+    assert nstep + nskip < 256, 'Too many moves to encode in traceback'
+    assert init is None or init.shape[0] == nkmer, 'Initial scores do not match number of kmers'
+    dtype = np.float32 if floating is float else np.float64
+
+    vscore = np.empty((2, nkmer), dtype=dtype)
+    traceback = np.empty((nev, nkmer), dtype=np.uint8)
+    cdef floating[:, :] vv = vscore
+    cdef np.uint8_t[:, :] tv = traceback
+    cdef floating[:] best_step = np.empty(nkmer // nstep, dtype=dtype)
+    cdef floating[:] best_skip = np.empty(nkmer // nskip, dtype=dtype)
+    cdef np.uint8_t[:] from_step = np.empty(nkmer // nstep, dtype=np.uint8)
+    cdef np.uint8_t[:] from_skip = np.empty(nkmer // nskip, dtype=np.uint8)
+    cdef bint has_init = init is not None
+
+    with nogil:
+        if has_init:
+            start = 0
+            vv[1, :] = init
+        else:
+            start = 1
+            vv[0, :] = lpost[0, 1:]
+        for i in range(start, nev):
+            _viterbi_update(vv[(i - 1) % 2], lpost[i], step_from, skip_from, <floating>skip_pen,
+                            best_step, from_step, best_skip, from_skip, vv[i % 2], tv[i])
+
+    return vscore[(nev - 1) % 2], traceback
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def map_forward(floating[:, :] ltrans, ITYPE_t[:] sequence, floating[:] pscore, slip=None):
+    """  Forwards pass of Viterbi mapping of transducer to sequence
+
+    Stay, step and slip are considered in a single sweep over the sequence
+    for each block, updating the scores in place.  The GIL is released
+    during the computation.
+    :param ltrans: A 2D :class:`nd.array` of log-scaled transducer, stay first
+    :param sequence: A 1D :class:`nd.array` of states of sequence
+    :param pscore: A 1D :class:`nd.array` containing scores for initial
+        position, updated in place to scores for the final position
+    :param slip: slip penalty (in log-space) or None for no slips
+
+    :returns: traceback of path through sequence
+    """
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nev = ltrans.shape[0]
+    cdef Py_ssize_t npos = sequence.shape[0]
+    cdef floating score, best, prev1, prev2, cur, run_score
+    cdef ITYPE_t best_from, run_from
+    cdef bint use_slip = slip is not None
+    cdef floating fslip = slip if use_slip else 0.0
+    assert pscore.shape[0] == npos, 'Initial scores and sequence have different lengths'
+
+    vmat = np.zeros((nev, npos), dtype=np.int16)
+    cdef np.int16_t[:, :] vv = vmat
+
+    with nogil:
+        for i in range(1, nev):
+            #  Scores of previous block at j - 1 and j - 2, overwritten in place
+            prev1 = pscore[0]
+            prev2 = -1e38
+            run_score = -1e38
+            run_from = 0
+            pscore[0] = prev1 + ltrans[i, 0]
+            vv[i, 0] = 0
+            for j in range(1, npos):
+                cur = pscore[j]
+                # Stay
+                best = cur + ltrans[i, 0]
+                best_from = j
+                # Step
+                score = prev1 + ltrans[i, sequence[j]]
+                if score > best:
+                    best = score
+                    best_from = j - 1
+                # Slip from anywhere at least two positions back
+                if use_slip and j >= 2:
+                    if run_score < prev2:
+                        run_score = prev2
+                        run_from = j - 2
+                    run_score -= fslip
+                    score = run_score + ltrans[i, sequence[j]]
+                    if score > best:
+                        best = score
+                        best_from = run_from
+                pscore[j] = best
+                vv[i, j] = best_from
+                prev2 = prev1
+                prev1 = cur
+
+    return vmat
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def forward_scan(np.ndarray[np.float64_t, ndim=1] x, np.ndarray[np.float64_t, ndim=1] a):
+    """  In-place first order linear recurrence, running forwards
+
+    Computes x[i + 1] += a[i] * x[i] for i = 0, ..., len(a) - 1
+    :param x: A 1D :class:`nd.array` of length at least len(a) + 1
+    :param a: A 1D :class:`nd.array` of multipliers
+
+    :returns: x, modified in place
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = a.shape[0]
+    assert x.shape[0] > n, 'Array too short for recurrence'
+    for i in range(n):
+        x[i + 1] += a[i] * x[i]
+    return x
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def backward_scan(np.ndarray[np.float64_t, ndim=1] x, np.ndarray[np.float64_t, ndim=1] a):
+    """  In-place first order linear recurrence, running backwards
+
+    Computes x[i] += a[i] * x[i + 1] for i = len(a) - 1, ..., 0
+    :param x: A 1D :class:`nd.array` of length at least len(a) + 1
+    :param a: A 1D :class:`nd.array` of multipliers
+
+    :returns: x, modified in place
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = a.shape[0]
+    assert x.shape[0] > n, 'Array too short for recurrence'
+    for i in range(n - 1, -1, -1):
+        x[i] += a[i] * x[i + 1]
+    return x
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def map_forward_band(floating[:, :] ltrans, ITYPE_t[:] sequence, floating[:] pscore,
+                     ITYPE_t[:] lower, ITYPE_t[:] upper, slip=None):
+    """  Forwards pass of Viterbi mapping of transducer to a band of sequence
+
+    Only positions `lower[i], ..., upper[i] - 1` of the sequence are
+    considered for block `i`.  The bounds should be non-decreasing.  The
+    GIL is released during the computation.
+    :param ltrans: A 2D :class:`nd.array` of log-scaled transducer, stay first
+    :param sequence: A 1D :class:`nd.array` of states of sequence
+    :param pscore: A 1D :class:`nd.array` containing scores for the band
+        of the first block
+    :param lower: A 1D :class:`nd.array` of first position in band of each block
+    :param upper: A 1D :class:`nd.array` of one past last position in band
+    :param slip: slip penalty (in log-space) or None for no slips
+
+    :returns: A tuple containing scores for the band of the final block,
+        traceback for each band concatenated and the offset of each band
+    """
+    cdef Py_ssize_t i, j, p, lo, hi, plo, phi
+    cdef Py_ssize_t nev = ltrans.shape[0]
+    cdef floating score, best, run_score
+    cdef ITYPE_t best_from, run_from
+    cdef bint use_slip = slip is not None
+    cdef floating fslip = slip if use_slip else 0.0
+    assert lower.shape[0] == nev and upper.shape[0] == nev, 'Band and transducer have different lengths'
+    assert pscore.shape[0] == upper[0] - lower[0], 'Initial scores do not match band'
+    dtype = np.float32 if floating is float else np.float64
+
+    width = np.subtract(upper, lower)
+    assert np.all(width > 0), 'Band is empty'
+    assert np.all(np.diff(lower) >= 0) and np.all(np.diff(upper) >= 0), 'Band is not monotone'
+    offset = np.zeros(nev + 1, dtype=ITYPE)
+    np.cumsum(width, out=offset[1:])
+    traceback = np.zeros(offset[nev], dtype=np.int32)
+    scores = np.empty((2, np.amax(width)), dtype=dtype)
+    cdef ITYPE_t[:] ov = offset
+    cdef np.int32_t[:] tv = traceback
+    cdef floating[:, :] sv = scores
+    sv[0, :pscore.shape[0]] = pscore
+
+    with nogil:
+        for i in range(1, nev):
+            plo = lower[i - 1]
+            phi = upper[i - 1]
+            lo = lower[i]
+            hi = upper[i]
+            run_score = -1e38
+            run_from = plo
+            for j in range(lo, hi):
+                best = -1e38
+                best_from = min(j, phi - 1)
+                # Stay
+                if j < phi:
+                    best = sv[(i - 1) % 2, j - plo] + ltrans[i, 0]
+                    best_from = j
+                # Step
+                if plo < j and j <= phi:
+                    score = sv[(i - 1) % 2, j - 1 - plo] + ltrans[i, sequence[j]]
+                    if score > best:
+                        best = score
+                        best_from = j - 1
+                # Slip from anywhere at least two positions back
+                if use_slip:
+                    if j == lo:
+                        for p in range(plo, lo - 1):
+                            if p < phi and run_score < sv[(i - 1) % 2, p - plo]:
+                                run_score = sv[(i - 1) % 2, p - plo]
+                                run_from = p
+                            run_score -= fslip
+                    elif j - 2 < phi and j - 2 >= plo:
+                        if run_score < sv[(i - 1) % 2, j - 2 - plo]:
+                            run_score = sv[(i - 1) % 2, j - 2 - plo]
+                            run_from = j - 2
+                        run_score -= fslip
+                    else:
+                        run_score -= fslip
+                    score = run_score + ltrans[i, sequence[j]]
+                    if score > best:
+                        best = score
+                        best_from = run_from
+                sv[i % 2, j - lo] = best
+                tv[ov[i] + j - lo] = best_from
+
+    return scores[(nev - 1) % 2, :width[nev - 1]].copy(), traceback, offset
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sparse_viterbi_forward(floating[:] stay, ITYPE_t[:] offset, ITYPE_t[:] state, floating[:] lpost,
+                           Py_ssize_t nbase, Py_ssize_t nkmer, double skip_pen, double prune):
+    """  Forwards pass of Viterbi for kmer transducer with sparse posterior
+
+    Only kmers present in the posterior of a block may be moved to at that
+    block, except at the first block where any kmer may start, and, after
+    each block, kmers scoring more than `prune` below the
+    best are discarded.
+    :param stay: A 1D :class:`nd.array` of log posterior of stay for each block
+    :param offset: A 1D :class:`nd.array` of start of each block in `state`
+        and `lpost`, plus one past the end
+    :param state: A 1D :class:`nd.array` of kmers of each block
+    :param lpost: A 1D :class:`nd.array` of log posterior of kmers of each block
+    :param nbase: Number of letters in alphabet
+    :param nkmer: Number of kmers
+    :param skip_pen: Penalty for skips (in log-space)
+    :param prune: Discard kmers this far below best score (in log-space)
+
+    :returns: A tuple containing the kmers and scores alive after the final
+        block and, for each block, a tuple of the kmers alive and the kmer
+        they came from, where negative entries indicate a stay
+    """
+    cdef Py_ssize_t i, j, n, nactive, ntouched, key
+    cdef Py_ssize_t nev = stay.shape[0]
+    cdef Py_ssize_t nskip = nbase * nbase
+    cdef ITYPE_t p, c, f
+    cdef floating score, move, best, neg_inf
+    assert offset.shape[0] == nev + 1, 'Offsets and blocks have different lengths'
+    dtype = np.float32 if floating is float else np.float64
+    neg_inf = -np.inf
+
+    cdef floating[:] best_step = np.full(nkmer // nbase, neg_inf, dtype=dtype)
+    cdef ITYPE_t[:] from_step = np.zeros(nkmer // nbase, dtype=ITYPE)
+    cdef floating[:] best_skip = np.full(nkmer // nskip, neg_inf, dtype=dtype)
+    cdef ITYPE_t[:] from_skip = np.zeros(nkmer // nskip, dtype=ITYPE)
+    cdef floating[:] kmer_score = np.full(nkmer, neg_inf, dtype=dtype)
+    cdef ITYPE_t[:] kmer_from = np.zeros(nkmer, dtype=ITYPE)
+    touched_arr = np.zeros(nkmer, dtype=ITYPE)
+    cdef ITYPE_t[:] touched = touched_arr
+
+    #  Initial kmers, those not retained assumed as probable as the least
+    #  probable kmer retained
+    nactive = nkmer
+    active_arr = np.arange(nkmer, dtype=ITYPE)
+    active_score_arr = np.full(nkmer, np.amin(lpost[offset[0]:offset[1]]), dtype=dtype)
+    cdef ITYPE_t[:] active = active_arr
+    cdef floating[:] active_score = active_score_arr
+    for n in range(offset[0], offset[1]):
+        active_score[state[n]] = lpost[n]
+
+    traceback = [(active_arr, np.repeat(-1, nactive))]
+    for i in range(1, nev):
+        #  Best predecessor by step and skip for each group of kmers
+        for j in range(nactive):
+            p = active[j]
+            score = active_score[j]
+            key = p % (nkmer // nbase)
+            if score > best_step[key] or (score == best_step[key] and p < from_step[key]):
+                best_step[key] = score
+                from_step[key] = p
+            key = p % (nkmer // nskip)
+            if score > best_skip[key] or (score == best_skip[key] and p < from_skip[key]):
+                best_skip[key] = score
+                from_skip[key] = p
+
+        #  Stay
+        ntouched = 0
+        for j in range(nactive):
+            p = active[j]
+            kmer_score[p] = active_score[j] + stay[i]
+            kmer_from[p] = -1
+            touched[ntouched] = p
+            ntouched += 1
+
+        #  Step or skip to kmers of block
+        for n in range(offset[i], offset[i + 1]):
+            c = state[n]
+            move = best_step[c // nbase]
+            f = from_step[c // nbase]
+            if not move > best_skip[c // nskip] - skip_pen:
+                move = best_skip[c // nskip] - skip_pen
+                f = from_skip[c // nskip]
+            if move == neg_inf:
+                continue
+            score = lpost[n] + move
+            if kmer_score[c] == neg_inf:
+                touched[ntouched] = c
+                ntouched += 1
+            elif not score > kmer_score[c]:
+                continue
+            kmer_score[c] = score
+            kmer_from[c] = f
+
+        for j in range(nactive):
+            p = active[j]
+            best_step[p % (nkmer // nbase)] = neg_inf
+            best_skip[p % (nkmer // nskip)] = neg_inf
+
+        #  Prune
+        best = neg_inf
+        for j in range(ntouched):
+            best = max(best, kmer_score[touched[j]])
+        active_arr = np.empty(ntouched, dtype=ITYPE)
+        active_score_arr = np.empty(ntouched, dtype=dtype)
+        from_arr = np.empty(ntouched, dtype=ITYPE)
+        active = active_arr
+        active_score = active_score_arr
+        nactive = 0
+        for j in range(ntouched):
+            c = touched[j]
+            if kmer_score[c] >= best - prune:
+                active[nactive] = c
+                active_score[nactive] = kmer_score[c]
+                from_arr[nactive] = kmer_from[c]
+                nactive += 1
+            kmer_score[c] = neg_inf
+        active_arr = active_arr[:nactive]
+        active_score_arr = active_score_arr[:nactive]
+        active = active_arr
+        active_score = active_score_arr
+        traceback.append((active_arr, from_arr[:nactive]))
+
+    return active_arr, active_score_arr, traceback
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def top_columns(floating[:, :] x, Py_ssize_t ntop):
+    """  Columns of largest elements of each row
+
+    Selection is by insertion into a sorted buffer, which is fast when few
+    columns are required of each row.
+
+    :param x: A 2D :class:`nd.array`
+    :param ntop: Number of columns to select from each row
+
+    :returns: A 2D :class:`nd.array` of columns of the `ntop` largest elements
+        of each row, ordered by decreasing value.  Ties are ordered by column.
+    """
+    cdef Py_ssize_t i, j, n
+    cdef Py_ssize_t nrow = x.shape[0]
+    cdef Py_ssize_t ncol = x.shape[1]
+    assert 0 < ntop <= ncol, 'Number of columns to select out of range'
+
+    res = np.empty((nrow, ntop), dtype=ITYPE)
+    cdef ITYPE_t[:, :] col = res
+
+    with nogil:
+        for i in range(nrow):
+            for j in range(ncol):
+                n = min(j, ntop)
+                if n == ntop and not x[i, j] > x[i, col[i, n - 1]]:
+                    continue
+                #  Shift smaller elements down and insert
+                if n == ntop:
+                    n -= 1
+                while n > 0 and x[i, j] > x[i, col[i, n - 1]]:
+                    col[i, n] = col[i, n - 1]
+                    n -= 1
+                col[i, n] = j
+    return res
+
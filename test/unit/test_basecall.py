@@ -0,0 +1,57 @@
+import numpy as np
+import unittest
+
+from sloika import basecall, decode
+
+
+class TestReadQuality(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        post = np.random.dirichlet(np.repeat(0.05, 65), size=200)
+        self.post = post[:, None, :]
+
+    def test_001_decode_post_quality(self):
+        score, call, qual = basecall.decode_post(self.post, 3, True, False, 1e-5, skip=0.0, quality=True)
+        post = decode.prepare_post(self.post, min_prob=1e-5)
+        self.assertAlmostEqual(qual['score_per_block'], score / len(post))
+        entropy = -np.sum(post * np.log(post)) / len(post)
+        self.assertAlmostEqual(qual['mean_entropy'], entropy, places=4)
+        self.assertAlmostEqual(qual['stay_fraction'], 1.0 - len(call) / len(post))
+
+    def test_002_decode_post_no_quality(self):
+        score, call, qual = basecall.decode_post(self.post, 3, True, False, 1e-5, skip=0.0)
+        self.assertIsNone(qual)
+        vscore, vcall = decode.viterbi(decode.prepare_post(self.post, min_prob=1e-5), 3)
+        self.assertAlmostEqual(score, vscore)
+        self.assertEqual(call, vcall)
+
+    def test_003_quality_without_posterior(self):
+        qual = basecall.read_quality(-10.0, [0, 1, 2, 3], 10, True)
+        self.assertAlmostEqual(qual['score_per_block'], -1.0)
+        self.assertAlmostEqual(qual['stay_fraction'], 0.6)
+        self.assertTrue(np.isnan(qual['mean_entropy']))
+
+    def test_004_threaded_worker_same_as_decode_worker(self):
+        reads = {'read{}'.format(i): self.post[i * 40:(i + 1) * 40] for i in range(5)}
+
+        def posterior_worker(fn, nev):
+            return fn, reads[fn], nev
+
+        decode_kwargs = {'kmer_len': 3, 'transducer': True, 'bad': False, 'min_prob': 1e-5, 'skip': 0.0}
+        res = basecall.threaded_worker(sorted(reads), posterior_worker, {'nev': 40}, decode_kwargs, 2)
+        self.assertEqual(sorted(r[0] for r in res), sorted(reads))
+        for sn, score, call, nev, qual in res:
+            expected = basecall.decode_worker(posterior_worker(sn, 40), **decode_kwargs)
+            self.assertAlmostEqual(score, expected[1])
+            self.assertEqual(list(call), list(expected[2]))
+            self.assertEqual(nev, 40)
+
+    def test_005_polished_score_is_forward_score(self):
+        skip = 3.0
+        score, call, qual = basecall.decode_post(self.post, 3, True, False, 1e-5, skip=skip, polish=(2, None))
+        post = decode.prepare_post(self.post, min_prob=1e-5)
+        post_t = np.ascontiguousarray(post.T, dtype=np.float64)
+        fwd, fscale, _, _ = decode._transpose_matrices(post_t, np.array(call) + 1, post[:, 0], np.exp(-skip))
+        self.assertAlmostEqual(score, np.log(fwd[-1, -1]) + fscale[-1])
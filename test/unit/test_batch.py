@@ -0,0 +1,149 @@
+import numpy as np
+import unittest
+
+from sloika import batch, bio, layers, maths
+from sloika.config import sloika_dtype
+import sloika.features
+
+
+def chunk_features_loop(ev, chunk_len):
+    res = []
+    for start in range(0, len(ev) - chunk_len + 1, chunk_len):
+        #  Padding of one event for step delta of last event in chunk
+        features = sloika.features.from_events(ev[start : start + chunk_len + 1], tag='', normalise=False)
+        res.append(maths.studentise(features[:chunk_len], axis=0))
+    return np.array(res)
+
+
+class ChunkifyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        self.nev = 105
+        self.chunk_len = 20
+        seq = ''.join(np.random.choice(list('ACGT'), size=self.nev + 4))
+        seq_pos = np.cumsum(np.random.randint(2, size=self.nev))
+        self.ev = np.zeros(self.nev, dtype=[('mean', 'f4'), ('stdv', 'f4'), ('length', 'f4'), ('kmer', 'S5'),
+                                            ('seq_pos', 'i8'), ('good_emission', '?')])
+        self.ev['mean'] = np.random.normal(100.0, 10.0, size=self.nev)
+        self.ev['stdv'] = np.random.gamma(2.0, size=self.nev)
+        self.ev['length'] = np.random.gamma(3.0, 0.001, size=self.nev)
+        self.ev['kmer'] = np.array(bio.seq_to_kmers(seq, 5))[seq_pos]
+        self.ev['seq_pos'] = seq_pos
+        self.ev['good_emission'] = True
+        batch.init_chunk_identity_worker(3, b'ACGT')
+
+    def test_001_per_chunk_same_as_loop(self):
+        chunks, _, _ = batch.chunkify(self.ev, self.chunk_len, 3, False, 'per-chunk')
+        np.testing.assert_almost_equal(chunks, chunk_features_loop(self.ev, self.chunk_len), decimal=5)
+
+    def test_002_labels(self):
+        _, labels, bad = batch.chunkify(self.ev, self.chunk_len, 3, False, 'none')
+        kmap = bio.kmer_mapping(3, alphabet=b'ACGT')
+        expected = np.array([kmap[k[1:4]] + 1 for k in self.ev['kmer'][:100]]).reshape(labels.shape)
+        seq_pos = self.ev['seq_pos'][:100].reshape(labels.shape)
+        expected[:, 1:][np.diff(seq_pos, axis=1) == 0] = 0
+        np.testing.assert_array_equal(labels, expected)
+        self.assertFalse(np.any(bad))
+
+
+class OpenPoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        #  Open pore either side of read of levels changing every 10 samples
+        levels = np.repeat(np.random.normal(1000.0, 200.0, size=300), 10)
+        signal = np.concatenate([np.repeat(2000.0, 1000), levels, np.repeat(2000.0, 500)])
+        self.adc = np.around(signal + np.random.normal(scale=5.0, size=len(signal))).astype(np.int16)
+        self.read_bounds = (1000, 4000)
+
+    def test_001_bounds_of_read(self):
+        for var_method in batch.TRIM_OPEN_PORE_LOCAL_VAR_METHODS:
+            self.assertEqual(batch.open_pore_bounds(self.adc, max_op_fraction=0.4, var_method=var_method),
+                             self.read_bounds)
+
+    def test_002_bounds_same_for_scaled_signal(self):
+        #  Scaling is exact so ties between windows are preserved
+        scaled = (self.adc + 10.0) * 0.25
+        for var_method in batch.TRIM_OPEN_PORE_LOCAL_VAR_METHODS:
+            self.assertEqual(batch.open_pore_bounds(scaled, max_op_fraction=0.1, var_method=var_method),
+                             batch.open_pore_bounds(self.adc, max_op_fraction=0.1, var_method=var_method))
+
+    def test_003_range_does_not_overflow(self):
+        adc = np.tile(np.array([-30000, 30000], dtype=np.int16), 1000)
+        adc[:500] = 0
+        self.assertEqual(batch.open_pore_bounds(adc, max_op_fraction=0.2, var_method='range'), (500, 2000))
+
+
+def strided_cumsum(inMat):
+    """  Network whose output at each block depends only on earlier input"""
+    return np.cumsum(inMat, axis=0)[::3]
+
+
+class CalcPostBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0xdeadbeef)
+        self.calc_post = getattr(batch, 'calc_post', None)
+        batch.calc_post = strided_cumsum
+
+    def tearDown(self):
+        batch.calc_post = self.calc_post
+
+    def test_001_batch_same_as_individual(self):
+        inMats = [np.random.normal(size=(n, 1, 2)).astype(np.float32) for n in [31, 100, 8, 99, 10, 9]]
+        for max_pad in [0.0, 0.2, 20.0]:
+            posts = batch.calc_post_batch(inMats, max_pad=max_pad)
+            self.assertEqual(len(posts), len(inMats))
+            for x, post in zip(inMats, posts):
+                np.testing.assert_almost_equal(post, strided_cumsum(x), decimal=5)
+
+    def test_002_network_stride(self):
+        self.assertEqual(batch.network_stride(2, np.float32), 3)
+
+
+def normal_init(size):
+    return np.random.normal(scale=0.5, size=size).astype(sloika_dtype)
+
+
+class CalcPostBatchNetworkTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        conv = layers.Convolution(2, 4, 5, stride=2, init=normal_init, has_bias=True)
+        birnn = layers.birnn(layers.Gru(4, 4, init=normal_init, has_bias=True),
+                             layers.Gru(4, 4, init=normal_init, has_bias=True))
+        forward = layers.Gru(4, 8, init=normal_init, has_bias=True)
+        softmax = layers.Softmax(8, 5, init=normal_init, has_bias=True)
+        self.birnn = layers.Serial([conv, birnn, softmax]).compile()
+        self.forward = layers.Serial([conv, forward, softmax]).compile()
+        self.inMats = [np.random.normal(size=(n, 1, 2)).astype(sloika_dtype) for n in [31, 50, 8, 50, 31, 47, 9]]
+
+    def setUp(self):
+        self.calc_post = getattr(batch, 'calc_post', None)
+
+    def tearDown(self):
+        batch.calc_post = self.calc_post
+
+    def test_001_birnn_equal_length_same_as_individual(self):
+        batch.calc_post = self.birnn
+        posts = batch.calc_post_batch(self.inMats)
+        self.assertEqual(len(posts), len(self.inMats))
+        for x, post in zip(self.inMats, posts):
+            np.testing.assert_almost_equal(post, self.birnn(x), decimal=6)
+
+    def test_002_birnn_padded_same_shape_as_individual(self):
+        batch.calc_post = self.birnn
+        posts = batch.calc_post_batch(self.inMats, max_pad=0.2)
+        for x, post in zip(self.inMats, posts):
+            self.assertEqual(post.shape, self.birnn(x).shape)
+
+    def test_003_forward_padded_same_as_individual(self):
+        #  Padding at end does not change posterior of network without reversed layers
+        batch.calc_post = self.forward
+        posts = batch.calc_post_batch(self.inMats, max_pad=10.0)
+        for x, post in zip(self.inMats, posts):
+            np.testing.assert_almost_equal(post, self.forward(x), decimal=6)
@@ -1,4 +1,5 @@
 """Tests for bio module"""
+import numpy as np
 import unittest
 from sloika import bio
 
@@ -187,6 +188,18 @@ class BioTest(unittest.TestCase):
         transitions2 = bio.kmer_transitions(kmers, proposed_max_move=3, forward_only=False)
         self.assertDictEqual(expected, transitions2)
 
+    def test_kmer_array_to_states_same_as_mapping(self):
+        kmap = bio.kmer_mapping(3, alphabet=b'ACGT')
+        kmers = np.array(bio.seq_to_kmers(b'GATTACACGTTGCA', 5))
+        expected = [kmap[k[1:4]] for k in kmers]
+        np.testing.assert_array_equal(bio.kmer_array_to_states(kmers, 3, alphabet=b'ACGT'), expected)
+
+    def test_seq_to_states_same_as_mapping(self):
+        kmap = bio.kmer_mapping(4, alphabet='ATC')
+        expected = [kmap[k] for k in bio.seq_to_kmers(self.base_seq.replace('G', 'A'), 4)]
+        np.testing.assert_array_equal(bio.seq_to_states(self.base_seq.replace('G', 'A'), 4, alphabet='ATC'),
+                                      expected)
+
 
 if __name__ == '__main__':
     unittest.main()
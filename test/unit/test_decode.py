@@ -1,7 +1,7 @@
 import numpy as np
 import unittest
 
-from sloika import decode
+from sloika import bio, decode
 
 
 class TestDecode(unittest.TestCase):
@@ -240,6 +240,181 @@ class TestDecode(unittest.TestCase):
         self.assertAlmostEqual(score, -11.936803444063674)
         self.assertEqual(path, [49, 7, 31, 63, 63])
 
+    def test_009_beam_search(self):
+        score, path = decode.beam_search(self.post3, 3, beam_width=16)
+        self.assertAlmostEqual(score, -11.130084569094556)
+        self.assertEqual(path, [49, 7, 63, 63])
+
+    def test_010_beam_search_with_skippen(self):
+        score, path = decode.beam_search(self.post3, 3, beam_width=16, skip_pen=3.0)
+        self.assertAlmostEqual(score, -11.936803444063674)
+        self.assertEqual(path, [49, 7, 31, 63, 63])
+
+    def test_011_beam_search_merge_increases_score(self):
+        vscore, _ = decode.beam_search(self.post3, 3, beam_width=16)
+        mscore, _ = decode.beam_search(self.post3, 3, beam_width=16, merge=True)
+        self.assertGreaterEqual(mscore, vscore)
+
+    def test_012_beam_search_narrow_beam(self):
+        vscore, _ = decode.viterbi(self.post3, 3)
+        score, path = decode.beam_search(self.post3, 3, beam_width=1)
+        self.assertLessEqual(score, vscore)
+        self.assertGreater(len(path), 0)
+
+    def test_013_viterbi_in_segments(self):
+        post = np.random.dirichlet(np.repeat(0.05, 65), size=50)
+        score, path = decode.viterbi(post, 3, skip_pen=1.0)
+        for seglen in [1, 7, 25]:
+            seg_score, seg_path = decode.viterbi(post, 3, skip_pen=1.0, max_traceback=64 * seglen)
+            self.assertAlmostEqual(seg_score, score)
+            self.assertEqual(seg_path, path)
+
+    def test_014_viterbi_long_kmer(self):
+        klen = 8
+        bases = np.random.randint(4, size=30)
+        path = decode._bases_to_kmer_path(bases, klen)
+        post = np.random.dirichlet(np.repeat(0.05, 4 ** klen + 1), size=len(path)).astype(np.float32)
+        post[np.arange(len(path)), path + 1] += 1.0
+        score, call = decode.viterbi(post, klen)
+        np.testing.assert_equal(call, path)
+        np.testing.assert_equal(decode.kmer_path_to_bases(call, klen), bases)
+
+
+class TestViterbiStream(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        post = np.random.dirichlet(np.repeat(0.05, 65), size=200)
+        self.post = decode.prepare_post(post[:, None, :])
+
+    def _stream(self, blocksize, **kwargs):
+        stream = decode.ViterbiStream(3, **kwargs)
+        seq = []
+        for i in range(0, len(self.post), blocksize):
+            seq += stream.update(self.post[i : i + blocksize])
+            if 'max_window' in kwargs:
+                self.assertLessEqual(stream.window, kwargs['max_window'])
+        seq += stream.finish()
+        return stream.score, seq
+
+    def test_001_same_as_viterbi(self):
+        score, path = decode.viterbi(self.post, 3, skip_pen=1.0)
+        for blocksize in [1, 7, 200]:
+            stream_score, stream_path = self._stream(blocksize, skip_pen=1.0)
+            self.assertAlmostEqual(stream_score, score)
+            self.assertEqual(stream_path, path)
+
+    def test_002_window_is_bounded(self):
+        score, path = decode.viterbi(self.post, 3, skip_pen=1.0)
+        stream_score, stream_path = self._stream(5, skip_pen=1.0, max_window=3)
+        self.assertAlmostEqual(stream_score, score)
+        self.assertGreater(len(stream_path), 0)
+
+
+class TestSparseViterbi(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        post = np.random.dirichlet(np.repeat(0.05, 65), size=200)
+        self.post = decode.prepare_post(post[:, None, :])
+
+    def test_001_sparsify_top(self):
+        spost = decode.sparsify_post(self.post, top=5)
+        self.assertEqual(len(spost), len(self.post))
+        self.assertTrue(np.all(np.diff(spost.offset) == 5))
+        for i in range(len(self.post)):
+            kmers = spost.state[spost.offset[i] : spost.offset[i + 1]]
+            expected = np.argsort(-self.post[i, 1:], kind='mergesort')[:5]
+            np.testing.assert_array_equal(kmers, expected)
+            np.testing.assert_almost_equal(spost.lpost[spost.offset[i] : spost.offset[i + 1]],
+                                           np.log(self.post[i, kmers + 1]))
+
+    def test_002_sparsify_mass(self):
+        spost = decode.sparsify_post(self.post, mass=0.5)
+        for i in range(len(self.post)):
+            kmers = spost.state[spost.offset[i] : spost.offset[i + 1]]
+            kept = np.sum(self.post[i, kmers + 1])
+            self.assertGreaterEqual(kept, 0.5 * np.sum(self.post[i, 1:]))
+            self.assertLess(kept - np.amin(self.post[i, kmers + 1]), 0.5 * np.sum(self.post[i, 1:]))
+
+    def test_003_all_kmers_same_as_viterbi(self):
+        score, path = decode.viterbi(self.post, 3, skip_pen=1.0)
+        spost = decode.sparsify_post(self.post)
+        sparse_score, sparse_path = decode.sparse_viterbi(spost, 3, skip_pen=1.0, prune=None)
+        self.assertAlmostEqual(sparse_score, score)
+        self.assertEqual(list(sparse_path), path)
+
+    def test_004_sparse_score_bounded(self):
+        spost = decode.sparsify_post(self.post, top=4)
+        score, path = decode.sparse_viterbi(spost, 3)
+        self.assertLessEqual(score, spost.upper_bound())
+        self.assertGreater(len(path), 0)
+
+    def test_005_fallback_to_viterbi(self):
+        score, path = decode.viterbi(self.post, 3)
+        sparse_score, sparse_path = decode.sparse_decode(self.post, 3, top=1, max_gap=0.0)
+        self.assertAlmostEqual(sparse_score, score)
+        self.assertEqual(sparse_path, path)
+
+
+class TestPolish(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        self.klen = 3
+        self.bases = np.random.randint(4, size=40)
+        self.path = decode._bases_to_kmer_path(self.bases, self.klen)
+        nstate = 4 ** self.klen + 1
+        post = []
+        for state in self.path:
+            for i in range(np.random.randint(1, 4)):
+                p = 0.3 * np.random.dirichlet(np.repeat(0.1, nstate))
+                p[0 if i > 0 else state + 1] += 0.7
+                post.append(p)
+        self.post = np.array(post)
+
+    def test_001_path_to_bases(self):
+        bases = decode.kmer_path_to_bases(self.path, self.klen)
+        self.assertTrue(np.array_equal(bases, self.bases))
+
+    def test_002_path_to_bases_with_skip(self):
+        bases = decode.kmer_path_to_bases([6, 27, 60], 3)
+        self.assertTrue(np.array_equal(bases, [0, 1, 2, 3, 3, 0]))
+
+    def test_003_transposed_matrices_consistent(self):
+        post_t = np.ascontiguousarray(self.post.T)
+        fwd, fscale, bwd, bscale = decode._transpose_matrices(post_t, self.path + 1, self.post[:, 0], 0.0)
+        scores = np.log(np.sum(fwd * bwd, axis=1)) + fscale + bscale
+        self.assertTrue(np.allclose(scores, scores[-1]))
+        self.assertAlmostEqual(scores[-1], np.log(fwd[-1, -1]) + fscale[-1])
+
+    def test_004_polish_corrects_errors(self):
+        bases = self.bases.copy()
+        bases[10] = (bases[10] + 1) % 4
+        bases = np.insert(np.delete(bases, 20), 30, 2)
+        start = decode._bases_to_kmer_path(bases, self.klen)
+
+        score, path, niter = decode.polish(self.post, start, self.klen, max_iter=10)
+        self.assertLess(niter, 10)
+        self.assertTrue(np.array_equal(path, self.path))
+
+    def test_005_polish_respects_budget(self):
+        score, path, niter = decode.polish(self.post, self.path[::-1], self.klen, max_iter=1)
+        self.assertEqual(niter, 1)
+        score, path, niter = decode.polish(self.post, self.path[::-1], self.klen, max_time=0.0)
+        self.assertEqual(niter, 0)
+
+    def test_006_path_to_sequence_same_as_kmers(self):
+        path = np.random.randint(4 ** self.klen, size=100)
+        path[10:12] = path[9]
+        kmers = bio.all_kmers(self.klen)
+        for always_move in [True, False]:
+            seq = decode.kmer_path_to_sequence(path, self.klen, always_move=always_move).decode('ascii')
+            self.assertEqual(seq, bio.kmers_to_sequence([kmers[i] for i in path], always_move=always_move))
+
 
 class TestDecodeModifiedBases(unittest.TestCase):
 
@@ -254,3 +429,7 @@ class TestDecodeModifiedBases(unittest.TestCase):
     def test_viterbi(self):
         score, path = decode.viterbi(self.post, 3, skip_pen=5.0, nbase=5)
         self.assertEqual(path, [x - 1 for x in self.seq if x])
+
+    def test_beam_search(self):
+        score, path = decode.beam_search(self.post, 3, skip_pen=5.0, nbase=5)
+        self.assertEqual(path, [x - 1 for x in self.seq if x])
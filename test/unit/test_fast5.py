@@ -1,6 +1,10 @@
 import glob
+import h5py
 from nose_parameterized import parameterized
+import numpy as np
 import os
+import shutil
+import tempfile
 import unittest
 
 from sloika import fast5
@@ -149,3 +153,27 @@ class GetReadTest(unittest.TestCase):
         with fast5.Reader(filename) as f5:
             ev = f5.get_read(raw=raw)
             self.assertEqual(len(ev), number_of_events)
+
+
+class ScaleRawTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'legacy.fast5')
+        with h5py.File(self.filename, 'w') as h5:
+            h5.create_group('UniqueGlobalKey/channel_id').attrs.update(
+                {'sampling_rate': 4000.0, 'range': 1000.0, 'digitisation': 1000.0, 'offset': 0.0})
+            h5.create_dataset('Analyses/RawData/Signal', data=np.arange(10, dtype=np.int16))
+            h5.create_group('Analyses/RawData/Meta').attrs.update(
+                {'sample_rate': 4000.0, 'range': 500.0, 'digitisation': 1000.0, 'offset': 4.0})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_legacy_file_scaled_as_get_read(self):
+        with fast5.Reader(self.filename) as f5:
+            expected = f5.get_read(raw=True)
+            signal = f5.get_read(raw=True, scale=False)
+            np.testing.assert_almost_equal(f5.scale_raw(signal), expected)
+            np.testing.assert_almost_equal(f5.scale_raw(signal[2:5]), expected[2:5])
+        np.testing.assert_almost_equal(expected, 0.5 * (np.arange(10) + 4.0))
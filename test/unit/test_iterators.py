@@ -1,3 +1,6 @@
+import os
+import subprocess
+import sys
 import unittest
 import numpy as np
 
@@ -28,5 +31,39 @@ class IteratorsTest(unittest.TestCase):
         self.assertEqual(self.f(L, 6), [(1, 2, 3, 4), (1, 2, 3, 4, 5), (1, 2, 3, 4, 5, 6),
                                         (2, 3, 4, 5, 6, 7), (3, 4, 5, 6, 7), (4, 5, 6, 7), (5, 6, 7)])
 
+    def test_imap_threads_ordered(self):
+        L = [hex(x) for x in range(20)]
+        res = iterators.imap_threads(int, L, fix_kwargs={'base': 16}, threads=3)
+        self.assertEqual(list(res), list(range(20)))
+
+    def test_imap_threads_unordered(self):
+        L = list(range(20))
+        res = iterators.imap_threads(pow, L, fix_args=[2], threads=3, unordered=True, max_pending=4)
+        self.assertEqual(sorted(res), [2 ** x for x in L])
+
+    def test_imap_mp_reorder(self):
+        L = list(range(20))
+        for threads in [1, 3]:
+            res = iterators.imap_mp_reorder(pow, L, fix_args=[2], threads=threads, max_pending=2)
+            self.assertEqual(list(res), [2 ** x for x in L])
+
+    def test_imap_mp_reorder_worker_raises(self):
+        #  Run in a fresh interpreter, which would hang on exit if the pool
+        #  were left waiting for the consumer
+        script = '\n'.join([
+            'from sloika import iterators',
+            'def f(x):',
+            '    if x == 5:',
+            '        raise ValueError(x)',
+            '    return x',
+            'try:',
+            '    list(iterators.imap_mp_reorder(f, range(100), threads=2, max_pending=4))',
+            'except ValueError:',
+            '    print("raised")'])
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(root))
+        out = subprocess.check_output([sys.executable, '-c', script], env=env, timeout=60)
+        self.assertEqual(out.decode().strip(), 'raised')
+
 if __name__ == '__main__':
     unittest.main()
@@ -265,12 +265,19 @@ class ANNTest(unittest.TestCase):
             np.testing.assert_almost_equal(self.x[:_WINLEN, j].ravel(), res[0, j].transpose().ravel())
             np.testing.assert_almost_equal(self.x[-_WINLEN:, j].ravel(), res[-1, j].transpose().ravel())
 
-    @unittest.skip('Decoding needs fixing')
     def test_017_decode_simple(self):
+        from sloika import decode
         _KMERLEN = 3
-        network = nn.Decode(_KMERLEN)
+        network = nn.Decode(_KMERLEN, skip_pen=2.0)
         f = network.compile()
-        res = f(self.res)
+        post = np.random.dirichlet(np.ones(self._SIZE + 1), size=(self._NSTEP, self._NBATCH)).astype(sloika_dtype)
+        res = f(post)
+        self.assertEqual(res.shape, (self._NSTEP, self._NBATCH, 2))
+
+        for i in range(self._NBATCH):
+            score, call = decode.viterbi(post[:, i], _KMERLEN, skip_pen=2.0)
+            self.assertAlmostEqual(res[-1, i, 1], score, places=3)
+            np.testing.assert_equal(res[:, i, 0][res[:, i, 0] >= 0], call)
 
     def test_018_studentise(self):
         network = nn.Studentise(self._NFEATURES)
@@ -68,6 +68,33 @@ class MathsTest(unittest.TestCase):
         self.assertTrue(np.allclose(maths.mad(x, axis=2, keepdims=True),
                         np.zeros((5, 6, 1))))
 
+    def test_008_fast_med_mad_exact_for_integers(self):
+        for hi in [50, 1000]:
+            x = np.random.randint(-hi // 2, hi, size=(20, 31, 4)).astype(np.int16)
+            for axis in [None, 0, 1, 2]:
+                loc, scale = maths.med_mad(x, axis=axis, method='fast')
+                expected_loc, expected_scale = maths.med_mad(x, axis=axis)
+                np.testing.assert_almost_equal(loc, expected_loc)
+                np.testing.assert_almost_equal(scale, expected_scale)
+
+    def test_009_fast_med_mad_within_bound(self):
+        x = np.random.normal(100.0, 10.0, size=(3, 1000))
+        expected_loc, expected_scale = maths.med_mad(x, factor=1, axis=1)
+        for nbin in [50, 500]:
+            width = (np.amax(x, axis=1) - np.amin(x, axis=1)) / nbin
+            loc, scale = maths.med_mad(x, factor=1, axis=1, method='fast', nbin=nbin)
+            self.assertTrue(np.all(np.fabs(loc - expected_loc) <= 0.5 * width))
+            self.assertTrue(np.all(np.fabs(scale - expected_scale) <= width))
+
+    def test_010_fast_med_mad_constant(self):
+        self.assertEqual(maths.med_mad(np.zeros(100), method='fast'), (0.0, 0.0))
+        x = np.random.normal(size=(4, 200))
+        x[1] = 7.0
+        for nvalue in [20, 200]:
+            loc, scale = maths.med_mad(x[:, :nvalue], axis=1, method='fast', nbin=16)
+            self.assertEqual(loc[1], 7.0)
+            self.assertEqual(scale[1], 0.0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import numpy as np
+from sloika import olddecode
+
+
+def estimate_transitions_loop(post):
+    res = np.zeros((len(post), 3))
+    res[:] = olddecode._ETA
+    for ev in range(1, len(post)):
+        stay = np.sum(post[ev - 1] * post[ev])
+        p = post[ev].reshape((-1, olddecode._NSTEP))
+        step = np.sum(post[ev - 1] * np.tile(np.sum(p, axis=1), olddecode._NSTEP)) / olddecode._NSTEP
+        p = post[ev].reshape((-1, olddecode._NSKIP))
+        skip = np.sum(post[ev - 1] * np.tile(np.sum(p, axis=1), olddecode._NSKIP)) / olddecode._NSKIP
+        res[ev - 1] = [stay, step, skip]
+    return res
+
+
+def decode_loop(post, slip):
+    """  Exhaustive Viterbi over all transitions between states"""
+    nev, nstate = post.shape
+    nrem_step = nstate // olddecode._NSTEP
+    nrem_skip = nstate // olddecode._NSKIP
+    lpost = np.log(olddecode._ETA + post)
+    log_slip = np.log(olddecode._ETA + slip)
+    pscore = lpost[0]
+    for ev in range(1, nev):
+        score = np.full(nstate, -np.inf)
+        for to in range(nstate):
+            cands = [pscore[to], np.amax(pscore) + log_slip]
+            cands += [pscore[to // olddecode._NSTEP + i * nrem_step]
+                      for i in range(olddecode._NSTEP)]
+            cands += [pscore[to // olddecode._NSKIP + i * nrem_skip]
+                      for i in range(olddecode._NSKIP)]
+            score[to] = max(cands)
+        pscore = score + lpost[ev]
+    return np.amax(pscore)
+
+
+class OldDecodeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        self.nev = 20
+        self.nstate = 64
+        self.post = np.random.dirichlet(np.ones(self.nstate) * 0.1, size=self.nev)
+
+    def test_001_estimate_transitions_same_as_loop(self):
+        expected = estimate_transitions_loop(self.post)
+        trans = np.sum(expected, axis=0)
+        expected *= trans / np.sum(trans)
+        expected /= np.sum(expected, axis=1).reshape((-1, 1))
+        np.testing.assert_almost_equal(olddecode.estimate_transitions(self.post), expected)
+
+    def test_002_decode_profile_score(self):
+        for slip in [0.0, 0.5]:
+            score, _ = olddecode.decode_profile(self.post, slip=slip)
+            self.assertAlmostEqual(score, decode_loop(self.post, slip))
+
+    def test_003_decode_profile_path_consistent(self):
+        lpost = np.log(olddecode._ETA + self.post)
+        score, path = olddecode.decode_profile(self.post)
+        self.assertEqual(len(path), self.nev)
+        #  With no transition weights, score of path is sum of its emissions
+        self.assertAlmostEqual(score, np.sum(lpost[np.arange(self.nev), path]))
+
+    def test_004_estimate_transitions_single_event(self):
+        res = olddecode.estimate_transitions(self.post[:1])
+        np.testing.assert_almost_equal(res, np.array([[1.0, 1.0, 1.0]]) / 3.0)
@@ -2,7 +2,7 @@ import numpy as np
 import unittest
 
 from sloika.config import sloika_dtype
-from sloika.tools.chunkify_raw import convert_mapping_times_to_samples
+from sloika.tools.chunkify_raw import convert_mapping_times_to_samples, replace_repeats_with_zero
 from sloika.util import is_close
 
 
@@ -37,3 +37,15 @@ class RawChunkifyUtilTest(unittest.TestCase):
         self.assertTrue(len(events) == len(commensurate_events))
         for e in commensurate_events:
             self.assertTrue(is_close(raw[e['start']: e['start'] + e['length']].mean(), e['mean']))
+
+    def test_replace_repeats_with_zero(self):
+        arr = np.array([3, 3, 1, 2, 2, 2, 0, 1, 1])
+        np.testing.assert_array_equal(replace_repeats_with_zero(arr), [3, 0, 1, 2, 0, 0, 0, 1, 0])
+
+    def test_replace_repeats_with_zero_same_for_each_row(self):
+        np.random.seed(0xdeadbeef)
+        arr = np.random.randint(3, size=(20, 30))
+        expected = arr.copy()
+        for row in expected:
+            row[np.ediff1d(row, to_begin=1) == 0] = 0
+        np.testing.assert_array_equal(replace_repeats_with_zero(arr.copy()), expected)
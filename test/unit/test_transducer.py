@@ -1,6 +1,7 @@
 import numpy as np
 import sys
-from sloika.transducer import align, alignment_to_call
+from sloika.transducer import (align, alignment_to_call, anchor_band, find_anchors, map_to_sequence,
+                               _map_to_sequence_numpy)
 import unittest
 
 _NEGLARGE = -3000.0
@@ -163,3 +164,53 @@ class TransducerTest(unittest.TestCase):
         call = [1, 2, 4, 3, 0, 1, 2, 3]
         score, alignment, path = self._compare_seqs(seq1, seq2)
         self.assertTrue(np.array_equiv(path, call))
+
+
+class MapToSequenceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        self.nstate = 65
+        #  Sequence of 3-mers from random bases
+        bases = np.random.randint(4, size=302)
+        self.seq = 1 + bases[:-2] * 16 + bases[1:-1] * 4 + bases[2:]
+        #  Read covering middle of sequence with stays
+        blocks = []
+        for state in self.seq[10:-10]:
+            blocks += [state] + [0] * np.random.randint(3)
+        self.post = np.random.dirichlet(np.ones(self.nstate), size=len(blocks)) * 0.1
+        self.post[np.arange(len(blocks)), blocks] += 0.9
+
+    def test_001_full_band_same_as_unconstrained(self):
+        nev = len(self.post)
+        band = (np.zeros(nev, dtype=int), np.repeat(len(self.seq), nev))
+        for slip in [None, 5.0]:
+            score1, path1 = map_to_sequence(self.post, self.seq, slip=slip, log=False)
+            score2, path2 = map_to_sequence(self.post, self.seq, slip=slip, log=False, band=band)
+            self.assertAlmostEqual(score1, score2, places=4)
+            np.testing.assert_equal(path1, path2)
+
+    def test_002_anchors_are_chained(self):
+        blocks, positions = find_anchors(self.post, self.seq)
+        self.assertGreater(len(blocks), 0)
+        self.assertTrue(np.all(np.diff(blocks) > 0))
+        self.assertTrue(np.all(np.diff(positions) > 0))
+        np.testing.assert_equal(np.argmax(self.post[blocks], axis=1), self.seq[positions])
+
+    def test_003_anchored_band(self):
+        lower, upper = anchor_band(self.post, self.seq, 5)
+        self.assertTrue(np.all(lower < upper))
+        self.assertLess(np.sum(upper - lower), len(self.post) * len(self.seq) // 4)
+        score1, path1 = map_to_sequence(self.post, self.seq, slip=5.0, log=False)
+        score2, path2 = map_to_sequence(self.post, self.seq, slip=5.0, log=False, band=(lower, upper))
+        self.assertAlmostEqual(score1, score2, places=4)
+        np.testing.assert_equal(path1, path2)
+
+    def test_004_same_as_numpy(self):
+        post = np.random.dirichlet(np.ones(self.nstate), size=50)
+        for slip in [None, 0.0, 1.0, 5.0]:
+            score1, path1 = map_to_sequence(post, self.seq[:40], slip=slip, log=False)
+            score2, path2 = _map_to_sequence_numpy(post, self.seq[:40], slip=slip, log=False)
+            self.assertAlmostEqual(score1, score2, places=4)
+            np.testing.assert_equal(path1, path2)
@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+
+from sloika import transitions
+
+
+class TransitionsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        self.klen = 3
+
+    def _check_predecessors(self, nbase):
+        trans = transitions.kmer_transitions(self.klen, nbase=nbase)
+        nkmer = nbase ** self.klen
+        for nmove, pred in [(nbase, trans.step_from), (nbase * nbase, trans.skip_from)]:
+            self.assertEqual(pred.shape, (nkmer // nmove, nmove))
+            for kmer in range(nkmer):
+                #  Suffix of predecessor matches prefix of kmer
+                expected = [p for p in range(nkmer) if p % (nkmer // nmove) == kmer // nmove]
+                self.assertEqual(sorted(pred[kmer // nmove]), expected)
+
+    def test_001_predecessors_four_bases(self):
+        self._check_predecessors(4)
+
+    def test_002_predecessors_five_bases(self):
+        self._check_predecessors(5)
+
+    def test_003_cached(self):
+        trans = transitions.kmer_transitions(self.klen)
+        self.assertIs(trans, transitions.kmer_transitions(self.klen))
+        self.assertIsNot(trans, transitions.kmer_transitions(self.klen, nbase=5))
+        self.assertFalse(trans.step_from.flags.writeable)
+
+    def test_004_best_predecessor(self):
+        trans = transitions.kmer_transitions(self.klen)
+        score = np.random.normal(size=(2, trans.nkmer))
+        best, best_from = transitions.best_predecessor(score, trans.step_from)
+        for i in range(2):
+            for j, pred in enumerate(trans.step_from):
+                self.assertEqual(best_from[i, j], pred[np.argmax(score[i, pred])])
+                self.assertEqual(best[i, j], np.amax(score[i, pred]))
+
+    def test_005_predecessor_of_moves(self):
+        trans = transitions.kmer_transitions(self.klen)
+        kmer = np.arange(trans.nkmer)
+        np.testing.assert_equal(trans.predecessor(kmer, 0), -1)
+        for j in range(trans.nstep):
+            np.testing.assert_equal(trans.predecessor(kmer, 1 + j), trans.step_from[kmer // trans.nstep, j])
+        for j in range(trans.nskip):
+            np.testing.assert_equal(trans.predecessor(kmer, 1 + trans.nstep + j),
+                                    trans.skip_from[kmer // trans.nskip, j])
@@ -0,0 +1,189 @@
+import h5py
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from sloika import util
+
+
+def fake_chunk_worker(fn, nchunk, calls):
+    calls.append(fn)
+    if nchunk is None:
+        return None
+    if nchunk == 0:
+        return util.empty_chunks(5, 1)
+    x = np.full((nchunk, 5), len(fn), dtype=np.int32)
+    return x.reshape((nchunk, 5, 1)).astype(np.float32), x, x == 0
+
+
+class LabelledChunksWriterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        self.chunks = np.random.normal(size=(10, 20, 4)).astype(np.float32)
+        self.labels = np.random.randint(3, size=(10, 20)).astype(np.int32)
+        self.bad = np.random.randint(2, size=(10, 20)).astype(np.int8)
+
+    def setUp(self):
+        fh, self.fname = tempfile.mkstemp(suffix='.hdf5')
+        os.close(fh)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_001_appended_same_as_whole(self):
+        with util.LabelledChunksWriter(self.fname, {'kmer': 5}) as writer:
+            for i in range(0, 10, 3):
+                writer.append(self.chunks[i : i + 3], self.labels[i : i + 3], self.bad[i : i + 3])
+            writer.finalise(0.4)
+            np.testing.assert_almost_equal(writer.blank_fraction, np.mean(self.labels == 0, axis=1))
+
+        with h5py.File(self.fname, 'r') as h5:
+            self.assertEqual(h5.attrs['kmer'], 5)
+            np.testing.assert_equal(h5['chunks'][:], self.chunks)
+            np.testing.assert_equal(h5['labels'][:], self.labels)
+            np.testing.assert_equal(h5['bad'][:], self.bad)
+            np.testing.assert_equal(h5['weights'][:], np.sum(self.labels == 0, axis=1) < 8)
+
+    def test_002_partial_file_readable(self):
+        writer = util.LabelledChunksWriter(self.fname, {})
+        writer.append(self.chunks[:4], self.labels[:4], self.bad[:4])
+        with h5py.File(self.fname, 'r') as h5:
+            np.testing.assert_equal(h5['chunks'][:], self.chunks[:4])
+            self.assertNotIn('weights', h5)
+        writer.close()
+
+    def test_003_identical_writes_byte_identical(self):
+        fh, fname2 = tempfile.mkstemp(suffix='.hdf5')
+        os.close(fh)
+        contents = []
+        for fname in [self.fname, fname2]:
+            with util.LabelledChunksWriter(fname, {'kmer': 5}) as writer:
+                writer.append(self.chunks, self.labels, self.bad)
+                writer.finalise(0.4)
+            with open(fname, 'rb') as fh:
+                contents.append(fh.read())
+            #  Timestamps are in seconds
+            time.sleep(1.1)
+        os.remove(fname2)
+        self.assertEqual(contents[0], contents[1])
+
+
+class ShardedChunksWriterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        np.random.seed(0xdeadbeef)
+        self.chunks = np.random.normal(size=(10, 20, 4)).astype(np.float32)
+        self.labels = np.random.randint(3, size=(10, 20)).astype(np.int32)
+        self.bad = np.random.randint(2, size=(10, 20)).astype(np.int8)
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_001_sharded_same_as_single(self):
+        names = ['chunks', 'labels', 'bad', 'weights']
+        attributes = {'kmer': 5, 'alphabet': b'ACGT'}
+        single = os.path.join(self.dirname, 'single.hdf5')
+        with util.chunks_writer(single, attributes) as writer:
+            writer.append(self.chunks, self.labels, self.bad)
+            writer.finalise(0.4)
+
+        manifest = os.path.join(self.dirname, 'sharded.json')
+        with util.chunks_writer(manifest, attributes, shard_size=4) as writer:
+            for i in range(0, 10, 3):
+                writer.append(self.chunks[i : i + 3], self.labels[i : i + 3], self.bad[i : i + 3])
+            writer.finalise(0.4)
+        self.assertEqual(len(util.chunk_files(manifest)), 2)
+
+        for x, y in zip(util.read_chunks(single, names), util.read_chunks(manifest, names)):
+            np.testing.assert_equal(x, y)
+        attrs = util.chunk_attributes(manifest)
+        self.assertEqual(attrs['kmer'], 5)
+        self.assertEqual(attrs['alphabet'], b'ACGT')
+
+
+class ChunkCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dirname, 'cache.hdf5')
+        self.fnames = []
+        for i in range(3):
+            fn = os.path.join(self.dirname, 'read{}.fast5'.format('x' * i))
+            with open(fn, 'w') as fh:
+                fh.write('read')
+            self.fnames.append(fn)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def cached_results(self, nchunk, calls):
+        kwargs = {'nchunk': nchunk, 'calls': calls}
+        return list(util.imap_cached(self.cache, {'nchunk': nchunk}, fake_chunk_worker, self.fnames, kwargs))
+
+    def test_001_rerun_uses_cache(self):
+        calls = []
+        expected = self.cached_results(2, calls)
+        self.assertEqual(calls, self.fnames)
+
+        calls = []
+        res = self.cached_results(2, calls)
+        self.assertEqual(calls, [])
+        for x, y in zip(expected, res):
+            for a, b in zip(x, y):
+                np.testing.assert_array_equal(a, b)
+
+    def test_002_changed_reads_and_params_not_cached(self):
+        self.cached_results(0, [])
+        calls = []
+        self.assertEqual(self.cached_results(0, calls), [None, None, None])
+        self.assertEqual(calls, [])
+
+        with open(self.fnames[1], 'a') as fh:
+            fh.write('more')
+        calls = []
+        self.cached_results(0, calls)
+        self.assertEqual(calls, self.fnames[1:2])
+
+        calls = []
+        self.cached_results(1, calls)
+        self.assertEqual(calls, self.fnames)
+
+    def test_003_deterministic_in_order_of_reads(self):
+        fnames = self.fnames
+        self.fnames = fnames[::2]
+        self.cached_results(1, [])
+
+        self.fnames = fnames
+        calls = []
+        kwargs = {'nchunk': 1, 'calls': calls}
+        res = util.imap_cached(self.cache, {'nchunk': 1}, fake_chunk_worker, self.fnames, kwargs,
+                               deterministic=True)
+        self.assertEqual([r[1][0, 0] for r in res], [len(fn) for fn in fnames])
+        self.assertEqual(calls, fnames[1:2])
+
+    def test_004_failures_not_cached(self):
+        calls = []
+        self.assertEqual(self.cached_results(None, calls), [None, None, None])
+        calls = []
+        self.cached_results(None, calls)
+        self.assertEqual(calls, self.fnames)
+
+    def test_005_incomplete_entry_not_used(self):
+        with util.ChunkCache(self.cache, {'nchunk': 1}) as chunk_cache:
+            chunk_cache.put(self.fnames[0], fake_chunk_worker(self.fnames[0], 1, []))
+            #  As left by a write interrupted after creating entry
+            chunk_cache.group.create_group(chunk_cache._key(self.fnames[1]))
+            chunk_cache.group.create_group(chunk_cache._key(self.fnames[2]) + '.tmp')
+        calls = []
+        res = self.cached_results(1, calls)
+        self.assertEqual(calls, self.fnames[1:])
+        self.assertEqual([r[1][0, 0] for r in res], [len(fn) for fn in self.fnames])
@@ -31,3 +31,46 @@ class ViterbiTest(unittest.TestCase):
 
         np.testing.assert_almost_equal(y1s, y2s)
         np.testing.assert_equal(y1i, y2i)
+
+    def test_002_forward_scan_same_as_python(self):
+        x = np.random.uniform(size=self.n + 1)
+        a = np.random.uniform(size=self.n)
+        y = x.copy()
+        for i in range(self.n):
+            y[i + 1] += a[i] * y[i]
+
+        viterbi_helpers.forward_scan(x, a)
+        np.testing.assert_almost_equal(x, y)
+
+    def test_003_backward_scan_same_as_python(self):
+        x = np.random.uniform(size=self.n + 1)
+        a = np.random.uniform(size=self.n)
+        y = x.copy()
+        for i in range(self.n, 0, -1):
+            y[i - 1] += a[i - 1] * y[i]
+
+        viterbi_helpers.backward_scan(x, a)
+        np.testing.assert_almost_equal(x, y)
+
+    def test_004_viterbi_forward_same_as_python(self):
+        from sloika.decode import _viterbi_step
+        from sloika.transitions import kmer_transitions
+        trans = kmer_transitions(3)
+        lpost = np.log(np.random.dirichlet(np.ones(65) * 0.1, size=self.n))
+        vscore, traceback = viterbi_helpers.viterbi_forward(lpost, trans.step_from, trans.skip_from, self.slip)
+
+        pscore = lpost[0][1:]
+        for i in range(1, self.n):
+            pscore, tb = _viterbi_step(pscore, lpost[i], trans, self.slip)
+            np.testing.assert_equal(trans.predecessor(np.arange(64), traceback[i]), tb)
+        np.testing.assert_almost_equal(vscore, pscore)
+
+    def test_005_map_forward_same_as_python(self):
+        from sloika import transducer
+        trans = np.log(np.random.dirichlet(np.ones(65) * 0.1, size=self.n * 5)).astype(np.float32)
+        seq = np.random.randint(1, 65, size=self.n)
+        for slip in [None, self.slip]:
+            score1, path1 = transducer.map_to_sequence(trans, seq, slip=slip)
+            score2, path2 = transducer._map_to_sequence_numpy(trans, seq, slip=slip)
+            self.assertAlmostEqual(score1, score2, places=5)
+            np.testing.assert_equal(path1, path2)